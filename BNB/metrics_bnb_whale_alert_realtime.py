@@ -7,8 +7,8 @@ from datetime import datetime
 import time
 import json
 import os
-import logging
 from cloud_db import db
+from scanner_log import get_scanner_logger
 
 from .bnb_cex_dex_wallets import classify_transaction
 
@@ -16,11 +16,10 @@ USER_SEEN_BLOCK_FILE = "bnb_whale_user_seen_block.json"
 HISTORY_FILE = "bnb_whale_alert_history.json"
 BLOCK_FILE = "bnb_whale_last_block.json"
 
-# Configure logging
-logging.basicConfig(filename="bnb_whale_scanner.log", level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
-
 # Define the log file for BNB whale scanner
 LOG_FILE = "bnb_whale_scanner.log"
+# Logger riêng của scanner (không cấu hình root logger)
+_logger = get_scanner_logger("bnb", LOG_FILE)
 
 # --- User seen block logic ---
 def mark_bnb_whale_alert_seen():
@@ -60,20 +59,20 @@ def fetch_block_transactions(block_number):
     try:
         data = r.json()
     except json.JSONDecodeError:
-        logging.error(f"Failed to decode JSON response for block {block_number}: {r.text}")
+        _logger.error(f"Failed to decode JSON response for block {block_number}: {r.text}")
         raise ValueError("Failed to decode JSON response from API.")
 
     if not isinstance(data, dict):
-        logging.error(f"Unexpected response format for block {block_number}: {data}")
+        _logger.error(f"Unexpected response format for block {block_number}: {data}")
         raise ValueError("Unexpected response format from API.")
 
     if "result" not in data or not isinstance(data["result"], dict):
-        logging.error(f"API returned error for block {block_number}: {data}")
+        _logger.error(f"API returned error for block {block_number}: {data}")
         raise ValueError(f"API error: {data.get('error', 'Unknown error')}")
 
     txs = data["result"].get("transactions", [])
     if not isinstance(txs, list):
-        logging.error(f"Unexpected transactions format for block {block_number}: {txs}")
+        _logger.error(f"Unexpected transactions format for block {block_number}: {txs}")
         raise ValueError(f"Unexpected transactions format for block {block_number}.")
 
     # Ensure transactions are formatted correctly
@@ -88,7 +87,7 @@ def fetch_block_transactions(block_number):
                 "timeStamp": tx.get("timeStamp"),
             })
         except Exception as e:
-            logging.error(f"Error formatting transaction {tx}: {e}")
+            _logger.error(f"Error formatting transaction {tx}: {e}")
 
     return formatted_txs
 
@@ -101,8 +100,8 @@ def load_whale_history():
 
     if db.available():
         # Lấy dữ liệu từ database
-        db_history = db.find_all("bnb_whale_history", sort_field="time", ascending=True)
-        db_hashes = {d.get("hash") for d in db_history if isinstance(d, dict) and "hash" in d}
+        # Chỉ lấy field hash (stream theo batch), không kéo toàn bộ lịch sử về để so sánh
+        db_hashes = {d.get("hash") for d in db.iter_find("bnb_whale_history", projection=["hash"], batch_size=5000) if "hash" in d}
 
         # Gộp dữ liệu từ file local vào database
         new_entries = [entry for entry in local_history if entry.get("hash") not in db_hashes]
@@ -141,19 +140,8 @@ def load_last_block():
     return local_last_block
 
 def _log(msg: str):
-    try:
-        line = f"[{datetime.utcnow()}] {msg}"
-        with open(LOG_FILE, "a", encoding="utf-8") as logf:
-            logf.write(line + "\n")
-
-        if db.available():
-            # Gộp log từ file local vào database
-            with open(LOG_FILE, "r", encoding="utf-8") as logf:
-                local_logs = [{"ts": datetime.utcnow().isoformat(), "line": line.strip()} for line in logf]
-            db.insert_many("bnb_logs", local_logs)
-            print(f"Gộp {len(local_logs)} log từ file local vào database.")
-    except Exception:
-        pass
+    # File xoay vòng + ring buffer; chỉ record mới được gửi lên bnb_logs theo batch (scanner_log)
+    _logger.info(msg)
 
 def show_bnb_whale_alert_realtime(min_value_bnb=250, num_blocks=100):
     st.markdown("""
@@ -200,26 +188,26 @@ def save_whale_history(history):
 def background_whale_alert_scanner(min_value_bnb=250, num_blocks=100, interval_sec=300):
     while True:
         try:
-            logging.info("Starting block scan...")
+            _logger.info("Starting block scan...")
             latest_block = fetch_latest_block_number()
             if not latest_block:
-                #logging.warning("Failed to fetch the latest block number.")
+                #_logger.warning("Failed to fetch the latest block number.")
                 time.sleep(interval_sec)
                 continue
-            logging.info(f"Latest block number: {latest_block}")
+            _logger.info(f"Latest block number: {latest_block}")
             last_scanned = load_last_block()
             start_block = latest_block
             end_block = latest_block - num_blocks + 1
             if last_scanned and last_scanned >= end_block:
                 end_block = last_scanned + 1
-            logging.info(f"Scanning blocks from {start_block} to {end_block}")
+            _logger.info(f"Scanning blocks from {start_block} to {end_block}")
             whale_txs = load_whale_history()
             seen_hashes = set(tx['hash'] for tx in whale_txs)
             for block_num in range(start_block, end_block - 1, -1):
                 try:
                     txs = fetch_block_transactions(block_num)
                     total_bnb = sum(tx.get("value", 0) for tx in txs)
-                    #logging.info(f"Block {block_num} contains a total of {total_bnb:.2f} BNB")
+                    #_logger.info(f"Block {block_num} contains a total of {total_bnb:.2f} BNB")
                     for tx in txs:
                         value_bnb = tx.get("value", 0)
                         tx_hash = tx.get("hash", "")
@@ -238,16 +226,16 @@ def background_whale_alert_scanner(min_value_bnb=250, num_blocks=100, interval_s
                             }
                             whale_txs.append(tx_obj)
                             seen_hashes.add(tx_hash)
-                            logging.info(f"Logged whale transaction: {tx_obj}")
+                            _logger.info(f"Logged whale transaction: {tx_obj}")
                 except Exception as e:
-                    logging.error(f"Error processing block {block_num}: {e}")
+                    _logger.error(f"Error processing block {block_num}: {e}")
             save_last_block(start_block)
             whale_txs = [tx for tx in whale_txs if tx['value'] >= min_value_bnb]
             whale_txs = whale_txs[-1000:]
             save_whale_history(whale_txs)
-            logging.info("Block scan completed and history updated.")
+            _logger.info("Block scan completed and history updated.")
         except Exception as e:
-            logging.error(f"Error during block scan: {e}")
+            _logger.error(f"Error during block scan: {e}")
         time.sleep(interval_sec)
 
 if "_bnb_whale_bg_thread" not in globals():
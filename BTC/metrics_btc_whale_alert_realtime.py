@@ -8,13 +8,19 @@ import time
 import json
 import os
 import html
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from cloud_db import db
+from scanner_log import get_scanner_logger
 
 LOG_FILE = "btc_whale_scanner.log"
+_logger = get_scanner_logger("btc", LOG_FILE)
 
 USER_SEEN_BLOCK_FILE = "btc_whale_user_seen_block.json"
 HISTORY_FILE = "btc_whale_alert_history.json"
 BLOCK_FILE = "btc_whale_last_block.json"
+FETCH_WORKERS = 4  # số block tải song song
+COMMIT_EVERY = 10  # ghi history + checkpoint sau mỗi N block liên tiếp đã xử lý
 
 # --- User seen block logic ---
 def mark_btc_whale_alert_seen():
@@ -41,9 +47,17 @@ def fetch_latest_block_number():
     data = r.json()
     return data.get("height")
 
+_http = threading.local()
+
+def _session():
+    # Mỗi thread một Session (giữ kết nối keep-alive tới blockchain.info)
+    if not hasattr(_http, "session"):
+        _http.session = requests.Session()
+    return _http.session
+
 def fetch_block_transactions(block_number):
     url = f"https://blockchain.info/block-height/{block_number}?format=json"
-    r = requests.get(url, timeout=10)
+    r = _session().get(url, timeout=30)
     data = r.json()
     blocks = data.get("blocks", [])
     if not blocks:
@@ -91,8 +105,8 @@ def load_whale_history():
 
     if db.available():
         # Lấy dữ liệu từ database
-        db_history = db.find_all("btc_whale_history", sort_field="time", ascending=True)
-        db_hashes = {d.get("hash") for d in db_history if isinstance(d, dict) and "hash" in d}
+        # Chỉ lấy field hash (stream theo batch), không kéo toàn bộ lịch sử về để so sánh
+        db_hashes = {d.get("hash") for d in db.iter_find("btc_whale_history", projection=["hash"], batch_size=5000) if "hash" in d}
 
         # Gộp dữ liệu từ file local vào database
         new_entries = [entry for entry in local_history if entry.get("hash") not in db_hashes]
@@ -106,30 +120,19 @@ def load_whale_history():
     # Nếu database không khả dụng, trả về dữ liệu từ file local
     return local_history
 
-def save_whale_history(history):
+def save_whale_history(history, new=None):
     # Save to cloud first if available
     if db.available() and isinstance(history, list):
-        # Upsert by unique key 'hash'
-        db.upsert_many("btc_whale_history", history, unique_keys=["hash"])
+        # Upsert by unique key 'hash' (chỉ các tx mới nếu được truyền vào)
+        db.upsert_many("btc_whale_history", history if new is None else new, unique_keys=["hash"])
     # Always keep local backup
     with open(HISTORY_FILE, "w") as f:
         json.dump(history, f)
 
 # --- Helpers & logging ---
 def _log(msg: str):
-    try:
-        line = f"[{datetime.utcnow()}] {msg}"
-        with open(LOG_FILE, "a", encoding="utf-8") as logf:
-            logf.write(line + "\n")
-
-        if db.available():
-            # Gộp log từ file local vào database
-            with open(LOG_FILE, "r", encoding="utf-8") as logf:
-                local_logs = [{"ts": datetime.utcnow().isoformat(), "line": line.strip()} for line in logf]
-            db.insert_many("btc_logs", local_logs)
-            print(f"Gộp {len(local_logs)} log từ file local vào database.")
-    except Exception:
-        pass
+    # File xoay vòng + ring buffer; chỉ record mới được gửi lên btc_logs theo batch (scanner_log)
+    _logger.info(msg)
 
 def _extract_addrs(tx):
     """Safely extract first input and output addresses from a blockchain.info tx object."""
@@ -145,6 +148,64 @@ def _extract_addrs(tx):
         pass
     return from_addr, to_addr
 
+def _is_cex_wallet_fn():
+    try:
+        from BTC.btc_cex_dex_wallets import is_cex_wallet
+        return is_cex_wallet
+    except Exception:
+        return lambda a: False
+
+def _scan_block(block_num, min_value_btc, is_cex_wallet):
+    """Tải một block và trả về các tx lớn (chạy trong worker: JSON vài MB được bỏ ngay sau khi lọc)."""
+    whales = []
+    for tx in fetch_block_transactions(block_num):
+        # blockchain.info tx doesn't include top-level 'value'; sum outputs instead
+        if 'hash' not in tx or 'out' not in tx:
+            continue
+        value_btc = sum(out.get('value', 0) for out in tx.get('out', [])) / 1e8
+        if value_btc < float(min_value_btc):
+            continue
+        from_addr, to_addr = _extract_addrs(tx)
+        tx_type = 'SELL' if is_cex_wallet(to_addr) else ('BUY' if is_cex_wallet(from_addr) else 'N/A')
+        whales.append({
+            "block": block_num,
+            "hash": tx.get('hash', ''),
+            "from": from_addr,
+            "to": to_addr,
+            "value": value_btc,
+            "time": datetime.utcfromtimestamp(tx.get('time', int(time.time()))).strftime("%Y-%m-%d %H:%M:%S"),
+            "type": tx_type
+        })
+    return whales
+
+def _iter_blocks_ordered(block_nums, fn, max_workers=FETCH_WORKERS):
+    """Yield (block_num, result, error) theo đúng thứ tự block_nums, tối đa max_workers block tải song song.
+
+    Chỉ giữ tối đa 2*max_workers block đang chờ, nên bộ nhớ không tăng theo độ dài cửa sổ.
+    """
+    it = iter(block_nums)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="btc-block") as pool:
+        try:
+            for b in it:
+                pending.append((b, pool.submit(fn, b)))
+                if len(pending) >= 2 * max_workers:
+                    break
+            while pending:
+                b, fut = pending.popleft()
+                try:
+                    res, err = fut.result(), None
+                except Exception as e:
+                    res, err = None, e
+                nxt = next(it, None)
+                if nxt is not None:
+                    pending.append((nxt, pool.submit(fn, nxt)))
+                yield b, res, err
+        finally:
+            # Người gọi dừng sớm (lỗi block): hủy các block chưa bắt đầu tải
+            for _, fut in pending:
+                fut.cancel()
+
 def fetch_recent_whales_once(min_value_btc, num_blocks=5):
     """Synchronous fetch of recent blocks to populate large BTC transfers when history is empty."""
     try:
@@ -156,37 +217,17 @@ def fetch_recent_whales_once(min_value_btc, num_blocks=5):
         end = start - max(1, int(num_blocks)) + 1
         seen = {tx.get('hash') for tx in load_whale_history()}
         results = []
-        try:
-            from BTC.btc_cex_dex_wallets import is_cex_wallet
-        except Exception:
-            is_cex_wallet = lambda a: False
-        for b in range(start, end - 1, -1):
-            try:
-                txs = fetch_block_transactions(b)
-            except Exception as e:
-                _log(f"[ONDEMAND] error fetch block {b}: {e}")
+        is_cex_wallet = _is_cex_wallet_fn()
+        blocks = range(start, end - 1, -1)
+        for b, found, err in _iter_blocks_ordered(blocks, lambda n: _scan_block(n, min_value_btc, is_cex_wallet)):
+            if err is not None:
+                _log(f"[ONDEMAND] error fetch block {b}: {err}")
                 continue
-            for tx in txs:
-                if 'hash' not in tx or 'out' not in tx:
-                    continue
-                value_btc = sum(out.get('value', 0) for out in tx.get('out', [])) / 1e8
-                if value_btc < float(min_value_btc):
-                    continue
-                h = tx.get('hash')
-                if h in seen:
+            for tx in found:
+                if tx['hash'] in seen:
                     continue
-                from_addr, to_addr = _extract_addrs(tx)
-                tx_type = 'SELL' if is_cex_wallet(to_addr) else ('BUY' if is_cex_wallet(from_addr) else 'N/A')
-                results.append({
-                    "block": b,
-                    "hash": h,
-                    "from": from_addr,
-                    "to": to_addr,
-                    "value": value_btc,
-                    "time": datetime.utcfromtimestamp(tx.get('time', int(time.time()))).strftime("%Y-%m-%d %H:%M:%S"),
-                    "type": tx_type
-                })
-                seen.add(h)
+                results.append(tx)
+                seen.add(tx['hash'])
         if results:
             hist = load_whale_history()
             by_hash = {t.get('hash'): t for t in hist}
@@ -277,45 +318,38 @@ def background_whale_alert_scanner(min_value_btc=300, num_blocks=5, interval_sec
                 end_block = last_scanned + 1
             whale_txs = load_whale_history()
             seen_hashes = set(tx['hash'] for tx in whale_txs)
-            try:
-                from BTC.btc_cex_dex_wallets import is_cex_wallet
-            except Exception:
-                is_cex_wallet = lambda a: False
-            appended = False
-            _log(f"[BG] scanning blocks {start_block} -> {end_block}")
-            for block_num in range(start_block, end_block - 1, -1):
-                txs = fetch_block_transactions(block_num)
-                for tx in txs:
-                    # blockchain.info tx doesn't include top-level 'value'; sum outputs instead
-                    if 'hash' not in tx or 'out' not in tx:
-                        # Nếu muốn log cảnh báo, dùng logging.warning thay vì print
-                        continue
-                    value_btc = sum(out.get('value', 0) for out in tx.get('out', [])) / 1e8
-                    tx_hash = tx.get('hash', '')
-                    from_addr, to_addr = _extract_addrs(tx)
-                    if is_cex_wallet(to_addr):
-                        tx_type = 'SELL'
-                    elif is_cex_wallet(from_addr):
-                        tx_type = 'BUY'
-                    else:
-                        tx_type = 'N/A'
-                    if value_btc >= min_value_btc and tx_hash not in seen_hashes:
-                        tx_obj = {
-                            "block": block_num,
-                            "hash": tx_hash,
-                            "from": from_addr,
-                            "to": to_addr,
-                            "value": value_btc,
-                            "time": datetime.utcfromtimestamp(tx.get('time', int(time.time()))).strftime("%Y-%m-%d %H:%M:%S"),
-                            "type": tx_type
-                        }
+            is_cex_wallet = _is_cex_wallet_fn()
+            _log(f"[BG] scanning blocks {end_block} -> {start_block}")
+            # Tải song song, commit theo thứ tự block tăng dần: history trước, checkpoint sau
+            new_txs = []
+            done_block = None
+            uncommitted = 0
+
+            def _commit():
+                nonlocal new_txs, uncommitted
+                if new_txs:
+                    save_whale_history(whale_txs, new=new_txs)
+                    new_txs = []
+                if done_block is not None:
+                    save_last_block(done_block)
+                uncommitted = 0
+
+            blocks = range(end_block, start_block + 1)
+            for block_num, found, err in _iter_blocks_ordered(blocks, lambda n: _scan_block(n, min_value_btc, is_cex_wallet)):
+                if err is not None:
+                    # Dừng tại block lỗi: checkpoint không vượt qua nó, lần quét sau thử lại
+                    _log(f"[BG] error fetch block {block_num}: {err}")
+                    break
+                for tx_obj in found:
+                    if tx_obj['hash'] not in seen_hashes:
                         whale_txs.append(tx_obj)
-                        seen_hashes.add(tx_hash)
-                        appended = True
-            save_last_block(start_block)
-            # Chỉ ghi file nếu có giao dịch lớn mới
-            if appended:
-                save_whale_history(whale_txs)
+                        new_txs.append(tx_obj)
+                        seen_hashes.add(tx_obj['hash'])
+                done_block = block_num
+                uncommitted += 1
+                if uncommitted >= COMMIT_EVERY:
+                    _commit()
+            _commit()
         except Exception as e:
             _log(f"[BG] error: {e}")
         time.sleep(interval_sec)
@@ -1,10 +1,10 @@
 
 from db_utils import (
-    db_upsert_portfolio_docs_with_retry,
     db_retry_queue,
     validate_portfolio_docs,
-    save_portfolio_history_optimized,
-    backup_file
+    fetch_recent_portfolio_docs,
+    db_portfolio_as_of,
+    db_portfolio_chart_series,
 )
 
 # New robust initialization system
@@ -18,8 +18,11 @@ from app_init import (
     get_cached_data
 )
 
-from config import COIN_LIST, DATA_FILE, AVG_PRICE_FILE, HISTORY_FILE
-from portfolio_history import load_history, append_snapshot
+from config import COIN_LIST, DATA_FILE, AVG_PRICE_FILE
+from snapshot_writer import submit_snapshot
+from history_retention import start_retention_job
+from history_sync import sync_portfolio_history
+from portfolio_history import load_history, read_chart_series, value_as_of, TOTAL_COIN
 from ui_metrics import show_portfolio_over_time_chart, show_pie_distribution, show_bar_pnl, show_health_panel
 
 import streamlit as st
@@ -83,11 +86,6 @@ def load_portfolio_holdings():
         return {}, {}
 
 # --- DB sync helpers ---
-def _db_upsert_portfolio_docs(docs: list):
-    # Sử dụng hàm helper từ db_utils.py
-    db_upsert_portfolio_docs_with_retry(db, docs)
-    db_retry_queue(db)
-
 def _db_set_portfolio_meta(holdings: dict | None = None, avg_price: dict | None = None):
     try:
         if not db.available():
@@ -113,6 +111,35 @@ def _db_upsert_marketcap_row(row: dict):
     except Exception:
         pass
 
+# Mongo chỉ dùng khi local chưa có lịch sử (máy mới, chưa sync xong); ts làm tròn theo phút để cache trúng giữa các lần rerun
+@st.cache_data(ttl=300, show_spinner=False)
+def _db_history_value_as_of(ts: int, coin: str):
+    doc = db_portfolio_as_of(db, ts, coin) if db.available() else None
+    return float(doc["value"]) if doc and doc.get("value") is not None else None
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _db_history_chart_series(start: int | None, coin: str):
+    if not db.available():
+        return None, pd.DataFrame()
+    return db_portfolio_chart_series(db, start, coin=coin)
+
+def _history_value_as_of(ts: int, coin: str = TOTAL_COIN):
+    # As-of "giá trị gần nhất tại/trước ts": đọc từ HistoryIndex local, chỉ hỏi Mongo khi local không có
+    value = value_as_of(ts, coin)
+    if value is not None:
+        return value
+    return _db_history_value_as_of(ts - ts % 60, coin)
+
+def _history_chart_series(start: int | None = None, coin: str = TOTAL_COIN):
+    # Rollup local (1m/5m/1h/1d); chuỗi bucket hóa trên Mongo chỉ khi local chưa có dữ liệu
+    tier, df = read_chart_series(start, coin=coin)
+    if tier and not df.empty:
+        return tier, df
+    db_tier, db_df = _db_history_chart_series(start - start % 60 if start is not None else None, coin)
+    if db_tier and not db_df.empty:
+        return db_tier, db_df
+    return tier, df
+
 def _db_bootstrap_sync_once():
     """One-time bootstrap from Cloud DB to local files (prefer cloud as source of truth).
 
@@ -139,15 +166,9 @@ def _db_bootstrap_sync_once():
                     pass
         except Exception:
             pass
-        # 2) Portfolio history
+        # 2) Portfolio history: chỉ đồng bộ phần mới hơn high-water mark
         try:
-            hist_docs = db.find_all("portfolio_history", sort_field="timestamp", ascending=True)
-            if hist_docs:
-                try:
-                    with open("portfolio_history.json", "w") as f:
-                        json.dump(hist_docs, f)
-                except Exception:
-                    pass
+            sync_portfolio_history(db)
         except Exception:
             pass
         # (Optional) Dominance & Marketcap history
@@ -302,9 +323,8 @@ def portfolio_recorder_background(interval_sec: int = 300):
 
     - Reads holdings/avg_price from local files (already synced to DB on edits)
     - Fetches prices from CoinGecko
-    - Appends to portfolio_history.json (local) and upserts to MongoDB
+    - Appends to the segmented local history (portfolio_history) and upserts to MongoDB
     """
-    history_file = HISTORY_FILE
     while True:
         try:
             holdings, avg_price_local = _load_portfolio_meta_from_local()
@@ -361,26 +381,8 @@ def portfolio_recorder_background(interval_sec: int = 300):
                 }
                 docs.append(coin_doc)
 
-            # Local file: append if newer than last minute recorded
-            try:
-                existing = []
-                if os.path.exists(history_file):
-                    with open(history_file, "r") as f:
-                        existing = json.load(f)
-                # Avoid duplicate total record for the same minute
-                has_same_minute = any((d.get("timestamp") == minute_ts and "coin" not in d) for d in existing)
-                if not has_same_minute:
-                    existing.extend(docs)
-                    with open(history_file, "w") as f:
-                        json.dump(existing, f)
-            except Exception:
-                pass
-
-            # DB upsert
-            try:
-                _db_upsert_portfolio_docs(docs)
-            except Exception:
-                pass
+            # Local history + DB qua single writer (dedupe theo (phút, coin), group commit)
+            submit_snapshot(docs)
         except Exception:
             pass
         time.sleep(interval_sec)
@@ -395,6 +397,9 @@ if "_portfolio_recorder" not in st.session_state:
         pass
     st.session_state["_portfolio_recorder"] = True
 
+# Retention: giữ phút trong 7 ngày, cũ hơn thì theo giờ/ngày (chạy nền, một lần mỗi process)
+start_retention_job()
+
 
 
 # Hàm lấy giá và % thay đổi từ CoinGecko, cache ngắn để cập nhật thường xuyên
@@ -433,18 +438,11 @@ def get_prices_and_changes(coins):
 
 # Hàm load lịch sử portfolio
 def load_portfolio_history():
-    if os.path.exists(HISTORY_FILE):
-        try:
-            with open(HISTORY_FILE, "r") as f:
-                return json.load(f)
-        except Exception:
-            pass
-    return []
+    return load_history()
 
 # Hàm lưu lịch sử portfolio
 def save_portfolio_history(history):
-    save_portfolio_history_optimized(history, HISTORY_FILE)
-    backup_file(HISTORY_FILE)
+    submit_snapshot(history)
 
 # Hàm load holdings từ file
 def load_holdings():
@@ -565,7 +563,7 @@ with tab1:
             if not db.available():
                 return False
             # Lấy một batch nhỏ mới nhất (descending) để tìm tổng + giá trị từng coin mới nhất
-            docs = db.find_all("portfolio_history", sort_field="timestamp", ascending=False, limit=250)
+            docs = fetch_recent_portfolio_docs(db, limit=250, fields=["timestamp", "coin", "value", "amount"])
             if not docs:
                 return False
             last_total = None
@@ -740,11 +738,7 @@ with tab1:
                     "avg_price": avg_price.get(coin, 0.0)
                 }
                 new_docs.append(coin_entry)
-        append_snapshot(new_docs)
-        try:
-            _db_upsert_portfolio_docs(new_docs)
-        except Exception:
-            pass
+        submit_snapshot(new_docs)
 
 
     # --- Hiển thị tổng giá trị portfolio và thay đổi so với hôm qua ---
@@ -752,19 +746,11 @@ with tab1:
     value_change = "N/A"
     value_yesterday = None
     if history:
-        # Lọc chỉ các entry tổng portfolio (không có key 'coin')
-        df_hist_metric = pd.DataFrame([h for h in history if 'coin' not in h])
-        if not df_hist_metric.empty:
-            # Chỉ chuyển sang GMT+7 khi hiển thị, dữ liệu gốc vẫn giữ UTC
-            df_hist_metric["Date"] = pd.to_datetime(df_hist_metric["timestamp"], unit="s").dt.tz_localize("UTC")
-            now_dt = pd.Timestamp.now(tz=tz_gmt7)
-            df_hist_sorted = df_hist_metric.sort_values("Date")
-            yesterday = now_dt - pd.Timedelta(days=1)
-            df_yesterday = df_hist_sorted[df_hist_sorted["Date"] <= yesterday]
-            if not df_yesterday.empty:
-                value_yesterday = df_yesterday.iloc[-1]["value"]
-                metric_delta = f"{(portfolio_value - value_yesterday) / (value_yesterday + 1e-9) * 100:.2f}%"
-                value_change = portfolio_value - value_yesterday
+        # As-of lookup "giá trị gần nhất cách đây >= 1 ngày" (memmap/index, không dựng DataFrame)
+        value_yesterday = _history_value_as_of(int(time.time()) - 86400, TOTAL_COIN)
+        if value_yesterday is not None:
+            metric_delta = f"{(portfolio_value - value_yesterday) / (value_yesterday + 1e-9) * 100:.2f}%"
+            value_change = portfolio_value - value_yesterday
 
     # Display portfolio metric (never show 0 if holdings exist and we have prior non-zero)
     display_value = portfolio_value
@@ -942,38 +928,29 @@ with tab1:
     st.dataframe(styled_result, hide_index=True)
 
     # --- TÍNH VÀ HIỂN THỊ CHART, METRIC, PIE/BAR CHART ---
-    # Lọc chỉ các entry tổng portfolio (không có key 'coin') cho chart tổng
-    df_hist = pd.DataFrame([h for h in history if 'coin' not in h])
+    # Giá trị tổng mới nhất và hôm qua: 2 lookup as-of (Mongo hoặc local), không tải toàn bộ lịch sử
+    now_dt = pd.Timestamp.now(tz=tz_gmt7)
+    now_ts = int(now_dt.timestamp())
+    value_last = _history_value_as_of(now_ts, TOTAL_COIN)
     metric_delta = ""
     metric_delta_pnl = ""
     metric_delta_profit = ""
-    if not df_hist.empty:
-        # Chỉ chuyển sang GMT+7 khi hiển thị, dữ liệu gốc vẫn giữ UTC
-        df_hist["Date"] = pd.to_datetime(df_hist["timestamp"], unit="s").dt.tz_localize("UTC")
-        # Tính tổng số tiền đầu tư tại mỗi thời điểm (dùng giá mua trung bình hiện tại * số token hiện tại)
+    if value_last is not None:
+        # Tính tổng số tiền đầu tư (dùng giá mua trung bình hiện tại * số token hiện tại)
         total_invested = sum(
             st.session_state["avg_price"].get(c, 0.0) * st.session_state["holdings"].get(c, 0.0)
             for c in coins
         )
-        df_hist["PNL"] = df_hist["value"] - total_invested
-        df_hist["% Profit & Loss"] = np.where(
-            df_hist["value"] > 0,
-            df_hist["PNL"] / (df_hist["value"] + 1e-9) * 100,
-            0.0
-        )
+
+        def _pnl_pct(value):
+            return (value - total_invested) / (value + 1e-9) * 100 if value > 0 else 0.0
+
         # Tìm giá trị hôm qua (gần nhất cách hiện tại >= 1 ngày)
-        now_dt = pd.Timestamp.now(tz=tz_gmt7)
-        df_hist_sorted = df_hist.sort_values("Date")
-        yesterday = now_dt - pd.Timedelta(days=1)
-        df_yesterday = df_hist_sorted[df_hist_sorted["Date"] <= yesterday]
-        if not df_yesterday.empty:
-            value_yesterday = df_yesterday.iloc[-1]["value"]
-            pnl_yesterday = df_yesterday.iloc[-1]["PNL"]
-            profit_yesterday = df_yesterday.iloc[-1]["% Profit & Loss"]
+        value_yesterday = _history_value_as_of(now_ts - 86400, TOTAL_COIN)
+        if value_yesterday is not None:
             metric_delta = f"{(portfolio_value - value_yesterday) / (value_yesterday + 1e-9) * 100:.2f}%"
-            metric_delta_pnl = f"{(df_hist_sorted.iloc[-1]['PNL'] - pnl_yesterday):,.2f} USD"
-            profit_today = df_hist_sorted.iloc[-1]["% Profit & Loss"]
-            metric_delta_profit = f"{(profit_today - profit_yesterday):.2f}%"
+            metric_delta_pnl = f"{(value_last - value_yesterday):,.2f} USD"
+            metric_delta_profit = f"{(_pnl_pct(value_last) - _pnl_pct(value_yesterday)):.2f}%"
         else:
             metric_delta = "N/A"
             metric_delta_pnl = "N/A"
@@ -981,14 +958,14 @@ with tab1:
 
         # Dropdown chọn time range
         range_option = st.selectbox("Chọn khung thời gian", ["30 ngày", "7 ngày", "1 ngày"])
-        if range_option == "30 ngày":
-            df_hist = df_hist[df_hist["Date"] >= now_dt - pd.Timedelta(days=30)]
-        elif range_option == "7 ngày":
-            df_hist = df_hist[df_hist["Date"] >= now_dt - pd.Timedelta(days=7)]
-        elif range_option == "1 ngày":
-            df_hist = df_hist[df_hist["Date"] >= now_dt - pd.Timedelta(days=1)]
-
-        show_portfolio_over_time_chart(history, key="main_line_chart")
+        range_days = {"30 ngày": 30, "7 ngày": 7, "1 ngày": 1}[range_option]
+        range_start = int((now_dt - pd.Timedelta(days=range_days)).timestamp())
+        # Rollup thô nhất vẫn đủ điểm cho khung thời gian đã chọn (1m/5m/1h/1d)
+        chart_tier, df_range = _history_chart_series(range_start, coin=TOTAL_COIN)
+        if chart_tier:
+            st.caption(f"Độ phân giải chart: {chart_tier}")
+
+        show_portfolio_over_time_chart(df_range, key="main_line_chart")
         show_pie_distribution(result_df)
         show_bar_pnl(result_df)
         st.session_state["portfolio_value"] = portfolio_value
@@ -1119,7 +1096,8 @@ with tab1:
         db_status_msg = "DB unavailable – auto retry 30s" + (f" | {last_err}" if last_err else "")
     elif queue_len > 0:
         db_status_msg = (
-            f"Queue: {queue_len} | next retry in {qinfo['next_retry_in']}s | fail x{qinfo['consecutive_failures']}"
+            f"Queue: {queue_len} | oldest {qinfo.get('oldest_age', 0)}s | max attempts {qinfo.get('max_attempts', 0)}"
+            f" | next retry in {qinfo['next_retry_in']}s | fail x{qinfo['consecutive_failures']}"
         )
     show_health_panel(db, queue_len, last_price_ts, last_price_update_message=db_status_msg)
 
@@ -1245,18 +1223,8 @@ with tab2:
             import numpy as np
             import pytz
             tz_gmt7 = pytz.timezone("Asia/Bangkok")
-            # Đọc lịch sử portfolio
-            HISTORY_FILE = "portfolio_history.json"
-            if os.path.exists(HISTORY_FILE):
-                try:
-                    with open(HISTORY_FILE, "r") as f:
-                        history = json.load(f)
-                except Exception:
-                    history = []
-            else:
-                history = []
-            # Lọc lịch sử cho coin này
-            df_hist = pd.DataFrame([h for h in history if h.get("coin") == coin[0]])
+            # Đọc rollup lịch sử portfolio của coin này (tier tự chọn theo độ dài lịch sử)
+            _, df_hist = _history_chart_series(coin=coin[0])
             if not df_hist.empty:
                 df_hist["Date"] = pd.to_datetime(df_hist["timestamp"], unit="s").dt.tz_localize("UTC").dt.tz_convert(tz_gmt7)
                 df_hist = df_hist.sort_values("Date")
@@ -1451,6 +1419,14 @@ with tab2:
                 metrics_btc_whale_alert_realtime.show_btc_whale_alert_realtime()
             if coin[1] == "SOL" and metrics_sol_whale_alert_realtime:
                 metrics_sol_whale_alert_realtime.show_sol_whale_alert_realtime()
+                # Token trên Solana không có tab coin riêng (USDC): hiển thị cùng tab SOL
+                tab_symbols = {c[1] for c in COIN_LIST}
+                for token_feed in metrics_sol_whale_alert_realtime.SOL_TOKEN_FEEDS:
+                    if token_feed["name"] not in tab_symbols:
+                        metrics_sol_whale_alert_realtime.show_sol_whale_alert_realtime(feed=token_feed["name"])
+            # USDT trên Solana: feed token lấy từ cùng lượt quét block của scanner SOL
+            if coin[1] == "USDT" and metrics_sol_whale_alert_realtime:
+                metrics_sol_whale_alert_realtime.show_sol_whale_alert_realtime(feed="USDT")
             # Whale Alert cho LINK: overlay markers, slider, box (thực hiện TRƯỚC khi vẽ chart)
             if coin[1] == "LINK" and fig_ohlcv and not df_ohlcv.empty:
                 from overlay_whale_alert import overlay_whale_alert_chart
@@ -1503,21 +1479,11 @@ if st_autorefresh:
 
 # Hàm load lịch sử portfolio
 def load_portfolio_history():
-    if os.path.exists(HISTORY_FILE):
-        try:
-            with open(HISTORY_FILE, "r") as f:
-                return json.load(f)
-        except Exception:
-            pass
-    return []
+    return load_history()
 
 # Hàm lưu lịch sử portfolio
 def save_portfolio_history(history):
-    try:
-        with open(HISTORY_FILE, "w") as f:
-            json.dump(history, f)
-    except Exception as e:
-        st.warning(f"Không thể lưu lịch sử portfolio: {e}")
+    submit_snapshot(history)
 
 # Hàm load holdings từ file
 def load_holdings():
@@ -1605,8 +1571,7 @@ def save_holdings(holdings):
     if len(history) == 0 or now // 60 > history[-1]["timestamp"] // 60:
         # Nếu đã có PNL trong dict thì giữ, nếu chưa thì thêm
         entry = {"timestamp": now, "value": portfolio_value, "PNL": current_pnl}
-        history.append(entry)
-        save_portfolio_history(history)
+        save_portfolio_history([entry])
 
     # Chuẩn bị dataframe cho bảng
     data = []
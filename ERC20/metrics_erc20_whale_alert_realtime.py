@@ -8,6 +8,7 @@ import time
 import json
 import os
 from cloud_db import db
+from scanner_log import get_scanner_logger
 
 # ERC20 token configs
 LINK_CONTRACT = "0x514910771af9ca656af840dff83e8264ecf986ca"  # Chainlink ERC20
@@ -151,8 +152,7 @@ def save_token_whale_history(token, history):
         with open(token["history_file"], "w") as f:
             json.dump(list(combined_history.values()), f, ensure_ascii=False, indent=2)
     except Exception as e:
-        with open("eth_whale_scanner.log", "a", encoding="utf-8") as logf:
-            logf.write(f"[{datetime.utcnow()}] Error saving whale history for {token['name']}: {str(e)}\n")
+        get_scanner_logger(token["name"]).error(f"Error saving whale history for {token['name']}: {str(e)}")
 
 def save_token_last_block(token, block_num):
     with open(token["block_file"], "w") as f:
@@ -279,8 +279,8 @@ def load_whale_history(token):
 
     if db.available():
         # Lấy dữ liệu từ database
-        db_history = db.find_all(f"{token['name'].lower()}_whale_history", sort_field="time", ascending=True)
-        db_hashes = {d.get("hash") for d in db_history if isinstance(d, dict) and "hash" in d}
+        # Chỉ lấy field hash (stream theo batch), không kéo toàn bộ lịch sử về để so sánh
+        db_hashes = {d.get("hash") for d in db.iter_find(f"{token['name'].lower()}_whale_history", projection=["hash"], batch_size=5000) if "hash" in d}
 
         # Gộp dữ liệu từ file local vào database
         new_entries = [entry for entry in local_history if entry.get("hash") not in db_hashes]
@@ -319,17 +319,5 @@ def load_last_block(token):
     return local_last_block
 
 def _log(token, msg: str):
-    try:
-        line = f"[{datetime.utcnow()}] {msg}"
-        log_file = f"{token['name'].lower()}_whale_scanner.log"
-        with open(log_file, "a", encoding="utf-8") as logf:
-            logf.write(line + "\n")
-
-        if db.available():
-            # Gộp log từ file local vào database
-            with open(log_file, "r", encoding="utf-8") as logf:
-                local_logs = [{"ts": datetime.utcnow().isoformat(), "line": line.strip()} for line in logf]
-            db.insert_many(f"{token['name'].lower()}_logs", local_logs)
-            print(f"Gộp {len(local_logs)} log từ file local vào database.")
-    except Exception:
-        pass
+    # Mỗi token một logger (<token>_whale_scanner.log, <token>_logs); chỉ record mới được gửi lên DB
+    get_scanner_logger(token["name"]).info(msg)
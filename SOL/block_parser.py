@@ -0,0 +1,372 @@
+"""
+Single-pass extraction of SOL and SPL token transfers from Solana `getBlock` responses.
+
+A `getBlock` response with full transaction details is several MB, and most
+of its transactions are validator votes, which can never contain a SOL
+transfer. `decode_blocks` replaces `json.loads` for those responses and avoids
+building them as Python objects:
+  - NumPy locates the brackets outside JSON strings in the raw bytes, and from
+    them the byte span of every element of each `"transactions"` array,
+  - only the transactions whose raw text contains the System Program id or one
+    of the tracked token mints are kept (as bytes). A transaction without them
+    in its text cannot have them in its `accountKeys` or token balances. The
+    others are counted and dropped undecoded,
+  - the rest of the response is decoded with the transaction arrays emptied.
+If the structure does not check out, it falls back to a plain `json.loads`.
+
+`extract_transfers` decodes the kept transactions in the parse stage and walks
+each of them once, for every asset:
+  - native SOL: System Program transfer instructions. The lamport deltas
+    (`preBalances - postBalances`) of the whole block come from one NumPy
+    subtraction,
+  - SPL Token / Token-2022 (programs named in Solana-programs.json): for each
+    tracked mint, the `preTokenBalances`/`postTokenBalances` change of every
+    owner. The largest sender and the largest receiver form the transfer.
+So one fetched block feeds the SOL feed and every token feed (USDC, USDT, ...).
+
+`full_walk_transfers` is the previous path (decode everything, walk every
+instruction and every token balance), kept as the reference. `audit_block` times both paths on the
+same raw bytes and checks they agree. `parse_stats` accumulates counts and
+timings, so the scanner can report the parse time saved per block.
+"""
+from __future__ import annotations
+
+import json
+import os
+import re
+import threading
+import time
+from functools import lru_cache
+from itertools import chain
+from typing import Any, Dict, FrozenSet, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+SYSTEM_PROGRAM = "11111111111111111111111111111111"
+LAMPORTS_PER_SOL = 1e9
+PROGRAMS_FILE = os.path.join(os.path.dirname(__file__), "Solana-programs.json")
+TOKEN_PROGRAM_NAMES = ("Token Program", "Token 2022 Program")
+_DEFAULT_TOKEN_PROGRAMS = frozenset({
+    "TokenkegQfeZyiNwAJbNbGKPFXCWuBvf9Ss623VQ5DA",
+    "TokenzQdBNbLqP5VEhdkAS6EPFLC1PHnBqCXEpPxuEb",
+})
+
+_TX_ARRAY_KEY = re.compile(rb'"transactions"\s*:\s*\[')
+# Loại byte cho _brackets: 0 = thường
+_OPEN, _CLOSE, _QUOTE, _BACKSLASH = 1, 2, 3, 4
+_KINDS = np.zeros(256, dtype=np.uint8)
+_KINDS[[ord("{"), ord("[")]] = _OPEN
+_KINDS[[ord("}"), ord("]")]] = _CLOSE
+_KINDS[ord('"')] = _QUOTE
+_KINDS[ord("\\")] = _BACKSLASH
+_SPECIAL = (_KINDS > 0).astype(np.uint8).tobytes()  # bảng translate -> 0/1, đọc lại như mảng bool
+
+# (signature, from, to, amount SOL)
+Transfer = Tuple[str, str, str, float]
+# (signature, mint, from owner, to owner, amount in token units)
+TokenTransfer = Tuple[str, str, str, str, float]
+
+_stats_lock = threading.Lock()
+parse_stats: Dict[str, float] = {
+    "blocks": 0, "txs": 0, "skipped": 0, "split_ms": 0.0, "parse_ms": 0.0,
+    "audits": 0, "audit_fast_ms": 0.0, "audit_full_ms": 0.0, "mismatches": 0,
+}
+
+
+def _count(**kw: float) -> None:
+    with _stats_lock:
+        for k, v in kw.items():
+            parse_stats[k] += v
+
+
+# ---------- program map ----------
+@lru_cache(maxsize=1)
+def program_map() -> Dict[str, Dict[str, str]]:
+    """Solana-programs.json: {"program": {addr: name}, "trust_token": {mint: symbol}, ...}."""
+    try:
+        with open(PROGRAMS_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        data = {}
+    return data if isinstance(data, dict) else {}
+
+
+def token_programs() -> FrozenSet[str]:
+    found = {addr for addr, name in (program_map().get("program") or {}).items() if name in TOKEN_PROGRAM_NAMES}
+    return frozenset(found) or _DEFAULT_TOKEN_PROGRAMS
+
+
+def mint_of(symbol: str) -> Optional[str]:
+    for mint, name in (program_map().get("trust_token") or {}).items():
+        if name == symbol:
+            return mint
+    return None
+
+
+def _needles(mints: Iterable[str]) -> Tuple[bytes, ...]:
+    return tuple(b'"' + m.encode() + b'"' for m in (SYSTEM_PROGRAM, *mints))
+
+
+# ---------- raw-bytes split ----------
+def _brackets(raw: bytes) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """(positions, kinds, depth after each) of the brackets outside JSON strings."""
+    # Một lượt translate (C) phân loại mọi byte; NumPy chỉ làm việc trên các vị trí đặc biệt
+    pos = np.flatnonzero(np.frombuffer(raw.translate(_SPECIAL), dtype=bool))
+    kind = _KINDS[np.frombuffer(raw, dtype=np.uint8)[pos]]
+    quote = kind == _QUOTE
+    # Dấu " ngay sau dấu \\ bị escape nếu chuỗi \\ liền trước có độ dài lẻ
+    after_bs = np.zeros(len(pos), dtype=bool)
+    after_bs[1:] = (kind[:-1] == _BACKSLASH) & (pos[1:] - pos[:-1] == 1)
+    for k in np.flatnonzero(quote & after_bs).tolist():
+        p, run = int(pos[k]) - 1, 0
+        while p >= 0 and raw[p] == 0x5C:
+            run += 1
+            p -= 1
+        quote[k] = run % 2 == 0
+    outside = np.cumsum(quote, dtype=np.int32) % 2 == 0
+    keep = outside & (kind <= _CLOSE)
+    bpos, bkind = pos[keep], kind[keep]
+    depth = np.cumsum(np.where(bkind == _OPEN, 1, -1), dtype=np.int32)
+    return bpos, bkind, depth
+
+
+def _split(raw: bytes, needles: Sequence[bytes]) -> Tuple[Any, List[Tuple[int, List[bytes], Tuple[int, int]]]]:
+    """Decode `raw` with every transactions array emptied.
+
+    Returns (skeleton, groups), one group per array in document order:
+    (tx count, raw bytes of the txs containing one of `needles`, array byte span).
+    """
+    bpos, bkind, depth = _brackets(raw)
+    groups = []
+    pieces = []
+    last = 0
+    for m in _TX_ARRAY_KEY.finditer(raw):
+        s = m.end() - 1
+        k = int(np.searchsorted(bpos, s))
+        if k >= len(bpos) or bpos[k] != s:
+            continue  # nằm trong một chuỗi
+        d = depth[k]
+        close = np.flatnonzero(depth[k + 1:] == d - 1)
+        if not len(close):
+            raise ValueError("unterminated transactions array")
+        e_k = k + 1 + int(close[0])
+        seg_pos, seg_kind, seg_depth = bpos[k + 1:e_k], bkind[k + 1:e_k], depth[k + 1:e_k]
+        # Phần tử của mảng: mở ở độ sâu d+1, đóng về d (mảng transactions chỉ chứa object)
+        starts = seg_pos[(seg_kind == _OPEN) & (seg_depth == d + 1)].tolist()
+        ends = seg_pos[(seg_kind == _CLOSE) & (seg_depth == d)].tolist()
+        if len(starts) != len(ends):
+            raise ValueError("unbalanced transactions array")
+        kept = [raw[a:b + 1] for a, b in zip(starts, ends)
+                if any(raw.find(n, a, b + 1) != -1 for n in needles)]
+        e = int(bpos[e_k])
+        groups.append((len(starts), kept, (s, e + 1)))
+        pieces.append(raw[last:s + 1])
+        last = e
+    pieces.append(raw[last:])
+    return json.loads(b"".join(pieces)), groups
+
+
+def _blocks_of(data: Any) -> Iterator[Dict]:
+    items = data if isinstance(data, list) else [data]
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        blk = item.get("result") if "result" in item else item
+        if isinstance(blk, dict) and "transactions" in blk:
+            yield blk
+
+
+def decode_blocks(raw: bytes, mints: Sequence[str] = ()) -> Any:
+    """`json.loads` for getBlock responses (single or batch) that leaves irrelevant txs undecoded.
+
+    Kept: txs mentioning the System Program or one of `mints`.
+    Each block gets `_raw_txs` (kept tx bytes), `_tx_count` and `_tx_array` (raw
+    bytes of its whole transactions array, for audits).
+    """
+    t0 = time.perf_counter()
+    try:
+        data, groups = _split(raw, _needles(mints))
+        blocks = list(_blocks_of(data))
+        if len(blocks) != len(groups):
+            raise ValueError("transactions arrays do not match the blocks")
+        view = memoryview(raw)
+        for blk, (n, kept, (s, e)) in zip(blocks, groups):
+            blk["_tx_count"] = n
+            blk["_raw_txs"] = kept
+            blk["_tx_array"] = view[s:e]
+    except ValueError:
+        data = json.loads(raw)
+    _count(split_ms=(time.perf_counter() - t0) * 1000)
+    return data
+
+
+def tx_count(block: Dict) -> int:
+    return block.get("_tx_count", len(block.get("transactions") or []))
+
+
+# ---------- extraction ----------
+def _tx_parts(tx: Dict):
+    t = tx.get("transaction") or {}
+    msg = t.get("message") or {}
+    return (t.get("signatures") or [""])[0], msg, tx.get("meta") or {}
+
+
+def _token_moves(sig: str, keys: List[str], meta: Dict, mints: FrozenSet[str],
+                 programs: FrozenSet[str]) -> List[TokenTransfer]:
+    """Largest sender -> largest receiver of each tracked mint, from the token balance changes."""
+    changes: Dict[Tuple[str, str], List[int]] = {}
+    for sign, balances in ((-1, meta.get("preTokenBalances")), (1, meta.get("postTokenBalances"))):
+        for b in balances or []:
+            mint = b.get("mint")
+            if mint not in mints:
+                continue
+            program = b.get("programId")
+            if program is not None and program not in programs:
+                continue
+            idx = b.get("accountIndex")
+            owner = b.get("owner") or (keys[idx] if isinstance(idx, int) and idx < len(keys) else str(idx))
+            ui = b.get("uiTokenAmount") or {}
+            cur = changes.setdefault((mint, owner), [0, int(ui.get("decimals") or 0)])
+            cur[0] += sign * int(ui.get("amount") or 0)
+    if not changes:
+        return []
+    out: List[TokenTransfer] = []
+    for mint in sorted({m for m, _ in changes}):
+        moves = [(owner, d, dec) for (m, owner), (d, dec) in changes.items() if m == mint and d]
+        sent = [mv for mv in moves if mv[1] < 0]
+        received = [mv for mv in moves if mv[1] > 0]
+        if not sent or not received:
+            continue  # mint/burn, không có bên gửi hoặc bên nhận
+        src = min(sent, key=lambda mv: mv[1])
+        dst = max(received, key=lambda mv: mv[1])
+        amount = min(dst[1], -sum(mv[1] for mv in sent))
+        out.append((sig, mint, src[0], dst[0], amount / 10 ** dst[2]))
+    return out
+
+
+def extract_transfers(block: Dict, mints: Iterable[str] = ()) -> Tuple[List[Transfer], List[TokenTransfer], int]:
+    """(SOL transfers, token transfers of `mints`, skipped tx count) in one walk over the block."""
+    mints = frozenset(mints)
+    programs = token_programs()
+    if "_raw_txs" in block:
+        txs = [json.loads(t) for t in block["_raw_txs"]]
+        skipped = block["_tx_count"] - len(txs)
+    else:
+        txs = block.get("transactions") or []
+        skipped = 0
+    cands = []
+    tokens: List[TokenTransfer] = []
+    for tx in txs:
+        sig, msg, meta = _tx_parts(tx)
+        keys = msg.get("accountKeys") or []
+        relevant = False
+        if mints and (meta.get("preTokenBalances") or meta.get("postTokenBalances")):
+            moves = _token_moves(sig, keys, meta, mints, programs)
+            tokens.extend(moves)
+            relevant = bool(moves)
+        if SYSTEM_PROGRAM not in keys:
+            skipped += 0 if relevant else 1
+            continue
+        sys_idx = keys.index(SYSTEM_PROGRAM)
+        ixs = [ix for ix in msg.get("instructions") or [] if ix.get("programIdIndex") == sys_idx]
+        if not ixs:
+            continue
+        pre = meta.get("preBalances") or []
+        post = meta.get("postBalances") or []
+        cands.append((sig, keys, ixs, pre, post, min(len(pre), len(post))))
+    if not cands:
+        return [], tokens, skipped
+
+    # Delta lamport của cả block trong một phép trừ NumPy
+    sizes = [c[5] for c in cands]
+    total = sum(sizes)
+    pre_all = np.fromiter(chain.from_iterable(c[3][:c[5]] for c in cands), dtype=np.int64, count=total)
+    post_all = np.fromiter(chain.from_iterable(c[4][:c[5]] for c in cands), dtype=np.int64, count=total)
+    deltas = ((pre_all - post_all) / LAMPORTS_PER_SOL).tolist()
+    offsets = np.concatenate(([0], np.cumsum(sizes)[:-1])).tolist()
+
+    out: List[Transfer] = []
+    for (sig, keys, ixs, pre, post, n), off in zip(cands, offsets):
+        for ix in ixs:
+            accounts = ix.get("accounts") or []
+            if len(accounts) < 2:
+                continue
+            from_idx, to_idx = accounts[0], accounts[1]
+            if not (isinstance(from_idx, int) and isinstance(to_idx, int)
+                    and from_idx < len(keys) and to_idx < len(keys)
+                    and from_idx < n and to_idx < n):
+                continue
+            if keys[from_idx] == keys[to_idx]:
+                continue
+            out.append((sig, keys[from_idx], keys[to_idx], deltas[off + from_idx]))
+    return out, tokens, skipped
+
+
+def full_walk_transfers(block: Dict, mints: Iterable[str] = ()) -> Tuple[List[Transfer], List[TokenTransfer]]:
+    """Reference path: walk every instruction and token balance of every (decoded) transaction."""
+    mints = frozenset(mints)
+    programs = token_programs()
+    out: List[Transfer] = []
+    tokens: List[TokenTransfer] = []
+    for tx in block.get("transactions") or []:
+        sig, msg, meta = _tx_parts(tx)
+        keys = msg.get("accountKeys") or []
+        if mints:
+            tokens.extend(_token_moves(sig, keys, meta, mints, programs))
+        pre = meta.get("preBalances") or []
+        post = meta.get("postBalances") or []
+        for ix in msg.get("instructions") or []:
+            prog_idx = ix.get("programIdIndex")
+            if prog_idx is None or prog_idx >= len(keys) or keys[prog_idx] != SYSTEM_PROGRAM:
+                continue
+            accounts = ix.get("accounts") or []
+            if len(accounts) < 2:
+                continue
+            from_idx, to_idx = accounts[0], accounts[1]
+            if not (isinstance(from_idx, int) and isinstance(to_idx, int)
+                    and from_idx < len(keys) and to_idx < len(keys)
+                    and from_idx < len(pre) and to_idx < len(post)):
+                continue
+            if keys[from_idx] == keys[to_idx]:
+                continue
+            out.append((sig, keys[from_idx], keys[to_idx], (pre[from_idx] - post[from_idx]) / LAMPORTS_PER_SOL))
+    return out, tokens
+
+
+# ---------- measurement ----------
+def record_parse(num_txs: int, skipped: int, parse_ms: float) -> None:
+    _count(blocks=1, txs=num_txs, skipped=skipped, parse_ms=parse_ms)
+
+
+def audit_block(block: Dict, mints: Sequence[str] = ()) -> Tuple[float, float, bool]:
+    """Time both paths from the block's raw transactions bytes: (fast_ms, full_ms, same result)."""
+    if "_tx_array" not in block:
+        return 0.0, 0.0, True
+    raw = b'{"transactions":' + bytes(block["_tx_array"]) + b"}"
+    t0 = time.perf_counter()
+    _, groups = _split(raw, _needles(mints))
+    n, kept, _ = groups[0]
+    fast = extract_transfers({"_raw_txs": kept, "_tx_count": n}, mints)[:2]
+    t1 = time.perf_counter()
+    full = full_walk_transfers(json.loads(raw), mints)
+    t2 = time.perf_counter()
+    fast_ms, full_ms = (t1 - t0) * 1000, (t2 - t1) * 1000
+    same = fast == full
+    _count(audits=1, audit_fast_ms=fast_ms, audit_full_ms=full_ms, mismatches=0 if same else 1)
+    return fast_ms, full_ms, same
+
+
+def estimated_saved_ms(fast_ms: float) -> float:
+    """Time the full decode + walk would have added to a fast parse of `fast_ms` (from audited blocks)."""
+    with _stats_lock:
+        fast, full = parse_stats["audit_fast_ms"], parse_stats["audit_full_ms"]
+    if fast <= 0:
+        return 0.0
+    return max(0.0, fast_ms * (full / fast - 1))
+
+
+__all__ = [
+    "SYSTEM_PROGRAM", "program_map", "token_programs", "mint_of", "decode_blocks", "tx_count",
+    "extract_transfers", "full_walk_transfers", "audit_block", "record_parse", "estimated_saved_ms",
+    "parse_stats",
+]
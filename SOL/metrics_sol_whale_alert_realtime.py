@@ -7,12 +7,39 @@ from datetime import datetime
 import time
 import json
 import os
+from functools import partial
 from .sol_cex_wallets import ALL_EXCHANGE_WALLETS, is_internal_exchange_transfer, is_exchange_wallet, is_org_wallet
 from cloud_db import db
+from .rpc_pipeline import BlockPipeline
+from . import block_parser
+from config import SOL_PARSE_AUDIT_EVERY
 
 USER_SEEN_BLOCK_FILE = "sol_whale_user_seen_block.json"
 HISTORY_FILE = "sol_whale_alert_history.json"
 BLOCK_FILE = "sol_whale_last_block.json"
+COMMIT_EVERY = 50  # ghi history + checkpoint sau mỗi N slot liên tiếp đã xử lý
+
+# Feed SPL token lấy từ cùng lượt quét block với SOL (mint theo trust_token trong Solana-programs.json)
+SOL_TOKEN_FEEDS = [
+    {
+        "name": "USDC",
+        "mint": block_parser.mint_of("USDC"),
+        "history_file": "sol_usdc_whale_alert_history.json",
+        "collection": "sol_usdc_whale_history",
+        "min_value": 1_000_000,
+    },
+    {
+        "name": "USDT",
+        "mint": block_parser.mint_of("USDT"),
+        "history_file": "sol_usdt_whale_alert_history.json",
+        "collection": "sol_usdt_whale_history",
+        "min_value": 1_000_000,
+    },
+    # Thêm token SPL khác ở đây
+]
+SOL_TOKEN_FEEDS = [f for f in SOL_TOKEN_FEEDS if f["mint"]]
+_FEEDS = {"SOL": {"name": "SOL", "history_file": HISTORY_FILE, "collection": "sol_whale_history"}}
+_FEEDS.update({f["name"]: f for f in SOL_TOKEN_FEEDS})
 
 # --- User seen block logic ---
 def mark_sol_whale_alert_seen():
@@ -128,12 +155,14 @@ def load_last_block():
     # Nếu database không khả dụng, trả về giá trị từ file local
     return local_last_block
 
-def load_whale_history():
+def load_whale_history(feed="SOL"):
     # Prefer cloud DB if available
+    history_file = _FEEDS[feed]["history_file"]
+    collection = _FEEDS[feed]["collection"]
     local_history = []
-    if os.path.exists(HISTORY_FILE):
+    if os.path.exists(history_file):
         try:
-            with open(HISTORY_FILE, "r") as f:
+            with open(history_file, "r") as f:
                 raw = f.read().strip()
                 if raw:
                     local_history = json.loads(raw)
@@ -142,17 +171,17 @@ def load_whale_history():
 
     if db.available():
         # Lấy dữ liệu từ database
-        db_history = db.find_all("sol_whale_history", sort_field="time", ascending=True)
-        db_hashes = {d.get("hash") for d in db_history if isinstance(d, dict) and "hash" in d}
+        # Chỉ lấy field hash (stream theo batch), không kéo toàn bộ lịch sử về để so sánh
+        db_hashes = {d.get("hash") for d in db.iter_find(collection, projection=["hash"], batch_size=5000) if "hash" in d}
 
         # Gộp dữ liệu từ file local vào database
         new_entries = [entry for entry in local_history if entry.get("hash") not in db_hashes]
         if new_entries:
-            db.upsert_many("sol_whale_history", new_entries, unique_keys=["hash"])
+            db.upsert_many(collection, new_entries, unique_keys=["hash"])
             print(f"Gộp {len(new_entries)} giao dịch từ file local vào database.")
 
         # Trả về dữ liệu đã gộp
-        return db.find_all("sol_whale_history", sort_field="time", ascending=True)
+        return db.find_all(collection, sort_field="time", ascending=True)
 
     # Nếu database không khả dụng, trả về dữ liệu từ file local
     return local_history
@@ -161,17 +190,18 @@ def save_last_block(block_num):
     with open(BLOCK_FILE, "w") as f:
         json.dump({"last_block": block_num}, f)
 
-def save_whale_history(history):
-    with open(HISTORY_FILE, "w") as f:
+def save_whale_history(history, feed="SOL"):
+    with open(_FEEDS[feed]["history_file"], "w") as f:
         json.dump(history, f)
 
-def show_sol_whale_alert_realtime(min_value_sol=3000, num_blocks=750):
-    st.markdown("""
+def show_sol_whale_alert_realtime(min_value_sol=3000, num_blocks=750, feed="SOL"):
+    title = "SOL Large Transactions" if feed == "SOL" else f"{feed} (Solana) Large Transfers"
+    st.markdown(f"""
 <div style='font-size:22px;font-weight:bold;margin-bottom:8px;'>
-    🐳 Whale Alert - SOL Large Transactions
+    🐳 Whale Alert - {title}
 </div>
 """, unsafe_allow_html=True)
-    whale_txs = load_whale_history()
+    whale_txs = load_whale_history(feed)
     last_block = load_last_block()
     # Tự động cập nhật seen_block = last_block mỗi lần load dashboard
     if last_block is not None:
@@ -195,19 +225,74 @@ def show_sol_whale_alert_realtime(min_value_sol=3000, num_blocks=750):
                 type_badge = "<span style='color:#fff;background:#43a047;padding:2px 6px;border-radius:4px;font-size:11px;margin-right:4px;vertical-align:middle;'>BUY</span>"
             else:
                 type_badge = "<span style='color:#fff;background:#888;padding:2px 6px;border-radius:4px;font-size:11px;margin-right:4px;vertical-align:middle;'>N/A</span>"
-            box_content += f"<div style='margin-bottom:8px;'>{new_badge}{type_badge}<span style='color:#1e88e5;font-weight:bold;'>🐳 {tx['value']:.2f} SOL</span> | Hash: <code>{tx['hash'][:12]}...</code> | Từ: <code>{tx['from']}</code> → Đến: <code>{tx['to']}</code> | <span style='color:#888;'>{tx['time']}</span></div>"
+            box_content += f"<div style='margin-bottom:8px;'>{new_badge}{type_badge}<span style='color:#1e88e5;font-weight:bold;'>🐳 {tx['value']:,.2f} {feed}</span> | Hash: <code>{tx['hash'][:12]}...</code> | Từ: <code>{tx['from']}</code> → Đến: <code>{tx['to']}</code> | <span style='color:#888;'>{tx['time']}</span></div>"
     st.markdown(f"<div style='height: 260px; overflow-y: auto; border: 1px solid #ccc; border-radius: 8px; padding: 8px; background: #f9f9f9; margin-top: 16px;'>{box_content}</div>", unsafe_allow_html=True)
 
-def background_whale_alert_scanner(min_value_sol=3000, num_blocks=750, interval_sec=300):
-    # Load danh sách protocol address từ Solana-programs.json
-    protocol_addr_to_name = {}
-    try:
-        with open(os.path.join(os.path.dirname(__file__), "Solana-programs.json"), "r", encoding="utf-8") as f:
-            protocol_json = json.load(f)
-            protocol_addr_to_name = protocol_json.get("program", {})
-    except Exception:
-        protocol_addr_to_name = {}
+def _whale_obj(block_num, tx_hash, from_addr, to_addr, amount, tx_time):
+    from_label = "exchange" if is_exchange_wallet(from_addr) else "org" if is_org_wallet(from_addr) else None
+    to_label = "exchange" if is_exchange_wallet(to_addr) else "org" if is_org_wallet(to_addr) else None
+    if from_label == "exchange" and to_label != "exchange":
+        tx_type = "SELL"
+    elif to_label == "exchange" and from_label != "exchange":
+        tx_type = "BUY"
+    else:
+        tx_type = "N/A"
+    return {
+        "block": block_num,
+        "hash": tx_hash,
+        "from": from_addr,
+        "to": to_addr,
+        "from_label": from_label,
+        "to_label": to_label,
+        "value": amount,
+        "type": tx_type,
+        "time": tx_time,
+    }
+
+def _parse_block(block_num, block, min_value_sol):
+    """Whale của mọi feed (SOL + token SPL) trong một lượt duyệt block (chạy trong pool parse của BlockPipeline)."""
+    t0 = time.perf_counter()
+    mints = {f["mint"]: f for f in SOL_TOKEN_FEEDS}
+    transfers, token_transfers, skipped = block_parser.extract_transfers(block, mints)
+    whales = {name: [] for name in _FEEDS}
+    total_sol_transferred = 0
+    block_time = block.get('blockTime', None)
+    tx_time = datetime.utcfromtimestamp(block_time).strftime("%Y-%m-%d %H:%M:%S") if block_time else datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    for tx_hash, from_addr, to_addr, amount in transfers:
+        if is_internal_exchange_transfer(from_addr, to_addr):
+            continue
+        if amount > 0:
+            total_sol_transferred += amount
+        if amount < min_value_sol:
+            continue
+        whales["SOL"].append(_whale_obj(block_num, tx_hash, from_addr, to_addr, amount, tx_time))
+    for tx_hash, mint, from_addr, to_addr, amount in token_transfers:
+        feed = mints[mint]
+        if amount < feed["min_value"] or is_internal_exchange_transfer(from_addr, to_addr):
+            continue
+        tx_obj = _whale_obj(block_num, tx_hash, from_addr, to_addr, amount, tx_time)
+        tx_obj["token"] = feed["name"]
+        whales[feed["name"]].append(tx_obj)
+    parse_ms = (time.perf_counter() - t0) * 1000
+    num_txs = block_parser.tx_count(block)
+    block_parser.record_parse(num_txs, skipped, parse_ms)
+    if SOL_PARSE_AUDIT_EVERY and block_num % SOL_PARSE_AUDIT_EVERY == 0:
+        # Đo lại đường đi cũ (duyệt mọi instruction) trên cùng block để biết thời gian tiết kiệm
+        _, full_ms, same = block_parser.audit_block(block, list(mints))
+        if not same:
+            _log_error(f"[block {block_num}] {datetime.utcnow()} | fast path lệch với full walk\n")
+    return {"whales": whales, "num_txs": num_txs, "skipped": skipped, "total_sol": total_sol_transferred,
+            "parse_ms": parse_ms, "saved_ms": block_parser.estimated_saved_ms(parse_ms)}
 
+def _log_error(line):
+    with open("solscan_api_error.log", "a", encoding="utf-8") as logf:
+        logf.write(line)
+
+def background_whale_alert_scanner(min_value_sol=3000, num_blocks=750, interval_sec=300):
+    # decode_blocks: tx không chạm System Program / mint theo dõi (vote...) bị bỏ qua ngay trên bytes
+    decode = partial(block_parser.decode_blocks, mints=[f["mint"] for f in SOL_TOKEN_FEEDS])
+    pipeline = BlockPipeline(lambda slot, block: _parse_block(slot, block, min_value_sol), decode=decode)
+    min_values = {"SOL": min_value_sol, **{f["name"]: f["min_value"] for f in SOL_TOKEN_FEEDS}}
     while True:
         try:
             with open("solscan_api_error.log", "w", encoding="utf-8") as logf:
@@ -222,84 +307,58 @@ def background_whale_alert_scanner(min_value_sol=3000, num_blocks=750, interval_
             if last_scanned and last_scanned >= end_block:
                 end_block = last_scanned + 1
             blocks_with_tx = fetch_blocks_with_transactions(end_block, start_block)
-            whale_txs = load_whale_history()
-            seen_hashes = set(tx['hash'] for tx in whale_txs)
-            new_whale_txs = []
-            for block_num in blocks_with_tx[::-1]:
-                try:
-                    txs = fetch_block_transactions(block_num)
-                    sol_found = 0
-                    total_sol_transferred = 0
-                    for tx in txs:
-                        tx_hash = tx.get('transaction', {}).get('signatures', [''])[0]
-                        block_time = tx.get('blockTime', None)
-                        message = tx.get('transaction', {}).get('message', {})
-                        account_keys = message.get('accountKeys', [])
-                        instructions = message.get('instructions', [])
-                        meta = tx.get('meta', {})
-                        pre_balances = meta.get('preBalances', [])
-                        post_balances = meta.get('postBalances', [])
-                        for ix in instructions:
-                            prog_idx = ix.get('programIdIndex', None)
-                            if prog_idx is not None and prog_idx < len(account_keys) and account_keys[prog_idx] == '11111111111111111111111111111111':
-                                accounts = ix.get('accounts', [])
-                                if len(accounts) >= 2:
-                                    from_idx, to_idx = accounts[0], accounts[1]
-                                    if (isinstance(from_idx, int) and isinstance(to_idx, int)
-                                        and from_idx < len(account_keys) and to_idx < len(account_keys)
-                                        and from_idx < len(pre_balances) and to_idx < len(post_balances)):
-                                        from_addr = account_keys[from_idx]
-                                        to_addr = account_keys[to_idx]
-                                        if is_internal_exchange_transfer(from_addr, to_addr):
-                                            continue
-                                        if from_addr == to_addr:
-                                            continue
-                                        try:
-                                            amount = (pre_balances[from_idx] - post_balances[from_idx]) / 1e9
-                                        except Exception as e:
-                                            amount = 0
-                                            with open("solscan_api_error.log", "a", encoding="utf-8") as logf:
-                                                logf.write(f"[block {block_num}] {datetime.utcnow()} | Error tính amount: {e} | from_idx: {from_idx}, to_idx: {to_idx}\n")
-                                        if amount > 0:
-                                            total_sol_transferred += amount
-                                        from_label = "exchange" if is_exchange_wallet(from_addr) else "org" if is_org_wallet(from_addr) else None
-                                        to_label = "exchange" if is_exchange_wallet(to_addr) else "org" if is_org_wallet(to_addr) else None
-                                        if from_label == "exchange" and to_label != "exchange":
-                                            tx_type = "SELL"
-                                        elif to_label == "exchange" and from_label != "exchange":
-                                            tx_type = "BUY"
-                                        elif from_label == "org" or to_label == "org":
-                                            tx_type = "N/A"
-                                        else:
-                                            tx_type = "N/A"
-                                        tx_obj = {
-                                            "block": block_num,
-                                            "hash": tx_hash,
-                                            "from": from_addr,
-                                            "to": to_addr,
-                                            "from_label": from_label,
-                                            "to_label": to_label,
-                                            "value": amount,
-                                            "type": tx_type,
-                                            "time": datetime.utcfromtimestamp(block_time).strftime("%Y-%m-%d %H:%M:%S") if block_time else datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
-                                        }
-                                        # Chỉ thêm giao dịch lớn mới chưa có trong lịch sử
-                                        if amount >= min_value_sol and tx_hash not in seen_hashes:
-                                            new_whale_txs.append(tx_obj)
-                                            seen_hashes.add(tx_hash)
-                    with open("solscan_api_error.log", "a", encoding="utf-8") as logf:
-                        logf.write(f"[block {block_num}] {datetime.utcnow()} | num_txs: {len(txs)} | Tổng SOL lớn phát hiện: {sol_found:.2f} | Tổng SOL phát hiện: {total_sol_transferred:.2f}\n")
-                    save_last_block(block_num)
-                    time.sleep(0.3)
-                except Exception as e:
-                    with open("solscan_api_error.log", "a", encoding="utf-8") as logf:
-                        logf.write(f"[block {block_num}] {datetime.utcnow()} | Exception: {e}\n")
-            # Chỉ ghi file nếu có giao dịch lớn mới
-            if new_whale_txs:
-                whale_txs.extend(new_whale_txs)
-                whale_txs = [tx for tx in whale_txs if tx['value'] >= min_value_sol]
-                whale_txs = whale_txs[-2000:]
-                save_whale_history(whale_txs)
+            # Mỗi feed một history; cùng một checkpoint block cho mọi feed
+            histories = {name: load_whale_history(name) for name in _FEEDS}
+            seen_hashes = {name: set(tx['hash'] for tx in hist) for name, hist in histories.items()}
+            new_whale_txs = {name: [] for name in _FEEDS}
+            done_block = None
+            uncommitted = 0
+
+            def _commit():
+                nonlocal uncommitted
+                # Chỉ ghi file nếu có giao dịch lớn mới; checkpoint ghi sau history
+                for name, new_txs in new_whale_txs.items():
+                    if not new_txs:
+                        continue
+                    whale_txs = histories[name] + new_txs
+                    whale_txs = [tx for tx in whale_txs if tx['value'] >= min_values[name]]
+                    histories[name] = whale_txs[-2000:]
+                    save_whale_history(histories[name], name)
+                    new_whale_txs[name] = []
+                if done_block is not None:
+                    save_last_block(done_block)
+                uncommitted = 0
+
+            # Slot tăng dần: tải theo batch JSON-RPC song song, parse ở pool riêng, commit theo thứ tự
+            with open("solscan_api_error.log", "a", encoding="utf-8") as logf:
+                for block_num, parsed, err in pipeline.run(sorted(blocks_with_tx)):
+                    if err is not None:
+                        # Dừng tại slot lỗi: checkpoint không vượt qua nó, lần quét sau thử lại
+                        logf.write(f"[block {block_num}] {datetime.utcnow()} | Exception: {err}\n")
+                        break
+                    if parsed is not None:
+                        for name, found in parsed["whales"].items():
+                            for tx_obj in found:
+                                if tx_obj['hash'] not in seen_hashes[name]:
+                                    new_whale_txs[name].append(tx_obj)
+                                    seen_hashes[name].add(tx_obj['hash'])
+                        tokens = " ".join(f"{name}: {len(found)}" for name, found in parsed["whales"].items() if name != "SOL")
+                        logf.write(f"[block {block_num}] {datetime.utcnow()} | num_txs: {parsed['num_txs']} | Tổng SOL lớn phát hiện: {sum(t['value'] for t in parsed['whales']['SOL']):.2f} | Tổng SOL phát hiện: {parsed['total_sol']:.2f} "
+                                   f"| token lớn: {tokens or '-'} | tx bỏ qua: {parsed['skipped']} | parse: {parsed['parse_ms']:.1f}ms (tiết kiệm ~{parsed['saved_ms']:.1f}ms)\n")
+                    done_block = block_num
+                    uncommitted += 1
+                    if uncommitted >= COMMIT_EVERY:
+                        _commit()
+                _commit()
+                st_ = pipeline.stats
+                logf.write(f"[pipeline] {datetime.utcnow()} | {st_.get('slots', 0)} slot trong {st_.get('elapsed_sec', 0):.1f}s "
+                           f"({st_.get('slots_per_sec', 0):.1f} slot/s) | posts: {st_.get('posts', 0)} | 429: {st_.get('rate_limited', 0)} "
+                           f"| batch: {st_.get('batch_size')} | delay: {st_.get('delay_sec', 0):.2f}s\n")
+                ps = block_parser.parse_stats
+                if ps["audits"]:
+                    logf.write(f"[parse] {ps['blocks']} block, {ps['skipped']}/{ps['txs']} tx bỏ qua (vote...) | full walk "
+                               f"{ps['audit_full_ms'] / ps['audits']:.1f}ms vs fast {ps['audit_fast_ms'] / ps['audits']:.1f}ms/block "
+                               f"({ps['audits']} block đo, lệch: {ps['mismatches']})\n")
         except Exception:
             pass
         time.sleep(interval_sec)
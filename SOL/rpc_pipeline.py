@@ -0,0 +1,261 @@
+"""
+Pipelined `getBlock` fetcher for the Solana whale scanner.
+
+Slots are sent as JSON-RPC batches (SOL_RPC_BATCH_SIZE `getBlock` calls per HTTP
+POST), with SOL_RPC_CONCURRENCY POSTs in flight. As soon as a batch arrives, its
+blocks are handed to a separate parse pool (SOL_PARSE_WORKERS), so downloading
+the next batches overlaps with parsing. `BlockPipeline.run(slots)` yields
+`(slot, parsed, error)` in slot order, so callers can advance a checkpoint block
+by block. `decode` turns the raw response bytes into JSON (the scanner passes
+`block_parser.decode_blocks`, which leaves vote transactions undecoded).
+
+Rate limits: all POSTs share one `_AdaptiveBackoff`. A 429 (HTTP status or a
+per-call error) doubles the pause between POSTs, honours Retry-After and halves
+the batch size. Each successful POST shrinks the pause and grows the batch back
+towards SOL_RPC_BATCH_SIZE. `stats` holds throughput figures (slots/s, posts,
+429s, current delay and batch size).
+"""
+from __future__ import annotations
+
+import json
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import requests
+
+from config import (
+    SOL_RPC_URL,
+    SOL_RPC_BATCH_SIZE,
+    SOL_RPC_CONCURRENCY,
+    SOL_RPC_MAX_RETRIES,
+    SOL_RPC_BACKOFF_MIN_SEC,
+    SOL_RPC_BACKOFF_MAX_SEC,
+    SOL_PARSE_WORKERS,
+)
+
+GET_BLOCK_CONFIG = {
+    "encoding": "json",
+    "transactionDetails": "full",
+    "rewards": False,
+    "maxSupportedTransactionVersion": 0,
+}
+# Slot không có block (bị bỏ qua / đã bị dọn khỏi storage): không phải lỗi
+SKIPPED_SLOT_CODES = {-32007, -32009}
+RATE_LIMIT_CODES = {429, -32429}
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after: Optional[float] = None) -> None:
+        super().__init__("429 Too Many Requests")
+        self.retry_after = retry_after
+
+
+class RpcError(Exception):
+    pass
+
+
+class _AdaptiveBackoff:
+    """Shared pacing of RPC POSTs: the pause doubles on 429 and decays on success."""
+
+    def __init__(self, min_delay: float = SOL_RPC_BACKOFF_MIN_SEC, max_delay: float = SOL_RPC_BACKOFF_MAX_SEC) -> None:
+        self._lock = threading.Lock()
+        self._min = min_delay
+        self._max = max_delay
+        self.delay = 0.0
+        self._next_at = 0.0
+
+    def wait(self) -> None:
+        # Giữ chỗ theo thứ tự: các POST song song cách nhau ít nhất `delay`
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next_at)
+            self._next_at = start + self.delay
+        if start > now:
+            time.sleep(start - now)
+
+    def throttled(self, retry_after: Optional[float] = None) -> None:
+        with self._lock:
+            self.delay = min(self._max, max(self._min, self.delay * 2))
+            self._next_at = max(self._next_at, time.time() + max(self.delay, retry_after or 0))
+
+    def succeeded(self) -> None:
+        with self._lock:
+            self.delay *= 0.7
+            if self.delay < self._min / 4:
+                self.delay = 0.0
+
+
+def _retry_after(resp: requests.Response) -> Optional[float]:
+    try:
+        return float(resp.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+class BlockPipeline:
+    """Batched, concurrent `getBlock` fetch + parse stage, results in slot order."""
+
+    def __init__(self, parse: Callable[[int, Dict], Any], url: str = SOL_RPC_URL,
+                 batch_size: int = SOL_RPC_BATCH_SIZE, concurrency: int = SOL_RPC_CONCURRENCY,
+                 parse_workers: int = SOL_PARSE_WORKERS, max_retries: int = SOL_RPC_MAX_RETRIES,
+                 timeout: float = 30, decode: Callable[[bytes], Any] = json.loads) -> None:
+        self._parse = parse
+        self._decode = decode
+        self._url = url
+        self._max_batch = max(1, int(batch_size))
+        self._batch = self._max_batch
+        self._concurrency = max(1, int(concurrency))
+        self._parse_workers = max(1, int(parse_workers))
+        self._max_retries = max_retries
+        self._timeout = timeout
+        self._backoff = _AdaptiveBackoff()
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self.stats: Dict[str, float] = {}
+
+    # ---------- fetch stage ----------
+    def _session(self) -> requests.Session:
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def _count(self, **kw: float) -> None:
+        with self._stats_lock:
+            for k, v in kw.items():
+                self.stats[k] = self.stats.get(k, 0) + v
+
+    def _post(self, slots: List[int]) -> Dict[int, Tuple[Optional[Dict], Optional[Exception]]]:
+        """One batch POST -> {slot: (block or None if skipped, error)}; raises on 429 / network error."""
+        payload = [{"jsonrpc": "2.0", "id": s, "method": "getBlock", "params": [s, GET_BLOCK_CONFIG]} for s in slots]
+        self._backoff.wait()
+        t0 = time.time()
+        resp = self._session().post(self._url, json=payload, timeout=self._timeout)
+        self._count(posts=1, fetch_sec=time.time() - t0)
+        if resp.status_code == 429:
+            raise RateLimited(_retry_after(resp))
+        resp.raise_for_status()
+        data = self._decode(resp.content)
+        if isinstance(data, dict):
+            # Node không hỗ trợ batch trả về một lỗi duy nhất
+            err = data.get("error") or {}
+            if err.get("code") in RATE_LIMIT_CODES:
+                raise RateLimited()
+            raise RpcError(err.get("message") or "unexpected batch response")
+        out: Dict[int, Tuple[Optional[Dict], Optional[Exception]]] = {}
+        limited = False
+        for item in data:
+            slot = item.get("id")
+            err = item.get("error")
+            if err is None:
+                out[slot] = (item.get("result"), None)
+            elif err.get("code") in SKIPPED_SLOT_CODES:
+                out[slot] = (None, None)
+            elif err.get("code") in RATE_LIMIT_CODES:
+                limited = True
+            else:
+                out[slot] = (None, RpcError(f"{err.get('code')}: {err.get('message')}"))
+        if limited:
+            if not out:
+                raise RateLimited()
+            # Một phần batch bị 429: giảm tốc, các slot thiếu sẽ được gửi lại
+            self._throttled(None)
+        return out
+
+    def _throttled(self, retry_after: Optional[float]) -> None:
+        self._backoff.throttled(retry_after)
+        self._batch = max(1, self._batch // 2)
+        self._count(rate_limited=1)
+
+    def _fetch(self, slots: List[int]) -> Dict[int, Tuple[Optional[Dict], Optional[Exception]]]:
+        results: Dict[int, Tuple[Optional[Dict], Optional[Exception]]] = {}
+        todo = list(slots)
+        last_error: Exception = RpcError("no response")
+        for _ in range(self._max_retries):
+            try:
+                results.update(self._post(todo))
+            except RateLimited as e:
+                self._throttled(e.retry_after)
+                last_error = e
+                continue
+            except (requests.RequestException, ValueError, RpcError) as e:
+                self._backoff.throttled()
+                self._count(errors=1)
+                last_error = e
+                continue
+            self._backoff.succeeded()
+            if self._batch < self._max_batch:
+                self._batch += 1
+            todo = [s for s in todo if s not in results]
+            if not todo:
+                break
+        for s in todo:
+            results[s] = (None, last_error)
+        return results
+
+    # ---------- parse stage ----------
+    def _parse_one(self, slot: int, block: Optional[Dict], error: Optional[Exception]) -> Tuple[Any, Optional[Exception]]:
+        if error is not None:
+            return None, error
+        if block is None:
+            return None, None
+        t0 = time.time()
+        try:
+            return self._parse(slot, block), None
+        except Exception as e:
+            return None, e
+        finally:
+            self._count(parse_sec=time.time() - t0)
+
+    def _fetch_then_parse(self, slots: List[int], parser: ThreadPoolExecutor) -> List[Tuple[int, Future]]:
+        fetched = self._fetch(slots)
+        # Giao block cho pool parse ngay, worker fetch quay lại tải batch tiếp theo
+        return [(s, parser.submit(self._parse_one, s, *fetched.get(s, (None, RpcError("missing"))))) for s in slots]
+
+    def run(self, slots: Iterable[int]) -> Iterator[Tuple[int, Any, Optional[Exception]]]:
+        """Yield (slot, parsed, error) in the order of `slots`; parsed is None for skipped slots."""
+        it = iter(slots)
+        self.stats = {"slots": 0, "posts": 0, "rate_limited": 0, "errors": 0, "fetch_sec": 0.0, "parse_sec": 0.0}
+        t0 = time.time()
+
+        def _next_batch() -> List[int]:
+            batch = []
+            for s in it:
+                batch.append(s)
+                if len(batch) >= self._batch:
+                    break
+            return batch
+
+        pending: deque = deque()
+        # Pool parse đóng sau pool fetch: batch đang tải vẫn giao được block khi dừng sớm
+        with ThreadPoolExecutor(self._parse_workers, thread_name_prefix="sol-parse") as parser, \
+                ThreadPoolExecutor(self._concurrency, thread_name_prefix="sol-rpc") as fetcher:
+            try:
+                while len(pending) < self._concurrency * 2:
+                    batch = _next_batch()
+                    if not batch:
+                        break
+                    pending.append(fetcher.submit(self._fetch_then_parse, batch, parser))
+                while pending:
+                    parsed = pending.popleft().result()
+                    batch = _next_batch()
+                    if batch:
+                        pending.append(fetcher.submit(self._fetch_then_parse, batch, parser))
+                    for slot, fut in parsed:
+                        result, error = fut.result()
+                        self.stats["slots"] += 1
+                        yield slot, result, error
+            finally:
+                # Người gọi dừng sớm: bỏ các batch chưa bắt đầu
+                for fut in pending:
+                    fut.cancel()
+                elapsed = time.time() - t0
+                self.stats["elapsed_sec"] = elapsed
+                self.stats["slots_per_sec"] = self.stats["slots"] / elapsed if elapsed > 0 else 0.0
+                self.stats["delay_sec"] = self._backoff.delay
+                self.stats["batch_size"] = self._batch
+
+
+__all__ = ["BlockPipeline", "RateLimited", "RpcError"]
@@ -69,10 +69,9 @@ def _load_local_files() -> bool:
             with open("avg_price.json", "r") as f:
                 _DATA_CACHE["avg_prices"] = json.load(f)
         
-        # History
-        if os.path.exists("portfolio_history.json"):
-            with open("portfolio_history.json", "r") as f:
-                _DATA_CACHE["history"] = json.load(f)
+        # History (segmented append-only store)
+        from portfolio_history import load_history
+        _DATA_CACHE["history"] = list(load_history())
         
         # Last prices
         if os.path.exists("last_prices.json"):
@@ -107,6 +106,17 @@ def _bootstrap_from_db() -> bool:
                 print(f"[DEBUG] {error_msg}")
                 return False
         
+        # Đảm bảo index (unique timestamp+coin, unique hash, ...) – idempotent, một lần mỗi process
+        try:
+            report = db.ensure_indexes()
+            created = {c: e["created"] for c, e in report.items() if e["created"]}
+            if created:
+                print(f"[DEBUG] Created Mongo indexes: {created}")
+            for w in db.index_warnings():
+                _APP_STATE["errors"].append(f"DB index warning: {w}")
+        except Exception as e:
+            _APP_STATE["errors"].append(f"DB index provisioning error: {e}")
+
         # Load portfolio metadata
         try:
             print("[DEBUG] Attempting to load portfolio metadata from DB...")
@@ -135,14 +145,14 @@ def _bootstrap_from_db() -> bool:
         except Exception as e:
             _APP_STATE["errors"].append(f"DB portfolio meta load error: {e}")
         
-        # Load portfolio history
+        # Portfolio history: incremental sync (chỉ kéo/đẩy docs mới hơn high-water mark)
         try:
-            history = db.find_all("portfolio_history", sort_field="timestamp", ascending=True)
-            if history:
-                _DATA_CACHE["history"] = history
-                # Backup to local file
-                with open("portfolio_history.json", "w") as f:
-                    json.dump(history, f)
+            from history_sync import sync_portfolio_history
+            from portfolio_history import load_history
+            sync = sync_portfolio_history(db)
+            print(f"[DEBUG] History sync: {sync}")
+            if sync["merged"]:
+                _DATA_CACHE["history"] = list(load_history())
         
         except Exception as e:
             _APP_STATE["errors"].append(f"DB history load error: {e}")
@@ -0,0 +1,72 @@
+"""
+So sánh độ trễ CloudDB: ping mỗi lần gọi (cũ), health cache và KV cache *_meta trên client giả lập.
+
+Mỗi lệnh tới "server" giả lập tốn RTT_MS mili-giây (ping cũng vậy).
+
+    python bench_cloud_db_health.py
+"""
+import time
+
+import cloud_db
+
+RTT_MS = 30
+CALLS = 50
+
+
+class _FakeCollection:
+    def find_one(self, query):
+        time.sleep(RTT_MS / 1000)
+        return {"_id": query.get("_id"), "v": 1}
+
+
+class _FakeAdmin:
+    def command(self, name):
+        time.sleep(RTT_MS / 1000)
+        return {"ok": 1}
+
+
+class _FakeClient:
+    admin = _FakeAdmin()
+
+
+def _make_db() -> cloud_db.CloudDB:
+    cloud_db.MONGO_CLIENT = _FakeClient()
+    d = cloud_db.CloudDB()
+    d._db = {"meta": _FakeCollection(), "btc_meta": _FakeCollection()}
+    return d
+
+
+def _legacy_available(d: cloud_db.CloudDB) -> bool:
+    # Hành vi cũ: ping trước mọi thao tác
+    cloud_db.MONGO_CLIENT.admin.command("ping")
+    return True
+
+
+def run() -> None:
+    d = _make_db()
+    t0 = time.perf_counter()
+    for _ in range(CALLS):
+        if _legacy_available(d):
+            d._db["meta"].find_one({"_id": "last_block"})
+    legacy = (time.perf_counter() - t0) * 1000 / CALLS
+
+    d = _make_db()
+    t0 = time.perf_counter()
+    for _ in range(CALLS):
+        d.get_kv("meta", "last_block")
+    cached = (time.perf_counter() - t0) * 1000 / CALLS
+
+    print(f"RTT giả lập {RTT_MS} ms, {CALLS} lần get_kv")
+    print(f"  ping mỗi lần : {legacy:6.1f} ms/lần")
+    print(f"  health cache : {cached:6.1f} ms/lần  ({d.health_stats['pings']} ping, {d.health_stats['cached_checks']} lần dùng cache)")
+
+    # Checkpoint *_meta: KV cache write-through, chỉ lần đọc đầu tiên tới "server"
+    t0 = time.perf_counter()
+    for _ in range(CALLS):
+        d.get_kv("btc_meta", "last_block")
+    kv_cached = (time.perf_counter() - t0) * 1000 / CALLS
+    print(f"  KV cache     : {kv_cached:6.3f} ms/lần  ({d.kv_stats['hits']} hit, {d.kv_stats['misses']} miss)")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,75 @@
+"""
+So sánh ts_codec (Gorilla) với JSON/CSV hiện tại: kích thước và thời gian đọc.
+
+    python bench_ts_codec.py
+"""
+import json
+import os
+import time
+
+import pandas as pd
+
+from ts_codec import frame_to_blob, decode_series
+
+
+def _timeit(fn, repeat=5):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    return best * 1000
+
+
+def _report(name, raw_size, raw_read, blob, last_day_start):
+    dec = _timeit(lambda: decode_series(blob))
+    dec_range = _timeit(lambda: decode_series(blob, start=last_day_start))
+    print(f"{name:<28} {raw_size/1024:>9.1f} KB {len(blob)/1024:>8.1f} KB  x{raw_size/max(1, len(blob)):>5.1f}"
+          f" | đọc gốc {raw_read:>7.1f} ms  giải nén {dec:>7.1f} ms  1 ngày cuối {dec_range:>6.1f} ms")
+
+
+def bench_csv(path, time_col="timestamp"):
+    if not os.path.exists(path):
+        return
+    raw_size = os.path.getsize(path)
+
+    def _read():
+        df = pd.read_csv(path)
+        df[time_col] = pd.to_datetime(df[time_col], errors="coerce")
+        return df
+
+    raw_read = _timeit(_read)
+    df = _read()
+    blob = frame_to_blob(df, time_col=time_col)
+    last = int(df[time_col].max().timestamp()) - 86400
+    _report(path, raw_size, raw_read, blob, last)
+
+
+def bench_history(path="portfolio_history.json"):
+    if not os.path.exists(path):
+        return
+    raw_size = os.path.getsize(path)
+
+    def _read():
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    raw_read = _timeit(_read, repeat=3)
+    df = pd.DataFrame(_read())
+    df["coin"] = df["coin"].fillna("__total__") if "coin" in df.columns else "__total__"
+    df = df.drop_duplicates(subset=["timestamp", "coin"], keep="last")
+    last = int(df["timestamp"].max()) - 86400
+    blobs = [frame_to_blob(g, columns=["value", "invested", "PNL", "amount", "avg_price"])
+             for _, g in df.groupby("coin")]
+    total = sum(len(b) for b in blobs)
+    dec = _timeit(lambda: [decode_series(b) for b in blobs], repeat=3)
+    dec_range = _timeit(lambda: [decode_series(b, start=last) for b in blobs], repeat=3)
+    print(f"{path + ' (' + str(len(blobs)) + ' series)':<28} {raw_size/1024:>9.1f} KB {total/1024:>8.1f} KB  x{raw_size/max(1, total):>5.1f}"
+          f" | đọc gốc {raw_read:>7.1f} ms  giải nén {dec:>7.1f} ms  1 ngày cuối {dec_range:>6.1f} ms")
+
+
+if __name__ == "__main__":
+    bench_history()
+    bench_csv("dominance_history.csv")
+    bench_csv("marketcap_history.csv")
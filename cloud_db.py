@@ -15,14 +15,82 @@ Usage:
 """
 from __future__ import annotations
 
+import atexit
+import copy
+import itertools
 import os
-from typing import Any, Dict, Iterable, List, Optional
+import threading
+from collections import deque
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 
-from pymongo import MongoClient
-from pymongo.errors import PyMongoError
+from pymongo import MongoClient, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, ConnectionFailure, PyMongoError
 import time
 
+from config import SCANNER_LOG_TTL_DAYS
+
 MONGO_CLIENT = None
+UPSERT_BATCH_SIZE = 500  # operations per bulk_write round trip
+HEALTH_TTL_SEC = 60  # last-known-good status is trusted this long without a heartbeat/op success
+KV_CACHED_SUFFIX = "_meta"  # get_kv/set_kv on *_meta collections (checkpoints, portfolio_meta) go through the cache
+KV_RETRY_SEC = 5  # pause of the KV writer after a failed write
+KV_SYNC_COLLECTIONS = ("portfolio_meta",)  # cached for reads, but written to Mongo before set_kv returns
+KV_EXIT_FLUSH_SEC = 10  # at interpreter exit, wait this long for queued KV writes
+
+
+# Index spec per collection: list of (keys, options). "*suffix" entries match any collection
+# with that suffix (per-chain whale histories). *_meta / portfolio_meta use the built-in _id index.
+INDEX_SPECS: Dict[str, List[tuple]] = {
+    "portfolio_history": [
+        ([("timestamp", 1), ("coin", 1)], {"name": "timestamp_coin_unique", "unique": True}),
+        ([("coin", 1), ("timestamp", 1)], {"name": "coin_timestamp"}),
+    ],
+    "portfolio_history_delta": [([("timestamp", 1)], {"name": "timestamp_unique", "unique": True})],
+    "dominance_history": [([("timestamp", 1)], {"name": "timestamp_unique", "unique": True})],
+    "marketcap_history": [([("timestamp", 1)], {"name": "timestamp_unique", "unique": True})],
+    "*_whale_history": [
+        ([("hash", 1)], {"name": "hash_unique", "unique": True}),
+        ([("time", 1)], {"name": "time"}),
+    ],
+    # Scanner logs (scanner_log): expire after SCANNER_LOG_TTL_DAYS (ISO-string `ts` of old
+    # docs is converted to a date by ensure_indexes, TTL ignores strings)
+    "*_logs": [([("ts", 1)], {"name": "ts_ttl", "expireAfterSeconds": SCANNER_LOG_TTL_DAYS * 86400})],
+}
+INDEX_USAGE_TTL_SEC = 300
+DUPLICATE_KEY_CODE = 11000
+FALLBACK_INDEX_SUFFIX = "_nonunique"  # same keys without `unique` when existing data has duplicates
+
+
+class _HeartbeatHealth(monitoring.ServerHeartbeatListener):
+    """Records pymongo's background server heartbeats (no extra round trips)."""
+
+    def __init__(self) -> None:
+        self.last_ok = 0.0
+        self.last_failure: Optional[str] = None
+
+    def started(self, event) -> None:
+        pass
+
+    def succeeded(self, event) -> None:
+        self.last_ok = time.time()
+
+    def failed(self, event) -> None:
+        self.last_failure = f"heartbeat {event.connection_id}: {event.reply}"[:300]
+
+
+_HEARTBEAT = _HeartbeatHealth()
+
+
+def _new_client(uri: str) -> MongoClient:
+    return MongoClient(
+        uri,
+        tz_aware=True,
+        serverSelectionTimeoutMS=15000,  # Increased timeout
+        connectTimeoutMS=15000,
+        socketTimeoutMS=15000,
+        maxPoolSize=10,
+        event_listeners=[_HEARTBEAT],
+    )
 
 
 class CloudDB:
@@ -37,6 +105,21 @@ class CloudDB:
         self._last_attempt = 0.0
         self._retry_interval = 30  # seconds between reconnect attempts
         self._last_error_msg = None  # type: Optional[str]
+        self.last_upsert_stats = []  # type: List[Dict[str, int]]
+        self.last_insert_stats = []  # type: List[Dict[str, int]]
+        self._last_ok = 0.0  # last successful ping/operation
+        self.health_stats = {"pings": 0, "cached_checks": 0, "op_failures": 0}
+        self.index_report = {}  # type: Dict[str, Dict[str, List[str]]]
+        self._indexes_ensured = False  # full ensure_indexes() run done
+        self._index_usage = {}  # type: Dict[str, tuple]
+        # Write-through KV cache: (collection, key) -> (version, value); writes flushed in order by one thread
+        self._kv_cache = {}  # type: Dict[Tuple[str, str], Tuple[int, Optional[Dict[str, Any]]]]
+        self._kv_versions = itertools.count(1)
+        self._kv_written = {}  # type: Dict[Tuple[str, str], int]
+        self._kv_dirty = deque()  # type: deque
+        self._kv_cond = threading.Condition()
+        self._kv_writer = None  # type: Optional[threading.Thread]
+        self.kv_stats = {"hits": 0, "misses": 0, "writes": 0, "write_failures": 0}
         self._connect_initial()
 
     def _connect_initial(self):
@@ -45,16 +128,9 @@ class CloudDB:
         try:
             global MONGO_CLIENT
             if MONGO_CLIENT is None:
-                MONGO_CLIENT = MongoClient(
-                    self._mongo_uri, 
-                    tz_aware=True, 
-                    serverSelectionTimeoutMS=15000,  # Increased timeout
-                    connectTimeoutMS=15000,
-                    socketTimeoutMS=15000,
-                    maxPoolSize=10
-                )
+                MONGO_CLIENT = _new_client(self._mongo_uri)
             # Force a ping to validate
-            MONGO_CLIENT.admin.command('ping')
+            self._ping()
             self._db = MONGO_CLIENT[self._db_name]
             self._provider = "mongo"
         except PyMongoError as e:
@@ -70,15 +146,8 @@ class CloudDB:
         self._last_attempt = now
         try:
             global MONGO_CLIENT
-            MONGO_CLIENT = MongoClient(
-                self._mongo_uri, 
-                tz_aware=True, 
-                serverSelectionTimeoutMS=15000,  # Increased timeout
-                connectTimeoutMS=15000,
-                socketTimeoutMS=15000,
-                maxPoolSize=10
-            )
-            MONGO_CLIENT.admin.command('ping')
+            MONGO_CLIENT = _new_client(self._mongo_uri)
+            self._ping()
             self._db = MONGO_CLIENT[self._db_name]
             self._provider = "mongo"
             self._last_error_msg = None  # Clear error on successful connect
@@ -86,24 +155,41 @@ class CloudDB:
             self._provider = None
             self._last_error_msg = f"reconnect error: {e}"[:300]
 
+    def _ping(self) -> None:
+        self.health_stats["pings"] += 1
+        MONGO_CLIENT.admin.command('ping')
+        self._last_ok = time.time()
+
+    def _note_ok(self) -> None:
+        self._last_ok = time.time()
+
+    def _note_failure(self, e: Exception) -> None:
+        """A real operation failed: connection errors mark the DB down (next call reconnects)."""
+        self.health_stats["op_failures"] += 1
+        self._last_error_msg = f"{type(e).__name__}: {e}"[:300]
+        if isinstance(e, ConnectionFailure):
+            self._db = None
+
     def available(self) -> bool:
-        """Check if the database connection is available (attempt lazy reconnect)."""
+        """Check if the database connection is available (attempt lazy reconnect).
+
+        Uses the last-known-good status (successful operation or pymongo heartbeat)
+        while it is younger than HEALTH_TTL_SEC; only a stale status costs a ping.
+        """
         if self._db is None:
             self._maybe_reconnect()
-        
-        # Additional ping test to ensure connection is really alive
-        if self._db is not None:
-            try:
-                global MONGO_CLIENT
-                if MONGO_CLIENT:
-                    MONGO_CLIENT.admin.command('ping')
-                return True
-            except Exception as e:
-                self._last_error_msg = f"ping failed: {e}"[:300]
-                self._db = None
-                return False
-        
-        return self._db is not None
+            return self._db is not None
+        now = time.time()
+        if now - max(self._last_ok, _HEARTBEAT.last_ok) < HEALTH_TTL_SEC:
+            self.health_stats["cached_checks"] += 1
+            return True
+        try:
+            self._ping()
+            return True
+        except Exception as e:
+            self._last_error_msg = f"ping failed: {e}"[:300]
+            self._db = None
+            return False
 
     def last_error(self) -> str | None:
         return self._last_error_msg
@@ -117,7 +203,11 @@ class CloudDB:
             "db_available": self._db is not None,
             "last_error": self._last_error_msg,
             "last_attempt": self._last_attempt,
-            "retry_interval": self._retry_interval
+            "retry_interval": self._retry_interval,
+            "last_ok_age": round(time.time() - max(self._last_ok, _HEARTBEAT.last_ok), 1),
+            "last_heartbeat_failure": _HEARTBEAT.last_failure,
+            **self.health_stats,
+            "kv": {**self.kv_stats, "cached": len(self._kv_cache), "pending": len(self._kv_dirty)},
         }
 
     def force_reconnect(self) -> bool:
@@ -134,65 +224,527 @@ class CloudDB:
             return None
         try:
             res = self._db[collection].insert_one(doc)
+            self._note_ok()
             return str(res.inserted_id)
-        except PyMongoError:
+        except PyMongoError as e:
+            self._note_failure(e)
             return None
 
-    def upsert_many(self, collection: str, docs: Iterable[Dict[str, Any]], unique_keys: List[str]) -> int:
-        """Upsert multiple documents into the specified collection."""
+    def upsert_many(self, collection: str, docs: Iterable[Dict[str, Any]], unique_keys: List[str],
+                    batch_size: int = UPSERT_BATCH_SIZE) -> int:
+        """Upsert multiple documents via unordered bulk_write, `batch_size` ops per round trip.
+
+        Docs sharing the same unique key are merged first (later fields win, as with
+        consecutive $set). Per-batch counts are kept in `last_upsert_stats`.
+        Returns the number of docs written successfully.
+        """
+        self.last_upsert_stats = []
         if not self.available():
             return 0
-        count = 0
-        col = self._db[collection]
+        merged: Dict[tuple, tuple] = {}
         for d in docs:
+            if not any(k in d for k in unique_keys):
+                # Skip docs without unique keys
+                continue
+            # Every key in the filter: a missing one matches null/missing (portfolio totals have no
+            # `coin`), not any value, so a totals doc cannot overwrite a coin doc of the same timestamp
+            filt = {k: d.get(k) for k in unique_keys}
+            key = tuple((k, repr(v)) for k, v in filt.items())
+            update = {k: v for k, v in d.items() if k != "_id"}
+            if key in merged:
+                merged[key][1].update(update)
+            else:
+                merged[key] = (filt, update)
+        ops = [UpdateOne(filt, {"$set": update}, upsert=True) for filt, update in merged.values()]
+        col = self._db[collection]
+        written = 0
+        for i in range(0, len(ops), max(1, batch_size)):
+            batch = ops[i:i + batch_size]
+            stats = {"batch": i // batch_size, "ops": len(batch), "inserted": 0, "modified": 0, "matched": 0, "failed": 0}
+            try:
+                res = col.bulk_write(batch, ordered=False)
+                stats.update(inserted=res.upserted_count, modified=res.modified_count, matched=res.matched_count)
+                self._note_ok()
+            except BulkWriteError as e:
+                details = e.details or {}
+                stats.update(
+                    inserted=details.get("nUpserted", 0),
+                    modified=details.get("nModified", 0),
+                    matched=details.get("nMatched", 0),
+                    failed=len(details.get("writeErrors", [])),
+                )
+                self._last_error_msg = f"bulk upsert {collection}: {stats['failed']} failed"[:300]
+            except PyMongoError as e:
+                stats["failed"] = len(batch)
+                self._note_failure(e)
+                self._last_error_msg = f"bulk upsert {collection}: {e}"[:300]
+            written += stats["ops"] - stats["failed"]
+            self.last_upsert_stats.append(stats)
+        return written
+
+    def delete_many(self, collection: str, query: Dict[str, Any]) -> int:
+        """Delete documents matching `query`. Returns the number deleted (0 on error)."""
+        if not self.available():
+            return 0
+        try:
+            res = self._db[collection].delete_many(query)
+            self._note_ok()
+            return int(res.deleted_count or 0)
+        except PyMongoError as e:
+            self._note_failure(e)
+            return 0
+
+    def insert_many(self, collection: str, docs: Iterable[Dict[str, Any]],
+                    batch_size: int = UPSERT_BATCH_SIZE) -> int:
+        """Plain unordered inserts (e.g. time-series collections, which have no upsert by key).
+
+        Per-batch counts are kept in `last_insert_stats`. Returns the number of docs inserted.
+        """
+        self.last_insert_stats = []
+        if not self.available():
+            return 0
+        docs = [d for d in docs if d]
+        col = self._db[collection]
+        written = 0
+        for i in range(0, len(docs), max(1, batch_size)):
+            batch = docs[i:i + batch_size]
+            stats = {"batch": i // batch_size, "ops": len(batch), "inserted": 0, "failed": 0}
+            try:
+                res = col.insert_many(batch, ordered=False)
+                stats["inserted"] = len(res.inserted_ids)
+                self._note_ok()
+            except BulkWriteError as e:
+                details = e.details or {}
+                stats.update(inserted=details.get("nInserted", 0), failed=len(details.get("writeErrors", [])))
+                self._last_error_msg = f"insert {collection}: {stats['failed']} failed"[:300]
+            except PyMongoError as e:
+                stats["failed"] = len(batch)
+                self._note_failure(e)
+                self._last_error_msg = f"insert {collection}: {e}"[:300]
+            written += stats["inserted"]
+            self.last_insert_stats.append(stats)
+        return written
+
+    # ---------- time-series collections ----------
+    def collection_type(self, collection: str) -> Optional[str]:
+        """"timeseries", "collection", "view" or None when it does not exist (or DB is down)."""
+        if not self.available():
+            return None
+        try:
+            infos = list(self._db.list_collections(filter={"name": collection}))
+            self._note_ok()
+            return infos[0].get("type", "collection") if infos else None
+        except PyMongoError as e:
+            self._note_failure(e)
+            return None
+
+    def create_timeseries_collection(self, collection: str, time_field: str, meta_field: str,
+                                     granularity: str = "minutes") -> bool:
+        """Create a native time-series collection (idempotent). False if the name is taken by another type."""
+        kind = self.collection_type(collection)
+        if kind is not None:
+            return kind == "timeseries"
+        if not self.available():
+            return False
+        try:
+            self._db.create_collection(collection, timeseries={
+                "timeField": time_field, "metaField": meta_field, "granularity": granularity,
+            })
+            self._note_ok()
+            return True
+        except PyMongoError as e:
+            self._note_failure(e)
+            self._last_error_msg = f"create timeseries {collection}: {e}"[:300]
+            return self.collection_type(collection) == "timeseries"
+
+    # ---------- indexes ----------
+    @staticmethod
+    def index_specs_for(collection: str) -> List[tuple]:
+        specs = list(INDEX_SPECS.get(collection, []))
+        for pattern, pattern_specs in INDEX_SPECS.items():
+            if pattern.startswith("*") and collection.endswith(pattern[1:]):
+                specs.extend(pattern_specs)
+        return specs
+
+    def ensure_indexes(self, collections: Optional[Iterable[str]] = None, force: bool = False) -> Dict[str, Dict[str, List[str]]]:
+        """Create missing indexes from INDEX_SPECS (idempotent; once per process unless `force`).
+
+        Default collections: every explicit spec plus existing collections matching a
+        pattern. Returns {collection: {"created", "missing", "fallback", "errors"}} (also
+        merged into `index_report`). A unique index that cannot be built because the data
+        already has duplicate keys is replaced by a non-unique index on the same keys
+        (listed in "fallback"), so reads and upserts by key still use an index. For TTL
+        indexes, string values of the field (legacy ISO timestamps) are converted to dates.
+        """
+        if self._indexes_ensured and not force and collections is None:
+            return self.index_report
+        full_run = collections is None
+        if not self.available():
+            return {}
+        if collections is None:
+            names = {c for c in INDEX_SPECS if not c.startswith("*")}
             try:
-                filt = {k: d.get(k) for k in unique_keys if k in d}
-                update = {k: v for k, v in d.items() if k not in ("_id",)}
-                if not filt:
-                    # Skip docs without unique keys
+                names.update(c for c in self._db.list_collection_names() if self.index_specs_for(c))
+            except PyMongoError as e:
+                self._note_failure(e)
+            collections = sorted(names)
+        report: Dict[str, Dict[str, List[str]]] = {}
+        for coll in collections:
+            entry = {"created": [], "missing": [], "fallback": [], "errors": []}
+            try:
+                # key pattern -> unique?
+                existing = {tuple(tuple(k) for k in info["key"]): bool(info.get("unique"))
+                            for info in self._db[coll].index_information().values()}
+            except PyMongoError as e:
+                existing = {}
+                entry["errors"].append(str(e)[:200])
+            for keys, options in self.index_specs_for(coll):
+                name = options["name"]
+                pattern = tuple((k, d) for k, d in keys)
+                if pattern in existing:
+                    if options.get("unique") and not existing[pattern]:
+                        entry["fallback"].append(name)
+                    elif "expireAfterSeconds" in options:
+                        self._convert_string_dates(coll, keys[0][0], entry)
                     continue
-                col.update_one(filt, {"$set": update}, upsert=True)
-                count += 1
-            except PyMongoError:
-                continue
-        return count
+                try:
+                    self._db[coll].create_index(keys, **options)
+                    entry["created"].append(name)
+                    if "expireAfterSeconds" in options:
+                        self._convert_string_dates(coll, keys[0][0], entry)
+                except PyMongoError as e:
+                    if not (options.get("unique") and getattr(e, "code", None) == DUPLICATE_KEY_CODE):
+                        entry["missing"].append(name)
+                        entry["errors"].append(f"{name}: {e}"[:200])
+                        continue
+                    # Duplicate keys in existing data: same keys, non-unique
+                    fallback = {k: v for k, v in options.items() if k != "unique"}
+                    fallback["name"] = (name[:-len("_unique")] if name.endswith("_unique") else name) + FALLBACK_INDEX_SUFFIX
+                    try:
+                        self._db[coll].create_index(keys, **fallback)
+                        entry["created"].append(fallback["name"])
+                        entry["fallback"].append(name)
+                    except PyMongoError as e2:
+                        entry["missing"].append(name)
+                        entry["errors"].append(f"{name}: {e2}"[:200])
+            report[coll] = entry
+        if full_run:
+            self.index_report = report
+            self._indexes_ensured = True
+        else:
+            self.index_report.update(report)
+        return report
 
-    def find_all(self, collection: str, sort_field: Optional[str] = None, ascending: bool = True, limit: Optional[int] = None) -> List[Dict[str, Any]]:
-        """Find all documents in the specified collection with optional sorting and limiting."""
+    def _convert_string_dates(self, collection: str, field: str, entry: Dict[str, List[str]]) -> None:
+        """Rewrite `field` stored as an ISO string into a BSON date, so a TTL index expires the doc."""
+        try:
+            self._db[collection].update_many(
+                {field: {"$type": "string"}},
+                [{"$set": {field: {"$dateFromString": {"dateString": f"${field}", "onError": "$$NOW"}}}}],
+            )
+        except PyMongoError as e:
+            entry["errors"].append(f"{field} string dates: {e}"[:200])
+
+    def index_usage(self, collection: str) -> Dict[str, int]:
+        """{index name: ops since server start} from $indexStats (cached INDEX_USAGE_TTL_SEC)."""
+        cached = self._index_usage.get(collection)
+        if cached and time.time() - cached[0] < INDEX_USAGE_TTL_SEC:
+            return cached[1]
+        usage: Dict[str, int] = {}
         if not self.available():
-            return []
+            return usage
         try:
-            cur = self._db[collection].find({})
+            for stat in self._db[collection].aggregate([{"$indexStats": {}}]):
+                usage[stat.get("name")] = int((stat.get("accesses") or {}).get("ops", 0))
+            self._note_ok()
+        except PyMongoError as e:
+            self._note_failure(e)
+        self._index_usage[collection] = (time.time(), usage)
+        return usage
+
+    def index_warnings(self) -> List[str]:
+        """Missing/failed indexes from the last ensure_indexes run, for the health panel."""
+        warnings = []
+        for coll, entry in (self.index_report or {}).items():
+            errors = entry.get("errors", [])
+            for name in entry.get("missing", []):
+                reason = next((e for e in errors if e.startswith(f"{name}:")), "")
+                warnings.append(f"{coll}: thiếu index {name}" + (f" ({reason[len(name) + 2:]})" if reason else ""))
+            for name in entry.get("fallback", []):
+                warnings.append(f"{coll}: {name} không unique (dữ liệu có key trùng), đang dùng index thường")
+            for err in errors:
+                if not any(err.startswith(f"{name}:") for name in entry.get("missing", [])):
+                    warnings.append(f"{coll}: {err}")
+        return warnings
+
+    @staticmethod
+    def _projection(projection) -> Dict[str, int]:
+        """Normalize a field list/dict projection; `_id` is excluded server-side unless asked for."""
+        if projection is None:
+            return {"_id": 0}
+        proj = dict(projection) if isinstance(projection, dict) else {f: 1 for f in projection}
+        proj.setdefault("_id", 0)
+        return proj
+
+    def iter_find(self, collection: str, filter: Optional[Dict[str, Any]] = None,
+                  projection: Optional[Iterable[str] | Dict[str, int]] = None,
+                  sort_field: Optional[str] = None, ascending: bool = True,
+                  limit: Optional[int] = None, batch_size: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        """Lazily yield documents matching `filter` (server-side), only the projected fields.
+
+        The cursor fetches `batch_size` documents per round trip; nothing is materialized.
+        """
+        if not self.available():
+            return
+        try:
+            cur = self._db[collection].find(filter or {}, self._projection(projection))
             if sort_field:
                 cur = cur.sort(sort_field, 1 if ascending else -1)
             if limit:
                 cur = cur.limit(int(limit))
-            return [self._strip_id(d) for d in cur]
-        except PyMongoError:
+            if batch_size:
+                cur = cur.batch_size(int(batch_size))
+            for d in cur:
+                yield d
+            self._note_ok()
+        except PyMongoError as e:
+            self._note_failure(e)
+
+    def find_all(self, collection: str, sort_field: Optional[str] = None, ascending: bool = True,
+                 limit: Optional[int] = None, filter: Optional[Dict[str, Any]] = None,
+                 projection: Optional[Iterable[str] | Dict[str, int]] = None,
+                 batch_size: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Find documents (all by default) with optional server-side filter, projection, sorting and limit."""
+        return list(self.iter_find(collection, filter=filter, projection=projection, sort_field=sort_field,
+                                   ascending=ascending, limit=limit, batch_size=batch_size))
+
+    # ---------- analytics (aggregation pipelines, computed server-side) ----------
+    def aggregate(self, collection: str, pipeline: List[Dict[str, Any]],
+                  batch_size: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Run an aggregation pipeline and return its (small) result list (stages project `_id` themselves)."""
+        if not self.available():
+            return []
+        try:
+            kwargs = {"allowDiskUse": True}
+            if batch_size:
+                kwargs["batchSize"] = int(batch_size)
+            out = list(self._db[collection].aggregate(pipeline, **kwargs))
+            self._note_ok()
+            return out
+        except PyMongoError as e:
+            self._note_failure(e)
             return []
 
-    def get_kv(self, collection: str, key: str) -> Optional[Dict[str, Any]]:
-        """Get a key-value pair from the specified collection."""
+    @staticmethod
+    def _match_stage(start: Optional[int], end: Optional[int], filter: Optional[Dict[str, Any]],
+                     time_field: str) -> Dict[str, Any]:
+        match = dict(filter or {})
+        cond = {}
+        if start is not None:
+            cond["$gte"] = start
+        if end is not None:
+            cond["$lte"] = end
+        if cond:
+            match[time_field] = cond
+        return {"$match": match}
+
+    def latest_before(self, collection: str, ts: int, filter: Optional[Dict[str, Any]] = None,
+                      fields: Optional[Iterable[str]] = None, time_field: str = "timestamp",
+                      tie_break_id: bool = False) -> Optional[Dict[str, Any]]:
+        """As-of lookup: newest document with `time_field` <= ts (served by a (…, time_field) index).
+
+        `tie_break_id` makes the last inserted of several docs with the same time win;
+        only needed where duplicates exist (time-series collections), since the extra
+        sort key keeps the index from covering the sort.
+        """
+        sort: Dict[str, int] = {time_field: -1, "_id": -1} if tie_break_id else {time_field: -1}
+        pipeline = [
+            self._match_stage(None, ts, filter, time_field),
+            {"$sort": sort},
+            {"$limit": 1},
+            {"$project": self._projection(fields)},
+        ]
+        docs = self.aggregate(collection, pipeline)
+        return docs[0] if docs else None
+
+    def bucket_series(self, collection: str, step: int, start: Optional[int] = None, end: Optional[int] = None,
+                      filter: Optional[Dict[str, Any]] = None, fields: Iterable[str] = ("value",),
+                      time_field: str = "timestamp", time_is_date: bool = False,
+                      dedupe_keys: Optional[Iterable[str]] = None) -> List[Dict[str, Any]]:
+        """Downsample a time range into `step`-second buckets on the server.
+
+        Epoch-second timestamps are truncated arithmetically (ts - ts % step, the
+        equivalent of $dateTrunc for UTC-aligned buckets); BSON dates
+        (`time_is_date`, e.g. time-series collections) use $dateTrunc and the bucket
+        start is returned as epoch seconds. Each bucket returns `timestamp` (bucket
+        start), `count` and per field the last value plus `<field>_min`,
+        `<field>_max` and `<field>_mean`, sorted by time. With `dedupe_keys` (e.g.
+        timestamp + coin) duplicate docs are collapsed first, the last inserted one
+        wins, so replayed inserts do not inflate `count` or the means.
+        """
+        if time_is_date:
+            bucket = {"$dateTrunc": {"date": f"${time_field}", "unit": "second", "binSize": int(step)}}
+            bucket_start: Any = {"$toLong": {"$divide": [{"$toLong": "$_id"}, 1000]}}
+        else:
+            bucket = {"$subtract": [f"${time_field}", {"$mod": [f"${time_field}", int(step)]}]}
+            bucket_start = "$_id"
+        group: Dict[str, Any] = {"_id": bucket, "count": {"$sum": 1}}
+        for f in fields:
+            group[f] = {"$last": f"${f}"}
+            group[f"{f}_min"] = {"$min": f"${f}"}
+            group[f"{f}_max"] = {"$max": f"${f}"}
+            group[f"{f}_mean"] = {"$avg": f"${f}"}
+        # _id only breaks ties for the dedupe ($last = last inserted); otherwise the index serves the sort
+        pipeline = [
+            self._match_stage(start, end, filter, time_field),
+            {"$sort": {time_field: 1, "_id": 1} if dedupe_keys else {time_field: 1}},
+        ]
+        if dedupe_keys:
+            keys = list(dedupe_keys)
+            unique: Dict[str, Any] = {"_id": {k: f"${k}" for k in keys}}
+            for f in {time_field, *fields}:
+                unique[f] = {"$last": f"${f}"}
+            pipeline += [{"$group": unique}, {"$sort": {time_field: 1}}]
+        pipeline += [
+            {"$group": group},
+            {"$sort": {"_id": 1}},
+            {"$addFields": {time_field: bucket_start}},
+            {"$project": {"_id": 0}},
+        ]
+        return self.aggregate(collection, pipeline)
+
+    # ---------- key-value (write-through cache for *_meta) ----------
+    @staticmethod
+    def _kv_cached(collection: str) -> bool:
+        return collection.endswith(KV_CACHED_SUFFIX)
+
+    def _kv_fetch(self, collection: str, key: str) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        """(ok, doc without _id) straight from Mongo."""
         if not self.available():
-            return None
+            return False, None
         try:
             doc = self._db[collection].find_one({"_id": key})
-            return self._strip_id(doc) if doc else None
-        except PyMongoError:
-            return None
+            self._note_ok()
+            return True, (self._strip_id(doc) if doc else None)
+        except PyMongoError as e:
+            self._note_failure(e)
+            return False, None
+
+    def get_kv(self, collection: str, key: str) -> Optional[Dict[str, Any]]:
+        """Get a key-value pair from the specified collection.
+
+        *_meta keys are served from memory after the first successful fetch (also while
+        the DB is down); this process's own writes are visible immediately.
+        """
+        if not self._kv_cached(collection):
+            return self._kv_fetch(collection, key)[1]
+        ck = (collection, key)
+        with self._kv_cond:
+            entry = self._kv_cache.get(ck)
+            if entry is not None:
+                self.kv_stats["hits"] += 1
+                return copy.deepcopy(entry[1])
+            self.kv_stats["misses"] += 1
+        ok, doc = self._kv_fetch(collection, key)
+        if ok:
+            with self._kv_cond:
+                # Không ghi đè một set_kv xảy ra trong lúc đang fetch
+                self._kv_cache.setdefault(ck, (0, doc))
+                doc = self._kv_cache[ck][1]
+        return copy.deepcopy(doc)
 
     def set_kv(self, collection: str, key: str, value: Dict[str, Any]) -> bool:
-        """Set a key-value pair in the specified collection."""
+        """Set a key-value pair in the specified collection ($set: fields are merged).
+
+        *_meta keys update the cache with a new version stamp and return at once; a
+        background writer sends the latest version of each dirty key to Mongo, in the
+        order keys were dirtied, retrying failed writes first (flushed at exit for up to
+        KV_EXIT_FLUSH_SEC). KV_SYNC_COLLECTIONS (user edits such as holdings) are written
+        before returning. Returns False, queuing nothing, when no MONGO_URI is configured.
+        """
+        if not self._mongo_uri:
+            return False
+        if not self._kv_cached(collection):
+            return self._kv_write(collection, key, value)
+        ck = (collection, key)
+        if collection in KV_SYNC_COLLECTIONS:
+            if not self._kv_write(collection, key, value):
+                return False
+            with self._kv_cond:
+                if ck in self._kv_cache:
+                    merged = {**(self._kv_cache[ck][1] or {}), **copy.deepcopy(dict(value))}
+                    merged.pop("_id", None)
+                    version = next(self._kv_versions)
+                    self._kv_cache[ck] = (version, merged)
+                    self._kv_written[ck] = version
+            return True
+        if ck not in self._kv_cache:
+            self.get_kv(collection, key)  # nạp bản hiện có để merge giống $set
+        with self._kv_cond:
+            old = self._kv_cache.get(ck, (0, None))[1] or {}
+            merged = {**old, **copy.deepcopy(dict(value))}
+            merged.pop("_id", None)
+            self._kv_cache[ck] = (next(self._kv_versions), merged)
+            if ck not in self._kv_dirty:
+                self._kv_dirty.append(ck)
+            self._kv_cond.notify_all()
+            if self._kv_writer is None or not self._kv_writer.is_alive():
+                self._kv_writer = threading.Thread(target=self._kv_write_loop, name="cloud-db-kv", daemon=True)
+                self._kv_writer.start()
+        return True
+
+    def _kv_write(self, collection: str, key: str, value: Dict[str, Any]) -> bool:
         if not self.available():
             return False
         try:
             doc = dict(value)
             doc["_id"] = key
             self._db[collection].update_one({"_id": key}, {"$set": doc}, upsert=True)
+            self._note_ok()
             return True
-        except PyMongoError:
+        except PyMongoError as e:
+            self._note_failure(e)
             return False
 
+    def _kv_write_loop(self) -> None:
+        while True:
+            with self._kv_cond:
+                while not self._kv_dirty:
+                    self._kv_cond.wait()
+                ck = self._kv_dirty.popleft()
+                version, value = self._kv_cache[ck]
+            if self._kv_write(ck[0], ck[1], value or {}):
+                with self._kv_cond:
+                    self.kv_stats["writes"] += 1
+                    self._kv_written[ck] = version
+                    self._kv_cond.notify_all()
+                continue
+            with self._kv_cond:
+                self.kv_stats["write_failures"] += 1
+                if ck not in self._kv_dirty:
+                    self._kv_dirty.appendleft(ck)
+            time.sleep(KV_RETRY_SEC)
+
+    def flush_kv(self, timeout: Optional[float] = None) -> bool:
+        """Wait until every cached KV write reached Mongo. False on timeout."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._kv_cond:
+            while self._kv_dirty or any(self._kv_written.get(ck, 0) < v
+                                        for ck, (v, _) in self._kv_cache.items() if v):
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._kv_cond.wait(remaining)
+        return True
+
+    def invalidate_kv(self, collection: Optional[str] = None) -> None:
+        """Drop clean cached entries (all, or one collection) so the next get_kv refetches."""
+        with self._kv_cond:
+            for ck in list(self._kv_cache):
+                version = self._kv_cache[ck][0]
+                if (collection is None or ck[0] == collection) and self._kv_written.get(ck, 0) >= version:
+                    del self._kv_cache[ck]
+
     @staticmethod
     def _strip_id(doc: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
         """Remove the '_id' field from a document."""
@@ -205,6 +757,8 @@ class CloudDB:
 
 # Singleton exposed for importers
 db = CloudDB()
+# The KV writer is a daemon thread: let queued checkpoint writes reach Mongo before exit
+atexit.register(db.flush_kv, KV_EXIT_FLUSH_SEC)
 
 __all__ = ["CloudDB", "db"]
 
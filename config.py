@@ -22,7 +22,35 @@ COIN_LIST = [
 
 DATA_FILE = "data.json"
 AVG_PRICE_FILE = "avg_price.json"
-HISTORY_FILE = "portfolio_history.json"
+HISTORY_FILE = "portfolio_history.json"  # legacy single-file history (imported once)
+HISTORY_DIR = "portfolio_history_segments"  # append-only NDJSON segments, one per UTC day
+HISTORY_PARQUET_DIR = "portfolio_history_parquet"  # columnar day/coin partitions of closed days
+HISTORY_BIN_FILE = "portfolio_history.bin"  # fixed-width records for the memmap backend
+HISTORY_DELTA_DIR = "portfolio_history_delta"  # day segments of delta-encoded frames
+HISTORY_BACKEND = "segments"  # "segments" (NDJSON + Parquet), "memmap" or "delta"
+PORTFOLIO_TS_COLLECTION = "portfolio_history_ts"  # native Mongo time-series copy of portfolio_history
+PORTFOLIO_TS_MODE = "off"  # "off" (plain collection), "dual" (write both, read TS up to the copy cursor) or "ts"
+HISTORY_RETENTION_STATE = "portfolio_history_retention.json"  # resolution already applied per day
+HISTORY_MINUTE_RETENTION_DAYS = 7  # full minute resolution
+HISTORY_HOURLY_RETENTION_DAYS = 90  # hourly points, older days keep one point per day
+HISTORY_RETENTION_INTERVAL_SEC = 6 * 3600  # how often the background retention job runs
+HISTORY_RETENTION_PRUNE_DB = True  # also delete downsampled-away docs from Cloud DB
+HISTORY_SYNC_STATE = "portfolio_history_sync.json"  # high-water marks of the incremental Cloud DB sync
+DB_QUEUE_FILE = "db_write_queue.sqlite3"  # durable queue of Cloud DB writes waiting for a retry
+SCANNER_LOG_MAX_BYTES = 1_000_000  # rotate <scanner>_whale_scanner.log at this size
+SCANNER_LOG_BACKUPS = 3  # rotated files kept per scanner
+SCANNER_LOG_RING_SIZE = 500  # recent records kept in memory per scanner
+SCANNER_LOG_SHIP_INTERVAL_SEC = 10  # background shipping of new records to <scanner>_logs
+SCANNER_LOG_SHIP_BATCH = 500
+SCANNER_LOG_TTL_DAYS = 14  # TTL index on <scanner>_logs.ts
+SOL_RPC_URL = "https://api.mainnet-beta.solana.com"
+SOL_RPC_BATCH_SIZE = 5  # getBlock calls per JSON-RPC batch POST (halved on 429, regrown on success)
+SOL_RPC_CONCURRENCY = 2  # batch POSTs in flight
+SOL_RPC_MAX_RETRIES = 5  # per batch, on 429 / network errors
+SOL_RPC_BACKOFF_MIN_SEC = 0.5  # first pause after a 429 (doubles per 429, decays on success)
+SOL_RPC_BACKOFF_MAX_SEC = 30
+SOL_PARSE_WORKERS = 1  # threads parsing fetched blocks
+SOL_PARSE_AUDIT_EVERY = 100  # also time the full instruction walk on every Nth block (measures the vote pre-filter)
 LAST_PRICE_FILE = "last_prices.json"
 
 # Health panel thresholds
@@ -1,8 +1,8 @@
 import json
 import os
 from cloud_db import db
+from history_sync import sync_portfolio_history
 
-PORTFOLIO_HISTORY_FILE = "portfolio_history.json"
 DATA_FILE = "data.json"
 AVG_PRICE_FILE = "avg_price.json"
 
@@ -29,14 +29,11 @@ def bootstrap_from_cloud():
                 changed = True
             except Exception:
                 pass
-        hist_docs = db.find_all("portfolio_history", sort_field="timestamp", ascending=True)
-        if hist_docs:
-            try:
-                with open(PORTFOLIO_HISTORY_FILE, 'w', encoding='utf-8') as f:
-                    json.dump(hist_docs, f)
+        try:
+            if sync_portfolio_history(db)["merged"]:
                 changed = True
-            except Exception:
-                pass
+        except Exception:
+            pass
         return changed, "Bootstrap thành công" if changed else "Không có thay đổi khi bootstrap"
     except Exception as e:
         return False, f"Lỗi bootstrap: {e}"
@@ -1,8 +1,23 @@
+import math
 import os
 import shutil
 import time
 import json
 
+import pandas as pd
+
+from config import HISTORY_BACKEND, DB_QUEUE_FILE, PORTFOLIO_TS_COLLECTION, PORTFOLIO_TS_MODE
+from db_write_queue import DurableWriteQueue
+from history_delta import DeltaEncoder, decode_frames, frame_to_mongo
+from history_retention import RESOLUTION_SECONDS
+from history_rollups import MIN_CHART_POINTS, ROLLUP_COLUMNS, TIERS, TIER_SECONDS
+import history_timeseries as ts_store
+
+PORTFOLIO_COLLECTION = "portfolio_history"
+PORTFOLIO_DELTA_COLLECTION = "portfolio_history_delta"
+_DELTA_KEYFRAME_SEC = 3600  # gửi lại đủ amount/avg_price/invested mỗi giờ
+_db_delta_encoder = DeltaEncoder(keyframe_interval=_DELTA_KEYFRAME_SEC)
+
 def validate_portfolio_docs(docs: list) -> list:
     required_keys = {"timestamp", "value"}
     valid_docs = []
@@ -18,43 +33,205 @@ def validate_portfolio_docs(docs: list) -> list:
         valid_docs.append(doc)
     return valid_docs
 
-_db_write_queue = []
+def _portfolio_db_payload(docs: list, keyframe: bool = False):
+    """(collection, docs, unique_keys) to upsert for snapshot docs.
+
+    In delta mode a minute becomes one frame doc (dotted $set keys so concurrent
+    writers merge); replays use a fresh encoder so every frame is self-contained.
+    """
+    if HISTORY_BACKEND == "delta":
+        encoder = DeltaEncoder() if keyframe else _db_delta_encoder
+        frames = [frame_to_mongo(f) for f in encoder.encode(docs)]
+        return PORTFOLIO_DELTA_COLLECTION, frames, ["timestamp"]
+    return PORTFOLIO_COLLECTION, docs, ["timestamp", "coin"]
+
+_PORTFOLIO_FIELDS = ["timestamp", "coin", "value", "invested", "PNL", "amount", "avg_price"]
+_DB_BATCH_SIZE = 2000
+
+def _time_filter(start=None, end=None) -> dict:
+    cond = {}
+    if start is not None:
+        cond["$gte"] = start
+    if end is not None:
+        cond["$lte"] = end
+    return {"timestamp": cond} if cond else {}
+
+def iter_portfolio_history_from_db(db, start=None, end=None, coin=None):
+    """Stream docs lịch sử portfolio từ DB (lọc thời gian/coin phía server, giải mã frame nếu delta).
+
+    coin: None = tất cả, "__total__" = chỉ tổng, còn lại = coin id.
+    """
+    if HISTORY_BACKEND == "delta":
+        # Frame chỉ giải mã được từ đầu ngày UTC (statics/tổng dựa vào các frame trước trong ngày):
+        # đọc từ 00:00 của ngày chứa start rồi bỏ các doc trước start
+        day_lo = None if start is None else int(start) - int(start) % 86400
+        frames = db.iter_find(PORTFOLIO_DELTA_COLLECTION, filter=_time_filter(day_lo, end), sort_field="timestamp",
+                              ascending=True, batch_size=_DB_BATCH_SIZE)
+        for d in decode_frames(frames):
+            if start is not None and d["timestamp"] < start:
+                continue
+            if coin is None or (d.get("coin") or "__total__") == coin:
+                yield d
+        return
+    # Dual-read: phần đã copy sang time-series đọc từ đó, phần còn lại từ collection cũ
+    boundary = ts_store.read_boundary(db)
+    if boundary is not None and (start is None or start <= boundary):
+        ts_end = end if boundary == math.inf else (boundary if end is None else min(end, boundary))
+        yield from ts_store.iter_docs(db, start, ts_end, coin, fields=_PORTFOLIO_FIELDS, batch_size=_DB_BATCH_SIZE)
+        if boundary == math.inf or (end is not None and end <= boundary):
+            return
+        start = int(boundary) + 1
+    query = _time_filter(start, end)
+    if coin == "__total__":
+        query["coin"] = {"$exists": False}
+    elif coin is not None:
+        query["coin"] = coin
+    yield from db.iter_find(PORTFOLIO_COLLECTION, filter=query, projection=_PORTFOLIO_FIELDS,
+                            sort_field="timestamp", ascending=True, batch_size=_DB_BATCH_SIZE)
+
+def fetch_portfolio_history_from_db(db, start=None, end=None) -> list:
+    """Lịch sử portfolio từ DB dưới dạng docs (mặc định toàn bộ; giải mã frame nếu delta)."""
+    return list(iter_portfolio_history_from_db(db, start, end))
+
+def latest_portfolio_timestamp_in_db(db):
+    """Timestamp mới nhất của lịch sử portfolio trên DB (None nếu trống)."""
+    collection = PORTFOLIO_DELTA_COLLECTION if HISTORY_BACKEND == "delta" else PORTFOLIO_COLLECTION
+    if _reads_timeseries(db):
+        collection = PORTFOLIO_TS_COLLECTION
+    docs = db.find_all(collection, sort_field="timestamp", ascending=False, limit=1, projection=["timestamp"])
+    return ts_store.from_date(docs[0]["timestamp"]) if docs and docs[0].get("timestamp") is not None else None
+
+def fetch_recent_portfolio_docs(db, limit: int = 250, fields=None) -> list:
+    """Các docs lịch sử mới nhất (timestamp giảm dần); `fields` giới hạn field trả về."""
+    if HISTORY_BACKEND == "delta":
+        # Lấy đủ frame để chắc chắn có một keyframe (statics đầy đủ)
+        n_frames = max(limit // 16, _DELTA_KEYFRAME_SEC // 60 + 30)
+        frames = db.find_all(PORTFOLIO_DELTA_COLLECTION, sort_field="timestamp", ascending=False, limit=n_frames)
+        docs = list(decode_frames(reversed(frames)))
+        docs.reverse()
+        return docs[:limit]
+    if _reads_timeseries(db):
+        docs = db.find_all(PORTFOLIO_TS_COLLECTION, sort_field="timestamp", ascending=False, limit=limit,
+                           projection=fields or _PORTFOLIO_FIELDS)
+        return [ts_store.from_ts_doc(d) for d in docs]
+    return db.find_all(PORTFOLIO_COLLECTION, sort_field="timestamp", ascending=False, limit=limit,
+                       projection=fields or _PORTFOLIO_FIELDS)
+
+def _reads_timeseries(db) -> bool:
+    """True khi toàn bộ lịch sử đọc được từ collection time-series (mode "ts" hoặc đã copy xong)."""
+    return HISTORY_BACKEND != "delta" and ts_store.read_boundary(db) == math.inf
+
+def _series_filter(coin: str) -> dict:
+    return {"coin": {"$exists": False}} if coin == "__total__" else {"coin": coin}
+
+def db_portfolio_as_of(db, ts: int, coin: str = "__total__", fields=("timestamp", "value", "PNL", "invested")):
+    """Doc mới nhất của một chuỗi (tổng hoặc coin) tại/trước ts, tính trên Mongo (None nếu không có).
+
+    Chỉ hỗ trợ collection dạng doc; backend delta trả None để UI dùng dữ liệu local.
+    """
+    if HISTORY_BACKEND == "delta":
+        return None
+    if _reads_timeseries(db):
+        # Time-series không có index unique: trùng timestamp thì lấy bản chèn sau cùng
+        doc = db.latest_before(PORTFOLIO_TS_COLLECTION, ts_store.to_date(ts), filter={"coin": coin}, fields=list(fields),
+                               tie_break_id=True)
+        return ts_store.from_ts_doc(doc) if doc else None
+    return db.latest_before(PORTFOLIO_COLLECTION, int(ts), filter=_series_filter(coin), fields=list(fields))
+
+def db_portfolio_chart_series(db, start=None, end=None, coin: str = "__total__", min_points: int = MIN_CHART_POINTS):
+    """(tier, DataFrame) giống `read_chart_series` nhưng bucket hóa trên Mongo (vài trăm điểm).
+
+    Trả (None, DataFrame rỗng) nếu backend delta, DB lỗi hoặc không có dữ liệu.
+    """
+    empty = pd.DataFrame(columns=ROLLUP_COLUMNS)
+    if HISTORY_BACKEND == "delta":
+        return None, empty
+    on_ts = _reads_timeseries(db)
+    collection = PORTFOLIO_TS_COLLECTION if on_ts else PORTFOLIO_COLLECTION
+    series = {"coin": coin} if on_ts else _series_filter(coin)
+    now = int(time.time())
+    first = start
+    if first is None:
+        docs = db.find_all(collection, sort_field="timestamp", ascending=True, limit=1,
+                           filter=series, projection=["timestamp"])
+        if not docs:
+            return None, empty
+        first = ts_store.from_date(docs[0]["timestamp"])
+    window = (end or now) - first
+    # Tier thô nhất vẫn cho >= min_points điểm (không bị giới hạn retention như rollup local)
+    tier = next((name for name, step in reversed(TIERS) if window / step >= min_points), TIERS[0][0])
+    # Time-series không có index unique (replay/dual-write chèn trùng), collection cũ có thể đang dùng index thường
+    if on_ts:
+        rows = db.bucket_series(collection, TIER_SECONDS[tier], filter=ts_store.ts_filter(start, end, coin),
+                                fields=["value", "PNL", "invested"], time_is_date=True, dedupe_keys=["timestamp", "coin"])
+    else:
+        rows = db.bucket_series(collection, TIER_SECONDS[tier], start=start, end=end,
+                                filter=series, fields=["value", "PNL", "invested"], dedupe_keys=["timestamp", "coin"])
+    if not rows:
+        return None, empty
+    return tier, pd.DataFrame(rows).reindex(columns=ROLLUP_COLUMNS)
+
+# Queue ghi lỗi bền vững trên đĩa (SQLite WAL), gộp theo (collection, key): mỗi (timestamp, coin) chỉ giữ bản ghi mới nhất
+_db_write_queue = DurableWriteQueue(DB_QUEUE_FILE)
 _db_last_retry = 0
 _db_retry_interval = 30  # giây
 _db_backoff_multiplier = 2
 _db_max_retry_interval = 600  # 10 phút
 _db_consecutive_failures = 0
-_DB_QUEUE_MAX = 5000  # tránh nở vô hạn bộ nhớ
+_DB_DRAIN_MAX = 50000  # số doc tối đa đọc từ queue cho một lần bulk upsert khi retry
+_DB_POISON_ATTEMPTS = 5  # doc bị DB từ chối riêng lẻ chừng này lần thì bỏ khỏi queue
+_DB_SPLIT_MAX_CALLS = 200  # số lần upsert tối đa khi chia đôi batch lỗi trong một lần retry
 
 def get_db_queue_info():
     """Return dict with queue diagnostics for health panel."""
-    next_retry_in = max(0, int(_db_retry_interval - (time.time() - _db_last_retry))) if _db_write_queue else 0
+    try:
+        qstats = _db_write_queue.stats()
+    except Exception:
+        qstats = {"length": 0, "oldest_age": 0, "max_attempts": 0, "coalesced": 0, "dropped": 0}
+    next_retry_in = max(0, int(_db_retry_interval - (time.time() - _db_last_retry))) if qstats["length"] else 0
     return {
-        "queue_length": len(_db_write_queue),
+        "queue_length": qstats["length"],
+        "oldest_age": qstats["oldest_age"],
+        "max_attempts": qstats["max_attempts"],
+        "coalesced": qstats["coalesced"],
+        "dropped": qstats["dropped"],
         "consecutive_failures": _db_consecutive_failures,
         "retry_interval": _db_retry_interval,
         "next_retry_in": next_retry_in,
     }
 
+def _upsert_or_raise(db, docs: list, keyframe: bool = False):
+    collection, payload, unique_keys = _portfolio_db_payload(docs, keyframe=keyframe)
+    to_timeseries = collection == PORTFOLIO_COLLECTION and ts_store.writes_enabled()
+    if not (to_timeseries and PORTFOLIO_TS_MODE == "ts"):
+        db.upsert_many(collection, payload, unique_keys=unique_keys)
+        if any(b.get("failed") for b in getattr(db, "last_upsert_stats", [])):
+            raise Exception(db.last_error() or "bulk upsert failed")
+    # Time-series không có upsert theo key: insert thường, đọc sẽ bỏ bản trùng
+    if to_timeseries and ts_store.insert_docs(db, payload):
+        raise Exception(db.last_error() or "time-series insert failed")
+
 def db_upsert_portfolio_docs_with_retry(db, docs: list):
     docs = validate_portfolio_docs(docs)
     if not docs:
         return
-    global _db_write_queue, _db_last_retry, _db_consecutive_failures, _db_retry_interval
+    global _db_last_retry, _db_consecutive_failures, _db_retry_interval
     try:
         if db.available():
-            db.upsert_many("portfolio_history", docs, unique_keys=["timestamp", "coin"])
+            _upsert_or_raise(db, docs)
             _db_consecutive_failures = 0
             _db_retry_interval = 30
             return
         else:
             raise Exception("DB not available")
     except Exception as e:
-        # Giới hạn độ dài queue
-        if len(_db_write_queue) >= _DB_QUEUE_MAX:
-            # Bỏ bớt bản ghi cũ nhất (FIFO) để tránh tràn bộ nhớ
-            _db_write_queue.pop(0)
-        _db_write_queue.append((time.time(), docs))
+        # Encoder đã coi statics của lần ghi lỗi là đã gửi: reset để frame kế tiếp là keyframe
+        _db_delta_encoder.reset()
+        try:
+            # Lưu docs gốc theo key (timestamp, coin); payload delta được mã hóa lại khi replay
+            _db_write_queue.enqueue(docs, PORTFOLIO_COLLECTION, ("timestamp", "coin"))
+        except Exception as qe:
+            print(f"[DB] Không ghi được vào queue trên đĩa: {qe}")
         _db_consecutive_failures += 1
         # Tăng backoff nhưng không vượt quá max
         _db_retry_interval = min(_db_retry_interval * _db_backoff_multiplier, _db_max_retry_interval)
@@ -62,30 +239,112 @@ def db_upsert_portfolio_docs_with_retry(db, docs: list):
             print(f"[DB] Lỗi ghi (x{_db_consecutive_failures}), queue={len(_db_write_queue)}, next retry interval={_db_retry_interval}s: {e}")
 
 def db_retry_queue(db):
-    global _db_write_queue, _db_last_retry, _db_consecutive_failures, _db_retry_interval
+    global _db_last_retry, _db_consecutive_failures, _db_retry_interval
     now = time.time()
-    if not _db_write_queue:
+    if not len(_db_write_queue):
         return
     if not db.available():
         return
     if now - _db_last_retry <= _db_retry_interval:
         return
-    # Retry theo batch nhỏ để tránh tạo áp lực
-    batch = list(_db_write_queue)[:50]
+    _db_last_retry = now
+    # Mỗi collection một lần bulk upsert đã khử trùng lặp; chỉ xóa khỏi queue khi ghi thành công
     success_any = False
-    for ts, docs in batch:
-        try:
-            db.upsert_many("portfolio_history", docs, unique_keys=["timestamp", "coin"])
-            _db_write_queue.remove((ts, docs))
+    for collection in _db_write_queue.collections():
+        while True:
+            keys, docs = _db_write_queue.peek(collection, _DB_DRAIN_MAX)
+            if not keys:
+                break
+            order = sorted(range(len(docs)), key=lambda i: (docs[i].get("timestamp") or 0, docs[i].get("coin") or ""))
+            keys, docs = [keys[i] for i in order], [docs[i] for i in order]
+            try:
+                _upsert_or_raise(db, docs, keyframe=True)
+            except Exception as e:
+                print(f"[DB] Retry ghi thất bại {collection} ({len(keys)} doc): {e}")
+                if not _replay_split(db, collection, keys, docs, str(e)):
+                    return
+                # Phần tốt đã ghi; doc bị từ chối chờ lần retry sau
+                success_any = True
+                break
+            _db_write_queue.ack(collection, keys)
             success_any = True
-        except Exception as e:
-            print(f"[DB] Retry ghi thất bại batch item: {e}")
-            break
-    _db_last_retry = now
     if success_any:
         _db_consecutive_failures = 0
         _db_retry_interval = 30
-        print(f"[DB] Retry thành công một batch, queue còn {len(_db_write_queue)}")
+        print(f"[DB] Retry thành công, queue còn {len(_db_write_queue)}")
+
+def _upsert_partly_failed(db) -> bool:
+    """Lần upsert vừa rồi có op ghi được không (DB nhận ghi, chỉ từ chối vài doc)."""
+    stats = getattr(db, "last_upsert_stats", None) or []
+    return sum(b.get("failed", 0) for b in stats) < sum(b.get("ops", 0) for b in stats)
+
+def _replay_split(db, collection: str, keys: list, docs: list, error: str) -> bool:
+    """Batch replay bị lỗi: chia đôi để ghi phần tốt và cô lập doc hỏng.
+
+    Chỉ chia khi DB còn nhận ghi (batch bị từ chối một phần). Doc bị từ chối riêng lẻ được
+    đếm lần thử và bỏ sau _DB_POISON_ATTEMPTS lần, để một doc hỏng không chặn cả queue;
+    khi DB mất kết nối các doc được giữ nguyên cho lần retry sau. Trả True nếu có phần ghi được.
+    """
+    if not db.available() or (len(keys) > 1 and not _upsert_partly_failed(db)):
+        _db_write_queue.fail(collection, keys, error)
+        return False
+    calls = 0
+    written = False
+    stack = [(keys, docs, error)]
+    while stack:
+        k, d, err = stack.pop()
+        if len(k) == 1:
+            if not db.available():
+                _db_write_queue.fail(collection, k, err)
+            elif _db_write_queue.fail(collection, k, err, max_attempts=_DB_POISON_ATTEMPTS):
+                print(f"[DB] Bỏ doc {collection} {k[0]} sau {_DB_POISON_ATTEMPTS} lần bị từ chối: {err}")
+            continue
+        if calls >= _DB_SPLIT_MAX_CALLS or not db.available():
+            _db_write_queue.fail(collection, k, err)
+            continue
+        mid = len(k) // 2
+        for hk, hd in ((k[mid:], d[mid:]), (k[:mid], d[:mid])):
+            calls += 1
+            try:
+                _upsert_or_raise(db, hd, keyframe=True)
+            except Exception as e:
+                stack.append((hk, hd, str(e)))
+                continue
+            _db_write_queue.ack(collection, hk)
+            written = True
+    return written
+
+_PRUNE_OR_CHUNK = 500  # số bucket tối đa trong một $or của delete_many
+
+def prune_portfolio_history_db(db, retention: dict) -> int:
+    """Xóa khỏi Cloud DB các bản ghi đã bị downsample ở local (history_retention).
+
+    `retention`: {day: {"resolution", "buckets": {series: [[bucket_start, kept_ts], ...]}}}.
+    Chỉ xóa trong các (bucket, series) mà local thực sự đã gộp, trừ timestamp được giữ;
+    dữ liệu cloud ở bucket/series local không có (mất dữ liệu, instance khác) không bị đụng.
+    Backend delta không prune: frame phụ thuộc keyframe/statics của frame trước.
+    """
+    if not retention or HISTORY_BACKEND == "delta" or not db.available():
+        return 0
+    to_ts = ts_store.writes_enabled()
+    removed = 0
+    for day, info in retention.items():
+        step = RESOLUTION_SECONDS.get(info.get("resolution"))
+        buckets = info.get("buckets") or {}
+        if not step or not buckets:
+            continue
+        for series, pairs in buckets.items():
+            for i in range(0, len(pairs), _PRUNE_OR_CHUNK):
+                chunk = pairs[i:i + _PRUNE_OR_CHUNK]
+                ranges = [{"timestamp": {"$gte": lo, "$lt": lo + step, "$ne": kept}} for lo, kept in chunk]
+                removed += db.delete_many(PORTFOLIO_COLLECTION, {**_series_filter(series), "$or": ranges})
+                if to_ts:
+                    ts_ranges = [{"timestamp": {"$gte": ts_store.to_date(lo), "$lt": ts_store.to_date(lo + step),
+                                                "$ne": ts_store.to_date(kept)}} for lo, kept in chunk]
+                    removed += db.delete_many(PORTFOLIO_TS_COLLECTION, {"coin": series, "$or": ts_ranges})
+    if removed:
+        print(f"[DB] Retention: đã xóa {removed} bản ghi portfolio_history")
+    return removed
 
 def save_portfolio_history_optimized(history, file_path="portfolio_history.json"):
     old = []
@@ -95,7 +354,14 @@ def save_portfolio_history_optimized(history, file_path="portfolio_history.json"
                 old = json.load(f)
         except Exception:
             old = []
-    new_entries = [h for h in history if h not in old]
+    # Dedupe theo key (timestamp, coin) bằng set: O(n + m) thay vì so sánh list O(n·m)
+    old_keys = {(h.get("timestamp"), h.get("coin")) for h in old if isinstance(h, dict)}
+    new_entries = []
+    for h in history:
+        k = (h.get("timestamp"), h.get("coin"))
+        if k not in old_keys:
+            old_keys.add(k)
+            new_entries.append(h)
     if new_entries:
         all_entries = old + new_entries
         with open(file_path, "w") as f:
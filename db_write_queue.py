@@ -0,0 +1,197 @@
+"""
+Durable, key-coalescing queue for Cloud DB writes that failed.
+
+Pending docs live in a SQLite database in WAL mode, one row per
+(collection, unique key) – e.g. (portfolio_history, [timestamp, coin]):
+  - `enqueue` upserts rows, so the overlapping snapshots sent by the UI and the
+    background recorder during an outage collapse into one pending doc per key
+    (last write wins, the first enqueue time and attempt count are kept),
+  - `peek(collection, n)` reads pending docs of one collection for a bulk replay,
+  - `ack` deletes rows once the upsert succeeded, `fail` bumps their attempt count
+    (and with `max_attempts` drops rows rejected that many times).
+Rows survive restarts and are only removed after a successful write or when the
+caller gives up on them; the replay upserts by the same unique key, so sending a
+doc twice is harmless.
+"""
+from __future__ import annotations
+
+import json
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pending (
+    collection TEXT NOT NULL,
+    key TEXT NOT NULL,
+    doc TEXT NOT NULL,
+    enqueued REAL NOT NULL,
+    updated REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    PRIMARY KEY (collection, key)
+)
+"""
+# peek() reads one collection oldest first
+_ORDER_INDEX = "CREATE INDEX IF NOT EXISTS pending_order ON pending (collection, enqueued, key)"
+
+
+def _key_of(doc: Dict, unique_keys: Sequence[str]) -> str:
+    return json.dumps([doc.get(k) for k in unique_keys], separators=(",", ":"))
+
+
+class DurableWriteQueue:
+    """SQLite (WAL) table of pending docs keyed by (collection, unique key)."""
+
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._length = 0
+        self._coalesced = 0
+        self._dropped = 0
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self._path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(_SCHEMA)
+            conn.execute(_ORDER_INDEX)
+            self._conn = conn
+            self._migrate_fifo()
+            self._length = conn.execute("SELECT COUNT(*) FROM pending").fetchone()[0]
+        return self._conn
+
+    def _migrate_fifo(self) -> None:
+        """Fold entries of the older FIFO table (one row per failed call) into `pending`."""
+        conn = self._conn
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='queue'").fetchone():
+            return
+        rows = conn.execute("SELECT enqueued, payload FROM queue ORDER BY id").fetchall()
+        conn.execute("BEGIN")
+        for enqueued, payload in rows:
+            try:
+                docs = json.loads(payload)
+            except ValueError:
+                continue
+            self._upsert_rows(conn, "portfolio_history", docs, ("timestamp", "coin"), enqueued)
+        conn.execute("DROP TABLE queue")
+        conn.execute("COMMIT")
+
+    def _upsert_rows(self, conn: sqlite3.Connection, collection: str, docs: Iterable[Dict],
+                     unique_keys: Sequence[str], now: float) -> int:
+        added = 0
+        for d in docs:
+            key = _key_of(d, unique_keys)
+            body = json.dumps(d, separators=(",", ":"))
+            cur = conn.execute(
+                "UPDATE pending SET doc = ?, updated = ? WHERE collection = ? AND key = ?",
+                (body, now, collection, key),
+            )
+            if cur.rowcount:
+                self._coalesced += 1
+                continue
+            conn.execute(
+                "INSERT INTO pending (collection, key, doc, enqueued, updated) VALUES (?, ?, ?, ?, ?)",
+                (collection, key, body, now, now),
+            )
+            added += 1
+        return added
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._db()
+            return self._length
+
+    def enqueue(self, docs: List[Dict], collection: str,
+                unique_keys: Sequence[str] = ("timestamp", "coin")) -> int:
+        """Add or overwrite pending docs. Returns the number of new keys."""
+        if not docs:
+            return 0
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN")
+            added = self._upsert_rows(db, collection, docs, unique_keys, time.time())
+            db.execute("COMMIT")
+            self._length += added
+            return added
+
+    def collections(self) -> List[str]:
+        with self._lock:
+            return [r[0] for r in self._db().execute("SELECT DISTINCT collection FROM pending ORDER BY collection")]
+
+    def peek(self, collection: str, limit: int) -> Tuple[List[str], List[Dict]]:
+        """(keys, docs) of up to `limit` pending docs of a collection, oldest first."""
+        with self._lock:
+            rows = self._db().execute(
+                "SELECT key, doc FROM pending WHERE collection = ? ORDER BY enqueued, key LIMIT ?",
+                (collection, int(limit)),
+            ).fetchall()
+        keys: List[str] = []
+        docs: List[Dict] = []
+        for key, body in rows:
+            try:
+                docs.append(json.loads(body))
+            except ValueError:
+                continue
+            keys.append(key)
+        return keys, docs
+
+    def ack(self, collection: str, keys: Iterable[str]) -> None:
+        keys = list(keys)
+        if not keys:
+            return
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN")
+            removed = 0
+            for key in keys:
+                removed += db.execute("DELETE FROM pending WHERE collection = ? AND key = ?", (collection, key)).rowcount
+            db.execute("COMMIT")
+            self._length -= removed
+
+    def fail(self, collection: str, keys: Iterable[str], error: str = "",
+             max_attempts: Optional[int] = None) -> int:
+        """Bump the attempt count of `keys`; with `max_attempts`, drop rows that reached it.
+
+        Returns the number of rows dropped.
+        """
+        keys = list(keys)
+        if not keys:
+            return 0
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN")
+            dropped = 0
+            for key in keys:
+                db.execute(
+                    "UPDATE pending SET attempts = attempts + 1, last_error = ? WHERE collection = ? AND key = ?",
+                    (error[:300], collection, key),
+                )
+                if max_attempts is not None:
+                    dropped += db.execute(
+                        "DELETE FROM pending WHERE collection = ? AND key = ? AND attempts >= ?",
+                        (collection, key, int(max_attempts)),
+                    ).rowcount
+            db.execute("COMMIT")
+            self._length -= dropped
+            self._dropped += dropped
+            return dropped
+
+    def stats(self) -> Dict[str, int]:
+        """Pending docs, age of the oldest (s), highest attempt count, writes coalesced, docs dropped."""
+        with self._lock:
+            db = self._db()
+            oldest, max_attempts = db.execute("SELECT MIN(enqueued), MAX(attempts) FROM pending").fetchone()
+            return {
+                "length": self._length,
+                "oldest_age": int(time.time() - oldest) if oldest else 0,
+                "max_attempts": int(max_attempts or 0),
+                "coalesced": self._coalesced,
+                "dropped": self._dropped,
+            }
+
+
+__all__ = ["DurableWriteQueue"]
@@ -0,0 +1,221 @@
+"""
+Delta-encoded portfolio snapshots.
+
+One frame replaces the 1 total + N per-coin docs recorded for a timestamp:
+  {"timestamp": ts,
+   "v": {coin: value, ...},                        # per-minute value vector
+   "s": {coin: [amount, avg_price, invested]},     # only coins whose static fields changed
+   "T": 1 | [value, PNL]}                          # total doc: 1 = derived on read
+`PNL` of a coin is value - invested, the total is derived from the coin rows
+unless it differs from them (then it is stored explicitly), so decoding gives
+back what the charts showed before. Static fields are carried by the decoder
+state; every UTC day (and every `keyframe_interval` seconds if set) starts from
+an empty state, so each day segment decodes on its own.
+
+HISTORY_BACKEND = "delta" stores these frames in day segments (DeltaHistoryStore);
+db_utils uses the same encoder for the Mongo `portfolio_history_delta` collection.
+"""
+from __future__ import annotations
+
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from history_store import SegmentedHistoryStore, day_of
+
+StaticFields = Tuple[Optional[float], Optional[float], Optional[float]]
+
+_REL_TOL = 1e-9
+
+
+def _static_of(doc: Dict) -> StaticFields:
+    return (doc.get("amount"), doc.get("avg_price"), doc.get("invested"))
+
+
+def _close(a: Optional[float], b: Optional[float]) -> bool:
+    if a is None or b is None:
+        return a is b
+    return abs(a - b) <= _REL_TOL * max(1.0, abs(a), abs(b))
+
+
+class DeltaEncoder:
+    """Stateful encoder: remembers the static fields last written per coin."""
+
+    def __init__(self, keyframe_interval: Optional[int] = None) -> None:
+        self._keyframe_interval = keyframe_interval
+        self._state: Dict[str, StaticFields] = {}
+        self._day: Optional[str] = None
+        self._last_keyframe = 0
+
+    def prime(self, day: str, state: Dict[str, StaticFields], last_ts: int = 0) -> None:
+        """Continue an existing segment: static fields already written for `day`."""
+        self._day = day
+        self._state = dict(state)
+        self._last_keyframe = last_ts
+
+    def reset(self) -> None:
+        """Forget the written state; the next frame is a keyframe (call when a write failed)."""
+        self._day = None
+        self._state = {}
+        self._last_keyframe = 0
+
+    def encode(self, docs: Iterable[Dict]) -> List[Dict]:
+        """Encode snapshot docs into one frame per timestamp (ascending)."""
+        groups: Dict[int, List[Dict]] = {}
+        for d in docs:
+            ts = d.get("timestamp")
+            if ts is None:
+                continue
+            groups.setdefault(int(ts), []).append(d)
+        frames = []
+        for ts in sorted(groups):
+            day = day_of(ts)
+            if day != self._day or (
+                self._keyframe_interval and ts - self._last_keyframe >= self._keyframe_interval
+            ):
+                self._day = day
+                self._state = {}
+                self._last_keyframe = ts
+            frame: Dict = {"timestamp": ts, "v": {}}
+            statics: Dict[str, List] = {}
+            total = None
+            for d in groups[ts]:
+                coin = d.get("coin")
+                if coin is None:
+                    total = d
+                    continue
+                frame["v"][coin] = d.get("value")
+                st = _static_of(d)
+                if self._state.get(coin) != st:
+                    statics[coin] = list(st)
+                    self._state[coin] = st
+            if statics:
+                frame["s"] = statics
+            if total is not None:
+                derived = _derive_total(frame["v"], self._state)
+                if derived is not None and _close(derived[0], total.get("value")) and _close(derived[1], total.get("PNL")):
+                    frame["T"] = 1
+                else:
+                    frame["T"] = [total.get("value"), total.get("PNL")]
+            frames.append(frame)
+        return frames
+
+
+def _derive_total(values: Dict[str, Optional[float]], state: Dict[str, StaticFields]) -> Optional[Tuple[float, float]]:
+    if not values:
+        return None
+    value = 0.0
+    invested = 0.0
+    for coin, v in values.items():
+        inv = state.get(coin, (None, None, None))[2]
+        if v is None or inv is None:
+            return None
+        value += v
+        invested += inv
+    return value, value - invested
+
+
+def decode_frames(frames: Iterable[Dict], state: Optional[Dict[str, StaticFields]] = None) -> Iterator[Dict]:
+    """Expand frames back into history docs; `state` (if given) is updated in place.
+
+    Frames must be fed in write order, starting at a day/keyframe boundary.
+    """
+    state = {} if state is None else state
+    day = None
+    for f in frames:
+        ts = f.get("timestamp")
+        if ts is None:
+            continue
+        # A new day starts from an empty state (the encoder re-sends statics)
+        d_ = day_of(ts)
+        if d_ != day:
+            if day is not None:
+                state.clear()
+            day = d_
+        for coin, st in (f.get("s") or {}).items():
+            state[coin] = tuple(st)
+        values = f.get("v") or {}
+        t = f.get("T")
+        if t == 1:
+            derived = _derive_total(values, state)
+            if derived is not None:
+                yield {"timestamp": ts, "value": derived[0], "PNL": derived[1]}
+        elif isinstance(t, list):
+            yield {"timestamp": ts, "value": t[0], "PNL": t[1]}
+        for coin, v in values.items():
+            amount, avg_price, invested = state.get(coin, (None, None, None))
+            doc = {"timestamp": ts, "coin": coin, "value": v, "invested": invested}
+            doc["PNL"] = (v - invested) if (v is not None and invested is not None) else None
+            doc["amount"] = amount
+            doc["avg_price"] = avg_price
+            yield doc
+
+
+def frame_to_mongo(frame: Dict) -> Dict:
+    """Flatten a frame into dotted $set keys so concurrent writers of a minute merge."""
+    doc: Dict = {"timestamp": frame["timestamp"]}
+    for coin, v in frame.get("v", {}).items():
+        doc[f"v.{coin}"] = v
+    for coin, st in frame.get("s", {}).items():
+        doc[f"s.{coin}"] = st
+    if "T" in frame:
+        doc["T"] = frame["T"]
+    return doc
+
+
+class DeltaHistoryStore(SegmentedHistoryStore):
+    """Day segments of delta frames; reads and dedup see plain history docs."""
+
+    def __init__(self, base_dir: str, seed: Optional[Callable[[], Iterable[Dict]]] = None) -> None:
+        super().__init__(base_dir, legacy_file=None)
+        self._seed = seed
+        self._encoders: Dict[str, DeltaEncoder] = {}
+
+    def _migrate_legacy(self) -> None:
+        if self._seed:
+            self._write_segments(list(self._seed()))
+
+    def _iter_frames(self, day: str) -> Iterator[Dict]:
+        yield from super()._iter_segment(day)
+
+    def _iter_segment(self, day: str) -> Iterator[Dict]:
+        yield from decode_frames(self._iter_frames(day))
+
+    def _encoder_for(self, day: str) -> DeltaEncoder:
+        enc = self._encoders.get(day)
+        if enc is None:
+            enc = DeltaEncoder()
+            state: Dict[str, StaticFields] = {}
+            for _ in decode_frames(self._iter_frames(day), state):
+                pass
+            enc.prime(day, state)
+            self._encoders[day] = enc
+        return enc
+
+    def _write_segments(self, docs: Iterable[Dict]) -> None:
+        by_day: Dict[str, List[Dict]] = {}
+        for d in docs:
+            ts = d.get("timestamp")
+            if ts is None:
+                continue
+            by_day.setdefault(day_of(ts), []).append(d)
+        for day, day_docs in by_day.items():
+            frames = self._encoder_for(day).encode(day_docs)
+            try:
+                super()._write_segments(frames)
+            except Exception:
+                # The encoder already counts these statics as written: re-prime from disk next time
+                self._encoders.pop(day, None)
+                raise
+
+    def _rewrite_segment(self, day: str, docs: List[Dict]) -> int:
+        enc = DeltaEncoder()
+        size = super()._rewrite_segment(day, enc.encode(docs))
+        self._encoders[day] = enc
+        return size
+
+    def replace_all(self, docs: List[Dict]) -> None:
+        with self._lock:
+            self._encoders.clear()
+            super().replace_all(docs)
+
+
+__all__ = ["DeltaEncoder", "DeltaHistoryStore", "decode_frames", "frame_to_mongo"]
@@ -0,0 +1,68 @@
+"""
+Per-series index over loaded portfolio history.
+
+Docs are bucketed once by series (TOTAL_COIN for portfolio totals, otherwise the
+coin id) and new snapshots are appended to their bucket, so reading one coin's
+history is a dict lookup instead of a scan over every document. A typed,
+timestamp-sorted DataFrame per series is materialized lazily and cached until
+that series receives new docs.
+"""
+from __future__ import annotations
+
+import threading
+from typing import Dict, Iterable, List
+
+import pandas as pd
+
+from history_parquet import TOTAL_COIN, docs_to_frame
+
+
+def series_of(doc: Dict) -> str:
+    return doc.get("coin") or TOTAL_COIN
+
+
+class HistoryIndex:
+    """series -> docs (append order) plus cached DataFrames."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._series: Dict[str, List[Dict]] = {}
+        self._frames: Dict[str, pd.DataFrame] = {}
+
+    def rebuild(self, docs: Iterable[Dict]) -> None:
+        series: Dict[str, List[Dict]] = {}
+        for d in docs:
+            series.setdefault(series_of(d), []).append(d)
+        with self._lock:
+            self._series = series
+            self._frames = {}
+
+    def add(self, docs: Iterable[Dict]) -> None:
+        with self._lock:
+            for d in docs:
+                s = series_of(d)
+                self._series.setdefault(s, []).append(d)
+                self._frames.pop(s, None)
+
+    def names(self) -> List[str]:
+        with self._lock:
+            return list(self._series)
+
+    def docs(self, series: str) -> List[Dict]:
+        """Docs of one series (shared list: do not mutate)."""
+        with self._lock:
+            return self._series.get(series, [])
+
+    def frame(self, series: str) -> pd.DataFrame:
+        """Timestamp-sorted DataFrame of one series (a copy, safe to mutate)."""
+        with self._lock:
+            df = self._frames.get(series)
+            if df is None:
+                df = docs_to_frame(self._series.get(series, []))
+                if not df.empty:
+                    df = df.sort_values("timestamp", kind="stable").reset_index(drop=True)
+                self._frames[series] = df
+        return df.copy()
+
+
+__all__ = ["HistoryIndex", "series_of"]
@@ -0,0 +1,163 @@
+"""
+Persistent (timestamp, coin) key index for history dedupe.
+
+Keys are packed into one int64 (timestamp * SLOTS + coin slot; slot 0 = totals,
+each coin gets max(slot) + 1 the first time it is seen) and kept as a sorted
+NumPy array, so membership is a binary search instead of rebuilding a Python
+set from the whole history. The slot map saved in the meta file is
+authoritative: adding or reordering coins in COIN_LIST never moves a slot.
+
+Files (next to the store):
+  <name>.npy       sorted int64 base array
+  <name>.log       raw int64 keys appended since the last merge
+  <name>.meta.json coin slots + the store signature the index matches
+
+New keys go to the log (and an in-memory set) and are merged into the base
+array once MERGE_THRESHOLD of them accumulate. The meta file records the store
+signature after each commit; if the store changed behind the index's back
+(crash between the segment write and the commit, another process), the index
+is rebuilt from the store on open.
+"""
+from __future__ import annotations
+
+import json
+import os
+import threading
+from typing import Callable, Dict, Iterable, Optional, Set, Tuple
+
+import numpy as np
+
+SLOTS = 4096
+MERGE_THRESHOLD = 8192
+
+HistoryKey = Tuple[Optional[int], Optional[str]]
+
+
+class KeyIndex:
+    """Sorted int64 key array + append log, validated against the store signature."""
+
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._lock = threading.RLock()
+        self._base = np.empty(0, dtype=np.int64)
+        self._tail: Set[int] = set()
+        self._slots: Dict[str, int] = {}
+
+    # ---------- files ----------
+    @property
+    def _npy(self) -> str:
+        return self._path + ".npy"
+
+    @property
+    def _log(self) -> str:
+        return self._path + ".log"
+
+    @property
+    def _meta(self) -> str:
+        return self._path + ".meta.json"
+
+    def _read_meta(self) -> Optional[Dict]:
+        try:
+            with open(self._meta, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            return meta if isinstance(meta, dict) else None
+        except Exception:
+            return None
+
+    def _write_meta(self, signature) -> None:
+        tmp = self._meta + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"signature": list(signature), "slots": self._slots}, f)
+        os.replace(tmp, self._meta)
+
+    def _write_base(self) -> None:
+        tmp = self._npy + ".tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, self._base)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._npy)
+        with open(self._log, "wb"):
+            pass
+
+    # ---------- keys ----------
+    def slot(self, coin: Optional[str]) -> int:
+        if not isinstance(coin, str):
+            return 0
+        s = self._slots.get(coin)
+        if s is None:
+            s = max(self._slots.values(), default=0) + 1
+            if s >= SLOTS:
+                raise ValueError(f"key index is out of coin slots ({SLOTS - 1})")
+            self._slots[coin] = s
+        return s
+
+    def pack(self, key: HistoryKey) -> int:
+        return int(key[0]) * SLOTS + self.slot(key[1])
+
+    # ---------- open / rebuild ----------
+    def open(self, signature, rebuild: Callable[[], Iterable[HistoryKey]]) -> None:
+        """Load the index if it matches the store signature, otherwise rebuild it."""
+        with self._lock:
+            meta = self._read_meta() or {}
+            slots = meta.get("slots") if isinstance(meta.get("slots"), dict) else {}
+            if len(set(slots.values())) != len(slots):
+                # Old maps were merged with COIN_LIST order and can share a slot: drop them and rebuild
+                meta, slots = {}, {}
+            self._slots = dict(slots)
+            if tuple(meta.get("signature") or ()) == tuple(signature):
+                try:
+                    self._base = np.load(self._npy)
+                    tail = np.fromfile(self._log, dtype=np.int64) if os.path.exists(self._log) else np.empty(0, np.int64)
+                    self._tail = set(tail.tolist())
+                    return
+                except (OSError, ValueError):
+                    pass
+            self.reset(rebuild(), signature)
+
+    def reset(self, keys: Iterable[HistoryKey], signature) -> None:
+        with self._lock:
+            packed = [self.pack(k) for k in keys if k[0] is not None]
+            self.reset_packed(np.asarray(packed, dtype=np.int64), signature)
+
+    def reset_packed(self, packed: np.ndarray, signature) -> None:
+        with self._lock:
+            self._base = np.unique(packed.astype(np.int64))
+            self._tail = set()
+            self._write_base()
+            self._write_meta(signature)
+
+    # ---------- membership / writes ----------
+    def contains_packed(self, k: int) -> bool:
+        if k in self._tail:
+            return True
+        i = int(np.searchsorted(self._base, k))
+        return i < len(self._base) and int(self._base[i]) == k
+
+    def __contains__(self, key: HistoryKey) -> bool:
+        if key[0] is None:
+            return False
+        with self._lock:
+            return self.contains_packed(self.pack(key))
+
+    def __len__(self) -> int:
+        return len(self._base) + len(self._tail)
+
+    def commit(self, new_keys: Iterable[int], signature) -> None:
+        """Persist packed keys written to the store, then record the store signature."""
+        new = [k for k in new_keys]
+        with self._lock:
+            if new:
+                with open(self._log, "ab") as f:
+                    f.write(np.asarray(new, dtype=np.int64).tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+                self._tail.update(new)
+            if len(self._tail) >= MERGE_THRESHOLD:
+                self._base = np.union1d(self._base, np.fromiter(self._tail, dtype=np.int64))
+                self._tail = set()
+                self._write_base()
+            self._write_meta(signature)
+
+
+__all__ = ["KeyIndex", "SLOTS", "MERGE_THRESHOLD"]
@@ -0,0 +1,358 @@
+"""
+Fixed-width binary portfolio history opened with np.memmap.
+
+Every doc is one packed record of RECORD_DTYPE (50 bytes):
+  timestamp int64 | coin int16 | value, invested, PNL, amount, avg_price float64
+`coin` is a code from the store's coin table, TOTAL_INDEX (-1) for portfolio
+totals. Missing fields are NaN. The table is saved next to the record file
+(`<path>.coins.json`) and only ever grows: a new coin gets max(code) + 1, so
+changing config.COIN_LIST never re-labels stored records. Files written before
+the table existed used COIN_LIST positions, which seed the table on first open.
+
+Appends write raw records at the end of the file; a torn record left by a crash
+is ignored (the view only covers whole records) and cut off on the next append.
+Reads map the file read-only so range slices, per-coin columns and as-of lookups
+are NumPy views instead of Python dicts. Select it with HISTORY_BACKEND = "memmap".
+"""
+from __future__ import annotations
+
+import json
+import os
+import threading
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from config import COIN_LIST
+from history_parquet import TOTAL_COIN, HISTORY_COLUMNS
+from history_keyindex import KeyIndex, SLOTS
+
+RECORD_DTYPE = np.dtype([
+    ("timestamp", "<i8"),
+    ("coin", "<i2"),
+    ("value", "<f8"),
+    ("invested", "<f8"),
+    ("PNL", "<f8"),
+    ("amount", "<f8"),
+    ("avg_price", "<f8"),
+])
+FLOAT_FIELDS = ["value", "invested", "PNL", "amount", "avg_price"]
+TOTAL_INDEX = -1
+
+# Codes of files written before the coin table existed (and of tables not bound to a file)
+COIN_INDEX: Dict[str, int] = {coin_id: i for i, (coin_id, _) in enumerate(COIN_LIST)}
+MAX_CODE = SLOTS - 2  # packed key slot = code + 1 < SLOTS
+
+
+class CoinTable:
+    """Coin id <-> record code, persisted as JSON; codes are never reassigned."""
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self._path = path
+        codes: Optional[Dict[str, int]] = None
+        if path:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                codes = {str(k): int(v) for k, v in data.items()} if isinstance(data, dict) else None
+            except (OSError, ValueError, TypeError):
+                codes = None
+        self._codes: Dict[str, int] = dict(COIN_INDEX) if codes is None else codes
+        self._coins: Dict[int, str] = {i: c for c, i in self._codes.items()}
+        if path and codes is None:
+            self._save()
+
+    def _save(self) -> None:
+        tmp = self._path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self._codes, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._path)
+
+    def code(self, coin: Optional[str], create: bool = False) -> Optional[int]:
+        """Record code of a coin id (TOTAL_INDEX for totals/NaN; None if unknown and not created)."""
+        if not isinstance(coin, str) or coin == TOTAL_COIN:
+            return TOTAL_INDEX
+        idx = self._codes.get(coin)
+        if idx is None and create and self._path:
+            idx = max(self._codes.values(), default=-1) + 1
+            if idx > MAX_CODE:
+                raise ValueError(f"memmap coin table is full ({MAX_CODE + 1} coins)")
+            self._codes[coin] = idx
+            self._coins[idx] = coin
+            # Persist the table before any record uses the new code
+            self._save()
+        return idx
+
+    def coin(self, idx: int) -> Optional[str]:
+        return self._coins.get(idx)
+
+
+_DEFAULT_COINS = CoinTable()
+
+
+def coin_index(coin: Optional[str], coins: Optional[CoinTable] = None) -> Optional[int]:
+    """Record code of a coin id (TOTAL_INDEX for totals/NaN, None if unknown)."""
+    return (coins or _DEFAULT_COINS).code(coin)
+
+
+def docs_to_records(docs: Iterable[Dict], coins: Optional[CoinTable] = None) -> np.ndarray:
+    """Pack history docs into a RECORD_DTYPE array.
+
+    With a file-backed `coins` table new coins get a code; otherwise docs of unknown coins are skipped.
+    """
+    coins = coins or _DEFAULT_COINS
+    rows = []
+    for d in docs:
+        ts = d.get("timestamp")
+        idx = coins.code(d.get("coin"), create=True)
+        if ts is None or idx is None:
+            continue
+        vals = []
+        for f in FLOAT_FIELDS:
+            try:
+                vals.append(float(d.get(f)))
+            except (TypeError, ValueError):
+                vals.append(np.nan)
+        rows.append((int(ts), idx, *vals))
+    return np.array(rows, dtype=RECORD_DTYPE)
+
+
+def records_to_docs(arr: np.ndarray, coins: Optional[CoinTable] = None) -> List[Dict]:
+    """Unpack records into history docs (NaN fields omitted, no `coin` for totals)."""
+    coins = coins or _DEFAULT_COINS
+    cols = {name: arr[name].tolist() for name in RECORD_DTYPE.names}
+    docs: List[Dict] = []
+    for i in range(len(arr)):
+        d: Dict = {"timestamp": cols["timestamp"][i]}
+        c = cols["coin"][i]
+        if c != TOTAL_INDEX:
+            d["coin"] = coins.coin(c) or str(c)
+        for f in FLOAT_FIELDS:
+            v = cols[f][i]
+            if v == v:
+                d[f] = v
+        docs.append(d)
+    return docs
+
+
+class MemmapHistoryStore:
+    """Append-only RECORD_DTYPE file with zero-copy memmap reads."""
+
+    def __init__(self, path: str, seed: Optional[Callable[[], Iterable[Dict]]] = None) -> None:
+        self._path = path
+        self._seed = seed
+        self._lock = threading.RLock()
+        self._opened = False
+        self._view: Optional[np.ndarray] = None
+        self._view_size = -1
+        self._sorted = True
+        self._keys: Optional[KeyIndex] = None
+        self._coins: Optional[CoinTable] = None
+
+    # ---------- open / view ----------
+    def ensure_open(self) -> None:
+        with self._lock:
+            if self._opened:
+                return
+            self._coins = CoinTable(self._path + ".coins.json")
+            if (not os.path.exists(self._path) or os.path.getsize(self._path) == 0) and self._seed:
+                self._write(docs_to_records(self._seed(), self._coins))
+            self._opened = True
+
+    @property
+    def coins(self) -> CoinTable:
+        self.ensure_open()
+        return self._coins
+
+    def _whole_size(self) -> int:
+        try:
+            size = os.path.getsize(self._path)
+        except OSError:
+            return 0
+        return size - size % RECORD_DTYPE.itemsize
+
+    def view(self) -> np.ndarray:
+        """Read-only memmap over all whole records (remapped when the file grew)."""
+        with self._lock:
+            self.ensure_open()
+            size = self._whole_size()
+            if size != self._view_size:
+                if size == 0:
+                    self._view = np.empty(0, dtype=RECORD_DTYPE)
+                else:
+                    self._view = np.memmap(self._path, dtype=RECORD_DTYPE, mode="r", shape=(size // RECORD_DTYPE.itemsize,))
+                ts = self._view["timestamp"]
+                self._sorted = bool(len(ts) < 2 or np.all(ts[1:] >= ts[:-1]))
+                self._view_size = size
+            return self._view
+
+    def signature(self) -> Tuple[int, int]:
+        return (1, self._whole_size())
+
+    # ---------- reads ----------
+    def slice_range(self, start: Optional[int] = None, end: Optional[int] = None,
+                    coin: Optional[str] = None) -> np.ndarray:
+        """Records with start <= timestamp <= end (a view when no coin filter is needed).
+
+        coin: None = every record, TOTAL_COIN = totals, else a coin id.
+        """
+        arr = self.view()
+        ts = arr["timestamp"]
+        if self._sorted:
+            lo = 0 if start is None else int(np.searchsorted(ts, start, side="left"))
+            hi = len(arr) if end is None else int(np.searchsorted(ts, end, side="right"))
+            arr = arr[lo:hi]
+        else:
+            mask = np.ones(len(arr), dtype=bool)
+            if start is not None:
+                mask &= ts >= start
+            if end is not None:
+                mask &= ts <= end
+            arr = arr[mask]
+        if coin is not None:
+            idx = self.coins.code(coin)
+            arr = arr[arr["coin"] == idx] if idx is not None else arr[:0]
+        return arr
+
+    def value_as_of(self, ts: int, coin: str = TOTAL_COIN, field: str = "value") -> Optional[float]:
+        """Last `field` of a series at or before ts (e.g. portfolio value yesterday)."""
+        arr = self.slice_range(None, ts, coin=coin)
+        if len(arr) == 0:
+            return None
+        if not self._sorted:
+            arr = arr[np.argsort(arr["timestamp"], kind="stable")]
+        v = float(arr[field][-1])
+        return None if v != v else v
+
+    def read_range(self, start: Optional[int] = None, end: Optional[int] = None,
+                   coin: Optional[str] = None, columns: Optional[Sequence[str]] = None) -> pd.DataFrame:
+        """Same contract as ParquetHistoryStore.read_range, served from the memmap."""
+        cols = list(columns or HISTORY_COLUMNS)
+        arr = self.slice_range(start, end, coin=coin)
+        if not self._sorted:
+            arr = arr[np.argsort(arr["timestamp"], kind="stable")]
+        data = {}
+        for c in cols:
+            if c == "coin":
+                codes = arr["coin"]
+                data[c] = pd.Series([None if x == TOTAL_INDEX else self.coins.coin(x) for x in codes.tolist()], dtype=object)
+            else:
+                data[c] = np.asarray(arr[c])
+        return pd.DataFrame(data, columns=cols)
+
+    def iter_docs(self) -> Iterator[Dict]:
+        yield from records_to_docs(self.view(), self.coins)
+
+    def load_all(self) -> List[Dict]:
+        return records_to_docs(self.view(), self.coins)
+
+    def keys(self) -> KeyIndex:
+        """Persistent (timestamp, coin) index next to the record file (`<path>.keys.*`)."""
+        with self._lock:
+            if self._keys is None:
+                self.ensure_open()
+                index = KeyIndex(self._path + ".keys")
+                index.open(self.signature(), lambda: ())
+                if len(index) == 0 and self._whole_size():
+                    index.reset_packed(self._packed_keys(self.view()), self.signature())
+                self._keys = index
+            return self._keys
+
+    @staticmethod
+    def _packed_keys(arr: np.ndarray) -> np.ndarray:
+        # Slot = coin code + 1 (0 = totals); only the packed KeyIndex API is used, never its slot map
+        return arr["timestamp"].astype(np.int64) * SLOTS + (arr["coin"].astype(np.int64) + 1)
+
+    # ---------- writes ----------
+    def _write(self, recs: np.ndarray, mode: str = "ab") -> None:
+        if mode == "ab":
+            # Cut a torn trailing record before appending whole ones
+            whole = self._whole_size()
+            if os.path.exists(self._path) and os.path.getsize(self._path) != whole:
+                with open(self._path, "rb+") as f:
+                    f.truncate(whole)
+        with open(self._path, mode) as f:
+            f.write(recs.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+    def append(self, docs: Iterable[Dict]) -> List[Dict]:
+        """Append docs whose (timestamp, coin) is not stored yet. Returns docs written."""
+        docs = list(docs)
+        with self._lock:
+            self.ensure_open()
+            keys = self.keys()
+            fresh_docs: List[Dict] = []
+            fresh_recs = []
+            packed: List[int] = []
+            seen = set()
+            for d, rec in zip(docs, self._pack_each(docs, self._coins)):
+                if rec is None:
+                    continue
+                k = int(rec["timestamp"]) * SLOTS + int(rec["coin"]) + 1
+                if k in seen or keys.contains_packed(k):
+                    continue
+                seen.add(k)
+                packed.append(k)
+                fresh_docs.append(d)
+                fresh_recs.append(rec)
+            if fresh_recs:
+                self._write(np.array(fresh_recs, dtype=RECORD_DTYPE))
+                keys.commit(packed, self.signature())
+            return fresh_docs
+
+    @staticmethod
+    def _pack_each(docs: List[Dict], coins: CoinTable) -> List[Optional[np.void]]:
+        out = []
+        for d in docs:
+            recs = docs_to_records([d], coins)
+            out.append(recs[0] if len(recs) else None)
+        return out
+
+    def replace_all(self, docs: List[Dict]) -> None:
+        with self._lock:
+            self.ensure_open()
+            recs = docs_to_records(docs, self._coins)
+            tmp = self._path + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(recs.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            self._view = None
+            self._view_size = -1
+            os.replace(tmp, self._path)
+            self.keys().reset_packed(self._packed_keys(recs), self.signature())
+
+    def compact(self, include_today: bool = False) -> Dict[str, int]:
+        """Sort by timestamp and dedupe (last write wins); atomic swap. Returns {"all": removed}."""
+        with self._lock:
+            arr = np.array(self.view())
+            if len(arr) == 0:
+                return {}
+            # Last occurrence of each (timestamp, coin) wins
+            rev = arr[::-1]
+            _, first_idx = np.unique(np.stack([rev["timestamp"], rev["coin"].astype(np.int64)], axis=1), axis=0, return_index=True)
+            kept = rev[np.sort(first_idx)][::-1]
+            kept = kept[np.lexsort((kept["coin"], kept["timestamp"]))]
+            removed = len(arr) - len(kept)
+            if removed == 0 and self._sorted:
+                return {}
+            tmp = self._path + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(kept.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            self._view = None
+            self._view_size = -1
+            os.replace(tmp, self._path)
+            self.keys().commit([], self.signature())
+            return {"all": removed}
+
+
+__all__ = [
+    "MemmapHistoryStore", "CoinTable", "RECORD_DTYPE", "TOTAL_INDEX", "COIN_INDEX",
+    "coin_index", "docs_to_records", "records_to_docs",
+]
@@ -0,0 +1,172 @@
+"""
+Columnar (Parquet) view of portfolio history with time-range pushdown.
+
+Layout (under HISTORY_PARQUET_DIR):
+  - YYYY-MM-DD/<coin>.parquet      : per-coin docs of that UTC day
+  - YYYY-MM-DD/__total__.parquet   : portfolio total docs of that UTC day
+  - YYYY-MM-DD/_SUCCESS            : marker, newer than the NDJSON segment it was built from
+
+The NDJSON day segments (history_store) stay the write path. Closed days are
+materialized lazily into typed Parquet partitions the first time they are read;
+the open day is read straight from its segment. `read_range` only touches the
+days (and coin files) overlapping the request, so a one-day chart no longer
+parses months of data.
+
+pyarrow is optional: without it every day is read from its NDJSON segment.
+"""
+from __future__ import annotations
+
+import os
+import time
+from typing import Dict, List, Optional, Sequence
+
+import pandas as pd
+
+from history_store import SegmentedHistoryStore, day_of
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+TOTAL_COIN = "__total__"
+HISTORY_COLUMNS = ["timestamp", "coin", "value", "invested", "PNL", "amount", "avg_price"]
+_FLOAT_COLUMNS = ["value", "invested", "PNL", "amount", "avg_price"]
+_SUCCESS = "_SUCCESS"
+
+_SCHEMA = (
+    pa.schema(
+        [("timestamp", pa.int64()), ("coin", pa.string())]
+        + [(c, pa.float64()) for c in _FLOAT_COLUMNS]
+    )
+    if pa is not None
+    else None
+)
+
+
+def _partition_name(coin: Optional[str]) -> str:
+    return TOTAL_COIN if coin is None else coin
+
+
+def _empty_frame(columns: Sequence[str]) -> pd.DataFrame:
+    return pd.DataFrame({c: pd.Series(dtype="float64") for c in columns})
+
+
+def docs_to_frame(docs: List[Dict], columns: Optional[Sequence[str]] = None) -> pd.DataFrame:
+    """Build a typed history DataFrame (missing fields become NaN, coin None for totals)."""
+    cols = list(columns or HISTORY_COLUMNS)
+    if not docs:
+        return _empty_frame(cols)
+    df = pd.DataFrame(docs)
+    for c in HISTORY_COLUMNS:
+        if c not in df.columns:
+            df[c] = None
+    df["timestamp"] = df["timestamp"].astype("int64")
+    for c in _FLOAT_COLUMNS:
+        df[c] = pd.to_numeric(df[c], errors="coerce").astype("float64")
+    df["coin"] = df["coin"].where(df["coin"].notna(), None)
+    return df[cols]
+
+
+class ParquetHistoryStore:
+    """Day/coin partitioned Parquet mirror of a SegmentedHistoryStore."""
+
+    def __init__(self, base_dir: str, segments: SegmentedHistoryStore) -> None:
+        self._base_dir = base_dir
+        self._segments = segments
+
+    @staticmethod
+    def available() -> bool:
+        return pq is not None
+
+    def _day_dir(self, day: str) -> str:
+        return os.path.join(self._base_dir, day)
+
+    def _is_fresh(self, day: str) -> bool:
+        marker = os.path.join(self._day_dir(day), _SUCCESS)
+        try:
+            return os.path.getmtime(marker) >= os.path.getmtime(self._segments.segment_path(day))
+        except OSError:
+            return False
+
+    def materialize(self, day: str) -> bool:
+        """(Re)build the Parquet partitions of one day from its NDJSON segment."""
+        if not self.available():
+            return False
+        by_coin: Dict[str, List[Dict]] = {}
+        for d in self._segments.iter_docs(days=[day]):
+            by_coin.setdefault(_partition_name(d.get("coin")), []).append(d)
+        day_dir = self._day_dir(day)
+        os.makedirs(day_dir, exist_ok=True)
+        for name in os.listdir(day_dir):
+            if name.endswith(".parquet") and name[: -len(".parquet")] not in by_coin:
+                os.remove(os.path.join(day_dir, name))
+        for name, docs in by_coin.items():
+            df = docs_to_frame(docs).sort_values("timestamp", kind="stable")
+            table = pa.Table.from_pandas(df, schema=_SCHEMA, preserve_index=False)
+            path = os.path.join(day_dir, f"{name}.parquet")
+            pq.write_table(table, path + ".tmp")
+            os.replace(path + ".tmp", path)
+        with open(os.path.join(day_dir, _SUCCESS), "w", encoding="utf-8") as f:
+            f.write(str(int(time.time())))
+        return True
+
+    def _read_day(self, day: str, coin: Optional[str], columns: List[str], closed: bool) -> pd.DataFrame:
+        if closed and self.available() and (self._is_fresh(day) or self.materialize(day)):
+            day_dir = self._day_dir(day)
+            if coin is not None:
+                paths = [os.path.join(day_dir, f"{coin}.parquet")]
+            else:
+                paths = [os.path.join(day_dir, n) for n in sorted(os.listdir(day_dir)) if n.endswith(".parquet")]
+            frames = [pq.read_table(p, columns=columns).to_pandas() for p in paths if os.path.exists(p)]
+            if not frames:
+                return _empty_frame(columns)
+            df = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+            if "coin" in df.columns:
+                df["coin"] = df["coin"].where(df["coin"].notna(), None)
+            return df
+        # Open day (or no pyarrow): parse the NDJSON segment
+        docs = self._segments.iter_docs(days=[day])
+        if coin == TOTAL_COIN:
+            docs = [d for d in docs if d.get("coin") is None]
+        elif coin is not None:
+            docs = [d for d in docs if d.get("coin") == coin]
+        else:
+            docs = list(docs)
+        return docs_to_frame(docs, columns)
+
+    def read_range(self, start: Optional[int] = None, end: Optional[int] = None,
+                   coin: Optional[str] = None, columns: Optional[Sequence[str]] = None) -> pd.DataFrame:
+        """Docs with start <= timestamp <= end as a DataFrame sorted by timestamp.
+
+        coin: None = every doc, TOTAL_COIN = portfolio totals only, else one coin id.
+        columns: subset of HISTORY_COLUMNS to return.
+        """
+        out_cols = list(columns or HISTORY_COLUMNS)
+        read_cols = out_cols if "timestamp" in out_cols else ["timestamp"] + out_cols
+        first = day_of(start) if start is not None else None
+        last = day_of(end) if end is not None else None
+        today = day_of(time.time())
+        frames = []
+        self._segments.ensure_open()
+        for day in self._segments.segments():
+            if (first and day < first) or (last and day > last):
+                continue
+            df = self._read_day(day, coin, read_cols, closed=day < today)
+            if not df.empty:
+                frames.append(df)
+        if not frames:
+            return _empty_frame(out_cols)
+        df = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+        mask = pd.Series(True, index=df.index)
+        if start is not None:
+            mask &= df["timestamp"] >= int(start)
+        if end is not None:
+            mask &= df["timestamp"] <= int(end)
+        df = df[mask].sort_values("timestamp", kind="stable").reset_index(drop=True)
+        return df[out_cols]
+
+
+__all__ = ["ParquetHistoryStore", "TOTAL_COIN", "HISTORY_COLUMNS", "docs_to_frame"]
@@ -0,0 +1,229 @@
+"""
+Retention / downsampling of closed history days.
+
+Per closed UTC day, by age of the day's end:
+  - younger than HISTORY_MINUTE_RETENTION_DAYS -> "1m": one doc per minute and series
+  - younger than HISTORY_HOURLY_RETENTION_DAYS -> "1h": one doc per hour and series
+  - older                                      -> "1d": one doc per day and series
+Within a bucket the first doc is kept with its own timestamp (first write wins,
+as in the snapshot writer), so the kept docs are still real snapshots and the
+same (timestamp, coin) keys can be kept in Cloud DB. Docs with value == 0
+(price fetch failures) are dropped at the same time. The result lists, per series,
+the buckets that lost docs; Cloud DB is pruned only inside those buckets, so
+cloud data the local store never had (gaps, other instances) is left alone.
+
+Segmented/delta stores rewrite each affected day atomically (tmp + os.replace);
+the memmap store is rewritten in one swap. Days already at their target
+resolution and unchanged since are skipped using a small state file.
+`start_retention_job()` runs `portfolio_history.apply_retention` periodically.
+"""
+from __future__ import annotations
+
+import calendar
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+from config import (
+    HISTORY_MINUTE_RETENTION_DAYS,
+    HISTORY_HOURLY_RETENTION_DAYS,
+    HISTORY_RETENTION_INTERVAL_SEC,
+    HISTORY_RETENTION_PRUNE_DB,
+)
+from history_parquet import TOTAL_COIN
+from history_store import SegmentedHistoryStore, day_of
+
+RESOLUTION_SECONDS = {"1m": 60, "1h": 3600, "1d": 86400}
+
+
+def day_start(day: str) -> int:
+    return calendar.timegm(time.strptime(day, "%Y-%m-%d"))
+
+
+def resolution_for(day: str, now: Optional[float] = None) -> Optional[str]:
+    """Target resolution of a day segment (None for the open day)."""
+    now = time.time() if now is None else now
+    if day >= day_of(now):
+        return None
+    age = now - (day_start(day) + 86400)
+    if age < HISTORY_MINUTE_RETENTION_DAYS * 86400:
+        return "1m"
+    if age < HISTORY_HOURLY_RETENTION_DAYS * 86400:
+        return "1h"
+    return "1d"
+
+
+def _is_zero(v) -> bool:
+    try:
+        return float(v) == 0
+    except (TypeError, ValueError):
+        return False
+
+
+def downsample(docs: List[Dict], step: int) -> List[Dict]:
+    """First doc per (bucket, series), zero values dropped; sorted by (timestamp, coin)."""
+    kept: Dict[tuple, Dict] = {}
+    for d in sorted(docs, key=lambda d: d.get("timestamp") or 0):
+        ts = d.get("timestamp")
+        if ts is None or _is_zero(d.get("value")):
+            continue
+        key = (int(ts) // step, d.get("coin") or TOTAL_COIN)
+        if key not in kept:
+            kept[key] = d
+    return sorted(kept.values(), key=lambda d: (d.get("timestamp") or 0, d.get("coin") or ""))
+
+
+def downsampled_buckets(docs: List[Dict], kept: List[Dict], step: int) -> Dict[str, List[List[int]]]:
+    """{series: [[bucket_start, kept_timestamp], ...]} of the buckets that actually lost docs.
+
+    Only these (bucket, series) pairs may be pruned elsewhere (Cloud DB): buckets the
+    local store had a single doc for, or no doc at all, say nothing about other copies.
+    """
+    counts: Dict[tuple, int] = {}
+    for d in docs:
+        if d.get("timestamp") is None:
+            continue
+        key = (int(d["timestamp"]) // step, d.get("coin") or TOTAL_COIN)
+        counts[key] = counts.get(key, 0) + 1
+    out: Dict[str, List[List[int]]] = {}
+    for d in kept:
+        ts = int(d["timestamp"])
+        key = (ts // step, d.get("coin") or TOTAL_COIN)
+        if counts.get(key, 0) > 1:
+            out.setdefault(key[1], []).append([key[0] * step, ts])
+    return out
+
+
+def _day_result(docs: List[Dict], kept: List[Dict], resolution: str) -> Dict:
+    return {
+        "resolution": resolution,
+        "removed": len(docs) - len(kept),
+        "timestamps": sorted({int(d["timestamp"]) for d in kept}),
+        "buckets": downsampled_buckets(docs, kept, RESOLUTION_SECONDS[resolution]),
+    }
+
+
+class RetentionState:
+    """{day: [resolution, size]} of days already processed."""
+
+    def __init__(self, path: str) -> None:
+        self._path = path
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.days: Dict[str, list] = data if isinstance(data, dict) else {}
+        except Exception:
+            self.days = {}
+
+    def save(self) -> None:
+        tmp = self._path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self.days, f)
+            os.replace(tmp, self._path)
+        except OSError:
+            pass
+
+
+def _segment_size(store: SegmentedHistoryStore, day: str) -> int:
+    try:
+        return os.path.getsize(store.segment_path(day))
+    except OSError:
+        return -1
+
+
+def apply_to_segments(store: SegmentedHistoryStore, state_path: str,
+                      now: Optional[float] = None) -> Dict[str, Dict]:
+    """Downsample closed day segments. Returns {day: {resolution, removed, timestamps, buckets}}."""
+    state = RetentionState(state_path)
+    targets: Dict[str, str] = {}
+    for day in store.segments():
+        res = resolution_for(day, now)
+        if res is None:
+            continue
+        done = state.days.get(day)
+        if done and done[0] == res and done[1] == _segment_size(store, day):
+            continue
+        targets[day] = res
+
+    out: Dict[str, Dict] = {}
+
+    def _fn(day: str, docs: List[Dict]) -> Optional[List[Dict]]:
+        kept = downsample(docs, RESOLUTION_SECONDS[targets[day]])
+        if len(kept) == len(docs):
+            return None
+        out[day] = _day_result(docs, kept, targets[day])
+        return kept
+
+    store.rewrite_days(_fn, targets)
+    for day, res in targets.items():
+        state.days[day] = [res, _segment_size(store, day)]
+    if targets:
+        state.save()
+    return out
+
+
+def apply_to_memmap(store, now: Optional[float] = None) -> Dict[str, Dict]:
+    """Same policy for the memmap store (whole file rewritten once if anything changes)."""
+    by_day: Dict[str, List[Dict]] = {}
+    for d in store.iter_docs():
+        by_day.setdefault(day_of(d["timestamp"]), []).append(d)
+    out: Dict[str, Dict] = {}
+    docs: List[Dict] = []
+    for day in sorted(by_day):
+        day_docs = by_day[day]
+        res = resolution_for(day, now)
+        kept = day_docs if res is None else downsample(day_docs, RESOLUTION_SECONDS[res])
+        if len(kept) != len(day_docs):
+            out[day] = _day_result(day_docs, kept, res)
+        docs.extend(kept)
+    if out:
+        store.replace_all(docs)
+    return out
+
+
+# ---------- background job ----------
+_JOB_STARTED = False
+_JOB_LOCK = threading.Lock()
+
+
+def _retention_loop(interval_sec: int) -> None:
+    # Import muộn: tránh import vòng với portfolio_history và đọc env Mongo quá sớm
+    from portfolio_history import apply_retention, compact_history
+
+    while True:
+        try:
+            # Gộp trùng + sắp xếp các ngày đã đóng trước khi downsample (ngày đã compact và không đổi được bỏ qua)
+            compacted = compact_history()
+            if any(compacted.values()):
+                print(f"[Retention] compact: bỏ {sum(compacted.values())} bản ghi trùng")
+            result = apply_retention()
+            if result:
+                removed = sum(r["removed"] for r in result.values())
+                print(f"[Retention] {len(result)} ngày đã downsample, bỏ {removed} bản ghi")
+                if HISTORY_RETENTION_PRUNE_DB:
+                    from cloud_db import db
+                    from db_utils import prune_portfolio_history_db
+
+                    prune_portfolio_history_db(db, result)
+        except Exception as e:
+            print(f"[Retention] Lỗi: {e}")
+        time.sleep(interval_sec)
+
+
+def start_retention_job(interval_sec: int = HISTORY_RETENTION_INTERVAL_SEC) -> None:
+    """Start the process-wide retention thread (once)."""
+    global _JOB_STARTED
+    with _JOB_LOCK:
+        if _JOB_STARTED:
+            return
+        threading.Thread(target=_retention_loop, args=(interval_sec,), name="history-retention", daemon=True).start()
+        _JOB_STARTED = True
+
+
+__all__ = [
+    "resolution_for", "downsample", "downsampled_buckets", "apply_to_segments", "apply_to_memmap",
+    "start_retention_job", "RESOLUTION_SECONDS",
+]
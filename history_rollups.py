@@ -0,0 +1,199 @@
+"""
+Multi-resolution rollups (1m / 5m / 1h / 1d) of portfolio history for charts.
+
+Each series (portfolio totals under TOTAL_COIN, or one coin id) keeps per tier a
+bucket -> aggregate map with last/min/max/mean of `value` and `PNL` (plus the
+last `invested` for per-coin PNL %). Buckets are seeded once from the stored
+history with a vectorized groupby and then updated incrementally for every
+appended snapshot, so a chart never has to replay the raw minute history.
+
+Fine tiers only keep a bounded window (TIER_RETENTION) which keeps memory flat;
+`pick_tier` returns the coarsest tier that still yields enough points for the
+requested window and whose retention covers it.
+"""
+from __future__ import annotations
+
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import pandas as pd
+
+from history_parquet import TOTAL_COIN
+
+# (name, bucket seconds), finest first
+TIERS: List[Tuple[str, int]] = [("1m", 60), ("5m", 300), ("1h", 3600), ("1d", 86400)]
+TIER_SECONDS: Dict[str, int] = dict(TIERS)
+# Seconds of history kept per tier (None = unbounded)
+TIER_RETENTION: Dict[str, Optional[int]] = {
+    "1m": 2 * 86400,
+    "5m": 14 * 86400,
+    "1h": 180 * 86400,
+    "1d": None,
+}
+MIN_CHART_POINTS = 200
+
+ROLLUP_COLUMNS = [
+    "timestamp", "count",
+    "value", "value_min", "value_max", "value_mean",
+    "PNL", "PNL_min", "PNL_max", "PNL_mean",
+    "invested",
+]
+
+# Aggregate slots: [count, v_sum, v_min, v_max, v_last, p_sum, p_min, p_max, p_last, invested_last, last_ts]
+_N, _VS, _VMIN, _VMAX, _VLAST, _PS, _PMIN, _PMAX, _PLAST, _ILAST, _TS = range(11)
+
+
+def _num(v) -> Optional[float]:
+    try:
+        f = float(v)
+    except (TypeError, ValueError):
+        return None
+    return None if f != f else f
+
+
+class HistoryRollups:
+    """In-memory rollup tiers, one bucket map per (series, tier)."""
+
+    def __init__(self, retention: Optional[Dict[str, Optional[int]]] = None) -> None:
+        self._retention = dict(retention or TIER_RETENTION)
+        self._lock = threading.Lock()
+        # series -> tier -> bucket_start -> aggregate list
+        self._buckets: Dict[str, Dict[str, Dict[int, list]]] = {}
+        self._last_prune = 0.0
+
+    def _series_tiers(self, series: str) -> Dict[str, Dict[int, list]]:
+        tiers = self._buckets.get(series)
+        if tiers is None:
+            tiers = {name: {} for name, _ in TIERS}
+            self._buckets[series] = tiers
+        return tiers
+
+    # ---------- building ----------
+    def clear(self) -> None:
+        with self._lock:
+            self._buckets.clear()
+
+    def seed(self, df: pd.DataFrame, now: Optional[float] = None) -> None:
+        """Bulk-build all tiers from a history DataFrame (timestamp, coin, value, PNL, invested)."""
+        now = time.time() if now is None else now
+        if df is None or df.empty:
+            return
+        df = df.copy()
+        df["series"] = df["coin"].where(df["coin"].notna(), TOTAL_COIN) if "coin" in df.columns else TOTAL_COIN
+        if "invested" not in df.columns:
+            df["invested"] = float("nan")
+        df = df.sort_values("timestamp", kind="stable")
+        with self._lock:
+            for name, step in TIERS:
+                keep = self._retention.get(name)
+                part = df if keep is None else df[df["timestamp"] >= now - keep]
+                if part.empty:
+                    continue
+                part = part.assign(bucket=(part["timestamp"] // step) * step)
+                agg = part.groupby(["series", "bucket"], sort=False).agg(
+                    n=("value", "size"),
+                    v_sum=("value", "sum"), v_min=("value", "min"), v_max=("value", "max"), v_last=("value", "last"),
+                    p_sum=("PNL", "sum"), p_min=("PNL", "min"), p_max=("PNL", "max"), p_last=("PNL", "last"),
+                    i_last=("invested", "last"), ts=("timestamp", "max"),
+                )
+                for (series, bucket), row in zip(agg.index, agg.itertuples(index=False)):
+                    self._series_tiers(series)[name][int(bucket)] = [
+                        int(row.n), row.v_sum, row.v_min, row.v_max, row.v_last,
+                        row.p_sum, row.p_min, row.p_max, row.p_last, row.i_last, int(row.ts),
+                    ]
+
+    def add(self, docs: Iterable[Dict]) -> None:
+        """Fold newly appended snapshot docs into every tier (O(docs x tiers))."""
+        with self._lock:
+            for d in docs:
+                ts = d.get("timestamp")
+                v = _num(d.get("value"))
+                if ts is None or v is None:
+                    continue
+                p = _num(d.get("PNL"))
+                inv = _num(d.get("invested"))
+                series = d.get("coin") or TOTAL_COIN
+                tiers = self._series_tiers(series)
+                for name, step in TIERS:
+                    bucket = (int(ts) // step) * step
+                    agg = tiers[name].get(bucket)
+                    if agg is None:
+                        tiers[name][bucket] = [
+                            1, v, v, v, v,
+                            p or 0.0, p, p, p, inv, int(ts),
+                        ]
+                        continue
+                    agg[_N] += 1
+                    agg[_VS] += v
+                    agg[_VMIN] = min(agg[_VMIN], v)
+                    agg[_VMAX] = max(agg[_VMAX], v)
+                    if p is not None:
+                        agg[_PS] = (agg[_PS] or 0.0) + p
+                        agg[_PMIN] = p if agg[_PMIN] is None else min(agg[_PMIN], p)
+                        agg[_PMAX] = p if agg[_PMAX] is None else max(agg[_PMAX], p)
+                    if int(ts) >= agg[_TS]:
+                        agg[_TS] = int(ts)
+                        agg[_VLAST] = v
+                        agg[_PLAST] = p
+                        agg[_ILAST] = inv
+        self.prune()
+
+    def prune(self, now: Optional[float] = None, min_interval: int = 3600) -> None:
+        """Drop buckets that fell out of a tier's retention window (at most hourly)."""
+        now = time.time() if now is None else now
+        if now - self._last_prune < min_interval:
+            return
+        self._last_prune = now
+        with self._lock:
+            for tiers in self._buckets.values():
+                for name, keep in self._retention.items():
+                    if keep is None:
+                        continue
+                    cutoff = now - keep
+                    stale = [b for b in tiers[name] if b < cutoff]
+                    for b in stale:
+                        del tiers[name][b]
+
+    # ---------- reading ----------
+    def earliest(self, series: str = TOTAL_COIN) -> Optional[int]:
+        tiers = self._buckets.get(series)
+        if not tiers or not tiers["1d"]:
+            return None
+        return min(tiers["1d"])
+
+    def pick_tier(self, window_seconds: float, min_points: int = MIN_CHART_POINTS) -> str:
+        """Coarsest tier giving >= min_points buckets over the window (and retaining it)."""
+        for name, step in reversed(TIERS):
+            keep = self._retention.get(name)
+            if keep is not None and keep < window_seconds:
+                continue
+            if window_seconds / step >= min_points:
+                return name
+        # Window too short for min_points anywhere: finest tier that still covers it
+        for name, _ in TIERS:
+            keep = self._retention.get(name)
+            if keep is None or keep >= window_seconds:
+                return name
+        return TIERS[-1][0]
+
+    def series(self, series: str, tier: str, start: Optional[int] = None, end: Optional[int] = None) -> pd.DataFrame:
+        """Rollup buckets of one series as a DataFrame (`value`/`PNL` are bucket last)."""
+        with self._lock:
+            buckets = self._buckets.get(series, {}).get(tier, {})
+            rows = []
+            for b in sorted(buckets):
+                if (start is not None and b + TIER_SECONDS[tier] <= start) or (end is not None and b > end):
+                    continue
+                a = buckets[b]
+                n = a[_N] or 1
+                rows.append((
+                    b, a[_N],
+                    a[_VLAST], a[_VMIN], a[_VMAX], a[_VS] / n,
+                    a[_PLAST], a[_PMIN], a[_PMAX], (a[_PS] / n) if a[_PS] is not None else None,
+                    a[_ILAST],
+                ))
+        return pd.DataFrame(rows, columns=ROLLUP_COLUMNS)
+
+
+__all__ = ["HistoryRollups", "TIERS", "TIER_RETENTION", "MIN_CHART_POINTS", "ROLLUP_COLUMNS"]
@@ -0,0 +1,317 @@
+"""
+Append-only segmented store for portfolio history.
+
+Layout (under HISTORY_DIR):
+  - YYYY-MM-DD.ndjson : one JSON document per line, rolled per UTC day of the doc timestamp
+  - _manifest.json    : bookkeeping for compaction (segment sizes already compacted)
+  - _keys.*           : persistent (timestamp, coin) index used to dedupe appends
+
+Recording a snapshot only appends a few hundred bytes to the current day's segment
+instead of rewriting the whole history. A crash in the middle of an append leaves at
+most one partial line at the tail of a segment; it is truncated on open.
+
+The legacy single-file `portfolio_history.json` is imported once when the segment
+directory is empty.
+"""
+from __future__ import annotations
+
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from history_keyindex import KeyIndex
+
+SEGMENT_SUFFIX = ".ndjson"
+MANIFEST_FILE = "_manifest.json"
+KEY_INDEX_FILE = "_keys"
+
+HistoryKey = Tuple[Optional[int], Optional[str]]
+
+
+def doc_key(doc: Dict) -> HistoryKey:
+    """Unique key of a history doc: (timestamp, coin) – coin is None for totals."""
+    return (doc.get("timestamp"), doc.get("coin"))
+
+
+def day_of(ts: int) -> str:
+    """UTC day (YYYY-MM-DD) a timestamp belongs to."""
+    return time.strftime("%Y-%m-%d", time.gmtime(int(ts)))
+
+
+class SegmentedHistoryStore:
+    """Append-only NDJSON history store rolled per UTC day."""
+
+    def __init__(self, base_dir: str, legacy_file: Optional[str] = None) -> None:
+        self._base_dir = base_dir
+        self._legacy_file = legacy_file
+        self._lock = threading.RLock()
+        self._opened = False
+        self._keys: Optional[KeyIndex] = None
+
+    # ---------- layout ----------
+    def segment_path(self, day: str) -> str:
+        return os.path.join(self._base_dir, f"{day}{SEGMENT_SUFFIX}")
+
+    def segments(self) -> List[str]:
+        """Sorted list of segment days present on disk."""
+        if not os.path.isdir(self._base_dir):
+            return []
+        days = [
+            name[: -len(SEGMENT_SUFFIX)]
+            for name in os.listdir(self._base_dir)
+            if name.endswith(SEGMENT_SUFFIX) and not name.startswith("_")
+        ]
+        return sorted(days)
+
+    def signature(self) -> Tuple[int, int]:
+        """(segment count, total bytes) – changes whenever any writer appends."""
+        total = 0
+        days = self.segments()
+        for day in days:
+            try:
+                total += os.path.getsize(self.segment_path(day))
+            except OSError:
+                pass
+        return (len(days), total)
+
+    def _open(self) -> None:
+        """Create the directory, import legacy JSON and repair torn tails (once)."""
+        if self._opened:
+            return
+        os.makedirs(self._base_dir, exist_ok=True)
+        if not self.segments():
+            self._migrate_legacy()
+        for day in self.segments():
+            self._recover_tail(self.segment_path(day))
+        self._opened = True
+
+    def ensure_open(self) -> None:
+        with self._lock:
+            self._open()
+
+    def _migrate_legacy(self) -> None:
+        if not self._legacy_file or not os.path.exists(self._legacy_file):
+            return
+        try:
+            with open(self._legacy_file, "r", encoding="utf-8") as f:
+                legacy = json.load(f)
+        except Exception:
+            return
+        if isinstance(legacy, list) and legacy:
+            self._write_segments(legacy)
+
+    @staticmethod
+    def _recover_tail(path: str) -> None:
+        """Truncate a partially written last line left behind by a crash."""
+        try:
+            with open(path, "rb+") as f:
+                f.seek(0, os.SEEK_END)
+                size = f.tell()
+                if size == 0:
+                    return
+                f.seek(size - 1)
+                if f.read(1) == b"\n":
+                    return
+                # Walk back to the last complete line
+                pos = size
+                chunk = 4096
+                while pos > 0:
+                    start = max(0, pos - chunk)
+                    f.seek(start)
+                    buf = f.read(pos - start)
+                    idx = buf.rfind(b"\n")
+                    if idx >= 0:
+                        f.truncate(start + idx + 1)
+                        return
+                    pos = start
+                f.truncate(0)
+        except OSError:
+            pass
+
+    # ---------- reads ----------
+    def _iter_segment(self, day: str) -> Iterator[Dict]:
+        path = self.segment_path(day)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        # Torn or corrupted line: skip, compaction will drop it
+                        continue
+        except OSError:
+            return
+
+    def iter_docs(self, days: Optional[Iterable[str]] = None) -> Iterator[Dict]:
+        """Yield docs segment by segment (optionally restricted to given days)."""
+        with self._lock:
+            self._open()
+            selected = self.segments() if days is None else sorted(set(days) & set(self.segments()))
+        for day in selected:
+            yield from self._iter_segment(day)
+
+    def load_all(self) -> List[Dict]:
+        return list(self.iter_docs())
+
+    def keys(self) -> KeyIndex:
+        """Persistent index of (timestamp, coin) already stored (rebuilt only if stale)."""
+        with self._lock:
+            if self._keys is None:
+                self._open()
+                index = KeyIndex(os.path.join(self._base_dir, KEY_INDEX_FILE))
+                index.open(self.signature(), lambda: (doc_key(d) for d in self.iter_docs()))
+                self._keys = index
+            return self._keys
+
+    # ---------- writes ----------
+    def append(self, docs: Iterable[Dict]) -> List[Dict]:
+        """Append docs not yet stored. Returns the docs actually written."""
+        with self._lock:
+            self._open()
+            keys = self.keys()
+            fresh: List[Dict] = []
+            packed: List[int] = []
+            seen = set()
+            for d in docs:
+                if d.get("timestamp") is None:
+                    continue
+                k = keys.pack(doc_key(d))
+                if k in seen or keys.contains_packed(k):
+                    continue
+                seen.add(k)
+                packed.append(k)
+                fresh.append(d)
+            if fresh:
+                self._write_segments(fresh)
+                keys.commit(packed, self.signature())
+            return fresh
+
+    def _write_segments(self, docs: Iterable[Dict]) -> None:
+        by_day: Dict[str, List[str]] = {}
+        for d in docs:
+            ts = d.get("timestamp")
+            if ts is None:
+                continue
+            by_day.setdefault(day_of(ts), []).append(json.dumps(d, separators=(",", ":")))
+        for day, lines in by_day.items():
+            with open(self.segment_path(day), "a", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def replace_all(self, docs: List[Dict]) -> None:
+        """Replace the whole history (e.g. with the cloud copy) segment by segment."""
+        with self._lock:
+            self._open()
+            by_day: Dict[str, List[Dict]] = {}
+            for d in docs:
+                if d.get("timestamp") is None:
+                    continue
+                by_day.setdefault(day_of(d["timestamp"]), []).append(d)
+            for day in self.segments():
+                if day not in by_day:
+                    try:
+                        os.remove(self.segment_path(day))
+                    except OSError:
+                        pass
+            for day, day_docs in by_day.items():
+                self._rewrite_segment(day, day_docs)
+            self._save_manifest({})
+            self.keys().reset((doc_key(d) for day_docs in by_day.values() for d in day_docs), self.signature())
+
+    def _rewrite_segment(self, day: str, docs: List[Dict]) -> int:
+        """Atomically swap a segment's content (tmp file + fsync + os.replace)."""
+        path = self.segment_path(day)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for d in docs:
+                f.write(json.dumps(d, separators=(",", ":")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        return os.path.getsize(path)
+
+    def rewrite_days(self, fn: Callable[[str, List[Dict]], Optional[List[Dict]]],
+                     days: Iterable[str]) -> Dict[str, int]:
+        """Atomically replace day segments with fn(day, docs) (None keeps the day as is).
+
+        `fn` must return docs sorted and without duplicates. Returns {day: docs_removed}.
+        """
+        result: Dict[str, int] = {}
+        with self._lock:
+            self._open()
+            compacted = self._load_manifest()
+            present = set(self.segments())
+            for day in sorted(set(days) & present):
+                docs = list(self._iter_segment(day))
+                new_docs = fn(day, docs)
+                if new_docs is None:
+                    continue
+                compacted[day] = self._rewrite_segment(day, new_docs)
+                result[day] = len(docs) - len(new_docs)
+            if result:
+                self._save_manifest(compacted)
+                self.keys().reset((doc_key(d) for d in self.iter_docs()), self.signature())
+        return result
+
+    # ---------- compaction ----------
+    def _load_manifest(self) -> Dict[str, int]:
+        try:
+            with open(os.path.join(self._base_dir, MANIFEST_FILE), "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return data.get("compacted", {}) if isinstance(data, dict) else {}
+        except Exception:
+            return {}
+
+    def _save_manifest(self, compacted: Dict[str, int]) -> None:
+        path = os.path.join(self._base_dir, MANIFEST_FILE)
+        tmp = path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"compacted": compacted}, f)
+            os.replace(tmp, path)
+        except OSError:
+            pass
+
+    def compact(self, include_today: bool = False) -> Dict[str, int]:
+        """Dedupe (last write wins) and sort closed segments by timestamp.
+
+        Segments already compacted and unchanged since are skipped.
+        Returns {day: docs_removed} for the segments rewritten.
+        """
+        today = day_of(time.time())
+        result: Dict[str, int] = {}
+        with self._lock:
+            self._open()
+            compacted = self._load_manifest()
+            for day in self.segments():
+                if day == today and not include_today:
+                    continue
+                path = self.segment_path(day)
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    continue
+                if compacted.get(day) == size:
+                    continue
+                merged: Dict[HistoryKey, Dict] = {}
+                total = 0
+                for d in self._iter_segment(day):
+                    total += 1
+                    merged[doc_key(d)] = d
+                docs = sorted(merged.values(), key=lambda d: (d.get("timestamp") or 0, d.get("coin") or ""))
+                compacted[day] = self._rewrite_segment(day, docs)
+                result[day] = total - len(docs)
+            self._save_manifest(compacted)
+            if result:
+                # Only duplicates were dropped: same keys, new signature
+                self.keys().commit([], self.signature())
+        return result
+
+
+__all__ = ["SegmentedHistoryStore", "doc_key", "day_of"]
@@ -0,0 +1,109 @@
+"""
+Incremental two-way sync of portfolio history with Cloud DB.
+
+Instead of pulling the whole collection and replacing local history on every
+start, a small state file (HISTORY_SYNC_STATE) keeps two high-water marks:
+  - pulled_ts: newest cloud timestamp already merged locally
+  - pushed_ts: newest local timestamp already sent to the cloud
+Each sync only fetches cloud docs newer than pulled_ts (minus SYNC_OVERLAP_SEC,
+for snapshots another instance committed a little late) and pushes local docs
+newer than pushed_ts. Merging goes through the store's key dedupe, so overlap
+and replays are idempotent. A fresh install (no state) still pulls once in full.
+"""
+from __future__ import annotations
+
+import json
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+from config import HISTORY_SYNC_STATE
+from db_utils import (
+    iter_portfolio_history_from_db,
+    latest_portfolio_timestamp_in_db,
+    db_upsert_portfolio_docs_with_retry,
+)
+from portfolio_history import append_snapshot, read_range
+
+SYNC_OVERLAP_SEC = 600
+PULL_CHUNK = 5000
+PUSH_CHUNK = 2000
+
+_SYNC_LOCK = threading.Lock()
+
+
+def _load_state(path: str = HISTORY_SYNC_STATE) -> Dict:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except Exception:
+        return {}
+
+
+def _save_state(state: Dict, path: str = HISTORY_SYNC_STATE) -> None:
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+
+def sync_portfolio_history(db, push: bool = True) -> Dict[str, int]:
+    """Pull newer cloud docs, push newer local docs. Returns counts and the new marks."""
+    result = {"pulled": 0, "merged": 0, "pushed": 0}
+    if not db.available():
+        return result
+    with _SYNC_LOCK:
+        state = _load_state()
+        first_sync = "pulled_ts" not in state
+        pulled_ts: Optional[int] = state.get("pulled_ts")
+        if first_sync:
+            # Everything older than the cloud's newest doc is assumed to be in the cloud already
+            state["pushed_ts"] = latest_portfolio_timestamp_in_db(db) or 0
+
+        # 1) Pull: only cloud docs newer than the high-water mark
+        start = None if pulled_ts is None else max(0, pulled_ts - SYNC_OVERLAP_SEC)
+        chunk = []
+        newest = pulled_ts or 0
+        pushed_ts = int(state.get("pushed_ts") or 0)
+        from_cloud = set()  # keys newer than pushed_ts that came from the cloud: no echo push
+        for d in iter_portfolio_history_from_db(db, start=start):
+            ts = d.get("timestamp")
+            if ts is None:
+                continue
+            newest = max(newest, int(ts))
+            if ts > pushed_ts:
+                from_cloud.add((int(ts), d.get("coin")))
+            chunk.append(d)
+            if len(chunk) >= PULL_CHUNK:
+                result["merged"] += len(append_snapshot(chunk))
+                result["pulled"] += len(chunk)
+                chunk = []
+        if chunk:
+            result["merged"] += len(append_snapshot(chunk))
+            result["pulled"] += len(chunk)
+        state["pulled_ts"] = newest
+
+        # 2) Push: only local docs newer than what was already sent
+        if push:
+            df = read_range(start=pushed_ts + 1)
+            if not df.empty:
+                docs = [{k: v for k, v in rec.items() if v == v and v is not None}
+                        for rec in df.to_dict("records")]
+                docs = [d for d in docs if (int(d["timestamp"]), d.get("coin")) not in from_cloud]
+                for i in range(0, len(docs), PUSH_CHUNK):
+                    db_upsert_portfolio_docs_with_retry(db, docs[i:i + PUSH_CHUNK])
+                result["pushed"] = len(docs)
+                state["pushed_ts"] = int(df["timestamp"].max())
+        state["last_sync"] = int(time.time())
+        _save_state(state)
+    result["pulled_ts"] = state.get("pulled_ts", 0)
+    result["pushed_ts"] = state.get("pushed_ts", 0)
+    return result
+
+
+__all__ = ["sync_portfolio_history", "SYNC_OVERLAP_SEC"]
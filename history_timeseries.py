@@ -0,0 +1,202 @@
+"""
+Portfolio history in a native Mongo time-series collection.
+
+PORTFOLIO_TS_COLLECTION is created with timeField=timestamp (a BSON date, the
+epoch seconds of the plain collection converted), metaField=coin ("__total__" for
+portfolio totals) and granularity=minutes, so Atlas stores each coin's minutes in
+compressed columnar buckets and range reads per coin hit the bucket index.
+
+PORTFOLIO_TS_MODE drives the cut-over:
+  - "off"  : only the plain `portfolio_history` collection is used,
+  - "dual" : writes go to both; reads use the time-series collection for
+             timestamps already copied (`copied_until`, everything once the copy is
+             done) and the plain collection for the rest,
+  - "ts"   : the time-series collection only.
+`copy_from_legacy` streams the plain collection into the time-series one in
+timestamp order, saving its cursor in the `meta` kv after each batch, so the copy
+can be stopped and resumed. It copies up to the time it was first started;
+later docs are already dual-written.
+
+Time-series collections have no unique indexes and no upsert by key: writes are
+plain inserts, and reads drop duplicate (timestamp, coin) docs (last one wins).
+"""
+from __future__ import annotations
+
+import calendar
+import math
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+from config import PORTFOLIO_TS_COLLECTION, PORTFOLIO_TS_MODE
+
+TOTAL_META = "__total__"
+META_COLLECTION = "meta"
+STATE_KEY = "portfolio_ts_migration"
+STATE_TTL_SEC = 60
+COPY_BATCH = 5000
+
+_state_cache: Dict = {}
+_state_loaded = 0.0
+
+
+# ---------- doc conversion ----------
+def to_date(ts: int) -> datetime:
+    return datetime.fromtimestamp(int(ts), tz=timezone.utc)
+
+
+def from_date(dt) -> int:
+    return int(dt) if isinstance(dt, (int, float)) else calendar.timegm(dt.utctimetuple())
+
+
+def to_ts_doc(doc: Dict) -> Dict:
+    """Plain history doc -> time-series doc (date timestamp, coin always set)."""
+    out = {k: v for k, v in doc.items() if k != "_id"}
+    out["timestamp"] = to_date(doc["timestamp"])
+    out["coin"] = doc.get("coin") or TOTAL_META
+    return out
+
+
+def from_ts_doc(doc: Dict) -> Dict:
+    """Time-series doc -> plain history doc (totals without `coin`)."""
+    out = {k: v for k, v in doc.items() if k != "_id"}
+    if "timestamp" in out:
+        out["timestamp"] = from_date(out["timestamp"])
+    if out.get("coin") == TOTAL_META:
+        del out["coin"]
+    return out
+
+
+def ts_filter(start: Optional[int] = None, end: Optional[int] = None, coin: Optional[str] = None) -> Dict:
+    query: Dict = {}
+    cond = {}
+    if start is not None:
+        cond["$gte"] = to_date(start)
+    if end is not None:
+        cond["$lte"] = to_date(end)
+    if cond:
+        query["timestamp"] = cond
+    if coin is not None:
+        query["coin"] = coin
+    return query
+
+
+# ---------- migration state ----------
+def migration_state(db, refresh: bool = False) -> Dict:
+    """{"cutoff", "copied_until", "done"} of the copy (cached STATE_TTL_SEC)."""
+    global _state_cache, _state_loaded
+    if refresh or time.time() - _state_loaded > STATE_TTL_SEC:
+        state = db.get_kv(META_COLLECTION, STATE_KEY)
+        if state is not None or refresh:
+            _state_cache = state or {}
+            _state_loaded = time.time()
+    return dict(_state_cache)
+
+
+def save_migration_state(db, state: Dict) -> None:
+    global _state_cache, _state_loaded
+    db.set_kv(META_COLLECTION, STATE_KEY, state)
+    _state_cache = dict(state)
+    _state_loaded = time.time()
+
+
+def read_boundary(db, mode: str = PORTFOLIO_TS_MODE) -> Optional[float]:
+    """Newest timestamp readable from the time-series collection (inf: all, None: none)."""
+    if mode == "ts":
+        return math.inf
+    if mode != "dual":
+        return None
+    state = migration_state(db)
+    if state.get("done"):
+        return math.inf
+    return state.get("copied_until")
+
+
+def writes_enabled(mode: str = PORTFOLIO_TS_MODE) -> bool:
+    return mode in ("dual", "ts")
+
+
+# ---------- reads / writes ----------
+def ensure_collection(db) -> bool:
+    return db.create_timeseries_collection(PORTFOLIO_TS_COLLECTION, "timestamp", "coin", granularity="minutes")
+
+
+def iter_docs(db, start: Optional[int] = None, end: Optional[int] = None, coin: Optional[str] = None,
+              fields: Optional[List[str]] = None, batch_size: Optional[int] = None) -> Iterator[Dict]:
+    """Plain docs from the time-series collection, timestamp order, duplicates dropped."""
+    pending: Dict[str, Dict] = {}
+    current = None
+    for d in db.iter_find(PORTFOLIO_TS_COLLECTION, filter=ts_filter(start, end, coin), projection=fields,
+                          sort_field="timestamp", ascending=True, batch_size=batch_size):
+        d = from_ts_doc(d)
+        ts = d.get("timestamp")
+        if ts != current:
+            yield from pending.values()
+            pending = {}
+            current = ts
+        pending[d.get("coin") or TOTAL_META] = d
+    yield from pending.values()
+
+
+def insert_docs(db, docs: Iterable[Dict]) -> int:
+    """Insert plain docs; returns the number that failed."""
+    ts_docs = [to_ts_doc(d) for d in docs if d.get("timestamp") is not None]
+    if not ts_docs:
+        return 0
+    db.insert_many(PORTFOLIO_TS_COLLECTION, ts_docs)
+    return sum(b.get("failed", 0) for b in db.last_insert_stats)
+
+
+def copy_from_legacy(db, legacy_collection: str, batch: int = COPY_BATCH,
+                     progress: Optional[Callable[[Dict], None]] = None) -> Dict:
+    """Stream `legacy_collection` into the time-series collection (resumable).
+
+    Batches never split a timestamp, so the saved cursor is always a clean boundary.
+    Returns the final migration state plus `copied` (docs inserted by this call).
+    """
+    if not ensure_collection(db):
+        raise RuntimeError(db.last_error() or f"không tạo được time-series {PORTFOLIO_TS_COLLECTION}")
+    state = migration_state(db, refresh=True)
+    if state.get("done"):
+        return {**state, "copied": 0}
+    state.setdefault("cutoff", int(time.time()))
+    query: Dict = {"timestamp": {"$lte": state["cutoff"]}}
+    if state.get("copied_until") is not None:
+        query["timestamp"]["$gt"] = state["copied_until"]
+    copied = 0
+    chunk: List[Dict] = []
+    failures_before = db.health_stats.get("op_failures", 0)
+
+    def _flush() -> None:
+        nonlocal copied, chunk
+        failed = insert_docs(db, chunk)
+        if failed:
+            raise RuntimeError(db.last_error() or f"{failed} doc không ghi được")
+        copied += len(chunk)
+        state["copied_until"] = int(chunk[-1]["timestamp"])
+        save_migration_state(db, state)
+        if progress:
+            progress({**state, "copied": copied})
+        chunk = []
+
+    for d in db.iter_find(legacy_collection, filter=query, sort_field="timestamp", ascending=True,
+                          batch_size=batch):
+        if len(chunk) >= batch and d.get("timestamp") != chunk[-1].get("timestamp"):
+            _flush()
+        chunk.append(d)
+    if chunk:
+        _flush()
+    if db.health_stats.get("op_failures", 0) != failures_before or not db.available():
+        # Cursor dừng giữa chừng: giữ copied_until để lần sau chạy tiếp
+        raise RuntimeError(db.last_error() or "đọc collection cũ bị gián đoạn")
+    state["copied_until"] = state["cutoff"]
+    state["done"] = True
+    save_migration_state(db, state)
+    return {**state, "copied": copied}
+
+
+__all__ = [
+    "to_ts_doc", "from_ts_doc", "ts_filter", "to_date", "from_date",
+    "migration_state", "read_boundary", "writes_enabled", "ensure_collection",
+    "iter_docs", "insert_docs", "copy_from_legacy", "TOTAL_META",
+]
@@ -0,0 +1,69 @@
+"""Migrate portfolio_history to a native Mongo time-series collection.
+
+Usage:
+  python migrate_portfolio_timeseries.py --uri "<MONGO_URI>" --status
+  python migrate_portfolio_timeseries.py --uri "<MONGO_URI>" [--batch 5000]
+
+Steps for the cut-over:
+  1. Set PORTFOLIO_TS_MODE = "dual" in config.py and restart the app (new snapshots
+     are written to both collections).
+  2. Run this script: it creates portfolio_history_ts (timeField=timestamp,
+     metaField=coin, granularity=minutes) and streams portfolio_history into it.
+     It can be stopped and re-run; it resumes from the saved cursor.
+  3. Once it reports done, reads already use the time-series collection; set
+     PORTFOLIO_TS_MODE = "ts" to stop writing the old collection.
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import time
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Copy portfolio_history into a Mongo time-series collection")
+    parser.add_argument("--uri", help="MongoDB URI (mặc định lấy từ biến môi trường MONGO_URI)")
+    parser.add_argument("--db", default=None, help="Tên database (mặc định CLOUD_DB_NAME hoặc Crypto2025)")
+    parser.add_argument("--batch", type=int, default=5000, help="Số doc mỗi lần insert")
+    parser.add_argument("--status", action="store_true", help="Chỉ in trạng thái migration")
+    args = parser.parse_args()
+
+    # cloud_db đọc MONGO_URI khi import
+    if args.uri:
+        os.environ["MONGO_URI"] = args.uri
+    if args.db:
+        os.environ["CLOUD_DB_NAME"] = args.db
+    from cloud_db import db
+    import history_timeseries as ts_store
+    from config import PORTFOLIO_TS_COLLECTION, PORTFOLIO_TS_MODE
+    from db_utils import PORTFOLIO_COLLECTION
+
+    if not db.available():
+        print(f"Không kết nối được DB: {db.last_error()}", file=sys.stderr)
+        return 1
+    state = ts_store.migration_state(db, refresh=True)
+    print(f"PORTFOLIO_TS_MODE={PORTFOLIO_TS_MODE} | {PORTFOLIO_TS_COLLECTION}: {db.collection_type(PORTFOLIO_TS_COLLECTION) or 'chưa có'}")
+    print(f"Trạng thái: {state or 'chưa bắt đầu'}")
+    if args.status:
+        return 0
+    if PORTFOLIO_TS_MODE != "dual":
+        print("Cảnh báo: nên bật PORTFOLIO_TS_MODE='dual' trước khi copy để snapshot mới được ghi cả hai nơi.")
+
+    t0 = time.time()
+
+    def _progress(st: dict) -> None:
+        until = time.strftime("%Y-%m-%d %H:%M", time.gmtime(st["copied_until"]))
+        print(f"  đã copy {st['copied']} doc (tới {until} UTC, {time.time() - t0:.0f}s)")
+
+    try:
+        result = ts_store.copy_from_legacy(db, PORTFOLIO_COLLECTION, batch=args.batch, progress=_progress)
+    except RuntimeError as e:
+        print(f"Dừng: {e} – chạy lại để tiếp tục từ con trỏ đã lưu", file=sys.stderr)
+        return 1
+    print(f"Xong: copy {result['copied']} doc trong {time.time() - t0:.0f}s, cutoff={result.get('cutoff')}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,54 +1,200 @@
-import json
-import os
+import threading
 import time
-from typing import List, Dict
-from config import HISTORY_FILE
+from typing import List, Dict, Optional, Sequence
+from config import (
+    HISTORY_FILE, HISTORY_DIR, HISTORY_PARQUET_DIR, HISTORY_BIN_FILE, HISTORY_DELTA_DIR, HISTORY_BACKEND,
+    HISTORY_RETENTION_STATE,
+)
+from history_store import SegmentedHistoryStore
+from history_parquet import ParquetHistoryStore, TOTAL_COIN, docs_to_frame
+from history_rollups import HistoryRollups, MIN_CHART_POINTS
+from history_index import HistoryIndex
+from history_memmap import MemmapHistoryStore, docs_to_records
+from history_delta import DeltaHistoryStore
+from history_retention import apply_to_segments, apply_to_memmap
+
+if HISTORY_BACKEND == "memmap":
+    # Fixed-width records opened with np.memmap (seeded once from the NDJSON segments)
+    _STORE = MemmapHistoryStore(
+        HISTORY_BIN_FILE,
+        seed=lambda: SegmentedHistoryStore(HISTORY_DIR, legacy_file=HISTORY_FILE).iter_docs(),
+    )
+    _RANGE = _STORE
+elif HISTORY_BACKEND == "delta":
+    # One delta frame per timestamp; statics only when they change, totals derived
+    _STORE = DeltaHistoryStore(
+        HISTORY_DELTA_DIR,
+        seed=lambda: SegmentedHistoryStore(HISTORY_DIR, legacy_file=HISTORY_FILE).iter_docs(),
+    )
+    _RANGE = ParquetHistoryStore(HISTORY_PARQUET_DIR, _STORE)
+else:
+    # Append-only segmented store (imports legacy HISTORY_FILE on first use)
+    _STORE = SegmentedHistoryStore(HISTORY_DIR, legacy_file=HISTORY_FILE)
+    # Columnar day/coin partitions built from closed segments, used for range reads
+    _RANGE = ParquetHistoryStore(HISTORY_PARQUET_DIR, _STORE)
+# 1m/5m/1h/1d chart rollups, seeded once then updated on every append
+_ROLLUPS = HistoryRollups()
+_ROLLUPS_READY = False
+_ROLLUPS_LOCK = threading.Lock()
 
 # Simple in-memory cache
 _HISTORY_CACHE: List[Dict] = []
 _HISTORY_LAST_LOAD = 0
+_HISTORY_SIG = None  # store signature the cache reflects
 _CACHE_TTL = 30  # seconds
+# Per-series index over the cache (totals + each coin)
+_INDEX = HistoryIndex()
 
 
 def load_history(force: bool = False) -> List[Dict]:
-    global _HISTORY_CACHE, _HISTORY_LAST_LOAD
+    """Full history (cached). After the TTL the store is re-parsed only if another
+    writer changed it; appends made through this module keep the cache current."""
+    global _HISTORY_CACHE, _HISTORY_LAST_LOAD, _HISTORY_SIG
     now = time.time()
     if not force and _HISTORY_CACHE and (now - _HISTORY_LAST_LOAD) < _CACHE_TTL:
         return _HISTORY_CACHE
-    if not os.path.exists(HISTORY_FILE):
-        _HISTORY_CACHE = []
-        _HISTORY_LAST_LOAD = now
-        return _HISTORY_CACHE
     try:
-        with open(HISTORY_FILE, 'r', encoding='utf-8') as f:
-            _HISTORY_CACHE = json.load(f)
+        sig = _STORE.signature()
+        if not force and _HISTORY_CACHE and sig == _HISTORY_SIG:
             _HISTORY_LAST_LOAD = now
+            return _HISTORY_CACHE
+        _HISTORY_CACHE = _STORE.load_all()
+        _HISTORY_SIG = _STORE.signature()
+        _HISTORY_LAST_LOAD = now
     except Exception:
         _HISTORY_CACHE = []
+    _INDEX.rebuild(_HISTORY_CACHE)
     return _HISTORY_CACHE
 
 
-def append_snapshot(docs: List[Dict]):
-    """Append new snapshot docs (already validated externally)."""
+def append_snapshot(docs: List[Dict]) -> List[Dict]:
+    """Append new snapshot docs (already validated externally).
+
+    Only docs whose (timestamp, coin) is not stored yet are appended to the
+    current day's segment; the whole history is never rewritten. Returns the
+    docs actually written. Producers should go through
+    snapshot_writer.submit_snapshot, which serializes writers.
+    """
+    global _HISTORY_SIG
     if not docs:
-        return
-    hist = load_history(force=True)
-    # Avoid duplication by (timestamp, coin/null)
-    existing_keys = {(d.get('timestamp'), d.get('coin')) for d in hist}
-    new_clean = [d for d in docs if (d.get('timestamp'), d.get('coin')) not in existing_keys]
-    if not new_clean:
-        return
-    hist.extend(new_clean)
+        return []
+    try:
+        written = _STORE.append(docs)
+    except Exception:
+        return []
+    if written and _HISTORY_CACHE:
+        _HISTORY_CACHE.extend(written)
+        _INDEX.add(written)
+        _HISTORY_SIG = _STORE.signature()
+    if written and _ROLLUPS_READY:
+        _ROLLUPS.add(written)
+    return written
+
+
+def read_range(start: Optional[int] = None, end: Optional[int] = None,
+               coin: Optional[str] = None, columns: Optional[Sequence[str]] = None):
+    """Typed DataFrame of docs in [start, end] (unix seconds), touching only those days.
+
+    coin: None = all docs, TOTAL_COIN = portfolio totals, otherwise a CoinGecko id.
+    """
     try:
-        with open(HISTORY_FILE, 'w', encoding='utf-8') as f:
-            json.dump(hist, f)
+        return _RANGE.read_range(start, end, coin=coin, columns=columns)
     except Exception:
-        pass
+        return docs_to_frame([], columns)
+
+
+def value_as_of(ts: int, coin: str = TOTAL_COIN, field: str = "value") -> Optional[float]:
+    """Last `field` of a series at or before ts (e.g. the portfolio value yesterday)."""
+    try:
+        if isinstance(_STORE, MemmapHistoryStore):
+            return _STORE.value_as_of(ts, coin=coin, field=field)
+        df = series_frame(coin)
+        pos = int(df["timestamp"].searchsorted(ts, side="right"))
+        if pos == 0:
+            return None
+        v = df[field].iloc[pos - 1]
+        return None if v != v else float(v)
+    except Exception:
+        return None
+
+
+def history_array(start: Optional[int] = None, end: Optional[int] = None, coin: Optional[str] = None):
+    """History as a RECORD_DTYPE NumPy array (a zero-copy memmap view on the memmap backend)."""
+    if isinstance(_STORE, MemmapHistoryStore):
+        return _STORE.slice_range(start, end, coin=coin)
+    df = _RANGE.read_range(start, end, coin=coin)
+    return docs_to_records(df.to_dict("records")) if not df.empty else docs_to_records([])
+
+
+def _ensure_rollups():
+    global _ROLLUPS_READY
+    with _ROLLUPS_LOCK:
+        if _ROLLUPS_READY:
+            return
+        _ROLLUPS.seed(_RANGE.read_range(columns=["timestamp", "coin", "value", "PNL", "invested"]))
+        _ROLLUPS_READY = True
+
+
+def read_chart_series(start: Optional[int] = None, end: Optional[int] = None,
+                      coin: str = TOTAL_COIN, min_points: int = MIN_CHART_POINTS):
+    """Rollup series for a chart window, at the coarsest tier with >= min_points points.
+
+    Returns (tier, DataFrame) where `value`/`PNL` are the last value of each bucket
+    and *_min/_max/_mean the bucket aggregates.
+    """
+    try:
+        _ensure_rollups()
+        now = int(time.time())
+        first = start if start is not None else (_ROLLUPS.earliest(coin) or now)
+        tier = _ROLLUPS.pick_tier((end or now) - first, min_points=min_points)
+        return tier, _ROLLUPS.series(coin, tier, start=start, end=end)
+    except Exception:
+        return None, docs_to_frame([], ["timestamp", "value", "PNL"])
+
+
+def compact_history(include_today: bool = False) -> Dict[str, int]:
+    """Dedupe and sort closed day segments. Returns {day: docs_removed}."""
+    try:
+        return _STORE.compact(include_today=include_today)
+    except Exception:
+        return {}
+
+
+def apply_retention(now: Optional[float] = None) -> Dict[str, Dict]:
+    """Downsample closed days (1m / 1h / 1d by age), drop zero values and refresh caches.
+
+    Returns {day: {"resolution", "removed", "timestamps", "buckets"}} for the days rewritten
+    (`buckets`: per series, the [bucket_start, kept_timestamp] pairs that lost docs).
+    """
+    global _ROLLUPS_READY
+    try:
+        if isinstance(_STORE, MemmapHistoryStore):
+            result = apply_to_memmap(_STORE, now)
+        else:
+            result = apply_to_segments(_STORE, HISTORY_RETENTION_STATE, now)
+    except Exception:
+        return {}
+    if result:
+        load_history(force=True)
+        with _ROLLUPS_LOCK:
+            _ROLLUPS.clear()
+            _ROLLUPS_READY = False
+    return result
+
+
+def series_frame(coin: str = TOTAL_COIN):
+    """Timestamp-sorted DataFrame of one series (TOTAL_COIN or a coin id), via the index."""
+    load_history()
+    return _INDEX.frame(coin)
 
 
 def filter_portfolio_totals(hist: List[Dict]):
+    if hist is _HISTORY_CACHE:
+        return _INDEX.docs(TOTAL_COIN)
     return [h for h in hist if 'coin' not in h]
 
 
 def filter_coin_history(hist: List[Dict], coin_id: str):
+    if hist is _HISTORY_CACHE:
+        return _INDEX.docs(coin_id)
     return [h for h in hist if h.get('coin') == coin_id]
@@ -0,0 +1,219 @@
+"""
+Shared logging for the whale scanners.
+
+`get_scanner_logger("btc")` returns a stdlib logger with three handlers:
+  - a RotatingFileHandler on `<name>_whale_scanner.log` (bounded size, a few backups),
+  - an in-memory ring buffer of the last SCANNER_LOG_RING_SIZE records (`recent_logs`),
+  - a shipping handler that only queues the new record; one background thread sends
+    queued records to the `<name>_logs` collection in batches every
+    SCANNER_LOG_SHIP_INTERVAL_SEC (kept and retried with a growing pause while the
+    DB is down, oldest dropped beyond a bound, records rejected MAX_SHIP_ATTEMPTS
+    times dropped). `<name>_logs` has a TTL index on `ts` (cloud_db.INDEX_SPECS),
+    ensured when the shipper first inserts into the collection.
+Logging a line is O(1): nothing re-reads the log file or re-sends old records.
+"""
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from logging.handlers import RotatingFileHandler
+from typing import Dict, List, Optional, Tuple
+
+from config import (
+    SCANNER_LOG_MAX_BYTES,
+    SCANNER_LOG_BACKUPS,
+    SCANNER_LOG_RING_SIZE,
+    SCANNER_LOG_SHIP_INTERVAL_SEC,
+    SCANNER_LOG_SHIP_BATCH,
+)
+
+LOG_FORMAT = "[%(asctime)s] %(levelname)s %(message)s"
+MAX_PENDING = 20000  # records waiting for Mongo across all scanners
+MAX_SHIP_ATTEMPTS = 5  # a record rejected this many times in a row is dropped
+MAX_SHIP_BACKOFF_SEC = 300
+
+_LOGGERS: Dict[str, logging.Logger] = {}
+_RINGS: Dict[str, deque] = {}
+_LOCK = threading.Lock()
+
+
+class _RingHandler(logging.Handler):
+    def __init__(self, ring: deque) -> None:
+        super().__init__()
+        self._ring = ring
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self._ring.append(self.format(record))
+
+
+class _LogShipper:
+    """Batches records per collection and inserts them from one daemon thread."""
+
+    def __init__(self) -> None:
+        self._pending: deque = deque(maxlen=MAX_PENDING)
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._inflight = 0
+        self.stats = {"shipped": 0, "failed_batches": 0, "dropped": 0}
+        self._indexed: set = set()  # collections whose TTL index was ensured this process
+
+    def submit(self, collection: str, doc: Dict) -> None:
+        with self._cond:
+            self._pending.append((collection, doc, 0))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name="scanner-log-shipper", daemon=True)
+                self._thread.start()
+
+    def _take(self) -> Dict[str, List[Tuple[Dict, int]]]:
+        batches: Dict[str, List[Tuple[Dict, int]]] = {}
+        with self._cond:
+            n = min(len(self._pending), SCANNER_LOG_SHIP_BATCH)
+            for _ in range(n):
+                collection, doc, attempts = self._pending.popleft()
+                batches.setdefault(collection, []).append((doc, attempts))
+            self._inflight = n
+        return batches
+
+    def _requeue(self, collection: str, items: List[Tuple[Dict, int]], failed: bool) -> None:
+        if failed:
+            # Batch bị từ chối toàn bộ: tăng số lần thử, bỏ record quá MAX_SHIP_ATTEMPTS để không chặn queue mãi
+            items = [(d, a + 1) for d, a in items]
+            kept = [(d, a) for d, a in items if a < MAX_SHIP_ATTEMPTS]
+            self.stats["dropped"] += len(items) - len(kept)
+            items = kept
+        with self._cond:
+            self._pending.extendleft((collection, d, a) for d, a in reversed(items))
+
+    def _ship(self, db, batches: Dict[str, List[Tuple[Dict, int]]]) -> int:
+        """Insert the batches; returns the number of records inserted (0: nothing went through)."""
+        if not batches:
+            return 0
+        if not db.available():
+            for collection, items in batches.items():
+                self._requeue(collection, items, failed=False)
+            return 0
+        shipped = 0
+        for collection, items in batches.items():
+            inserted = db.insert_many(collection, [d for d, _ in items])
+            if inserted:
+                # Lỗi từng doc (nếu có) không gửi lại để tránh trùng log
+                shipped += inserted
+                self._ensure_ttl(db, collection)
+            else:
+                self._requeue(collection, items, failed=True)
+                self.stats["failed_batches"] += 1
+        self.stats["shipped"] += shipped
+        return shipped
+
+    def _ensure_ttl(self, db, collection: str) -> None:
+        """TTL index (and date `ts` for old docs) on a `*_logs` collection, once per process.
+
+        ensure_indexes at startup only sees collections that already exist; a scanner
+        logging for the first time creates its collection here.
+        """
+        if collection in self._indexed:
+            return
+        # Lỗi tạo index hiện trong health panel (index_report), không thử lại sau mỗi batch
+        if db.ensure_indexes([collection]).get(collection) is not None:
+            self._indexed.add(collection)
+
+    def _loop(self) -> None:
+        # Import muộn: cloud_db đọc MONGO_URI lúc import
+        from cloud_db import db
+
+        delay = SCANNER_LOG_SHIP_INTERVAL_SEC
+        while True:
+            batches = self._take()
+            shipped = self._ship(db, batches)
+            with self._cond:
+                self._inflight = 0
+                self._cond.notify_all()
+                if shipped and len(self._pending) >= SCANNER_LOG_SHIP_BATCH:
+                    # Còn backlog và Mongo đang nhận: gửi batch tiếp ngay
+                    delay = SCANNER_LOG_SHIP_INTERVAL_SEC
+                    continue
+                if batches and not shipped:
+                    # DB không sẵn sàng / batch bị từ chối: chờ lâu dần thay vì quay vòng
+                    delay = min(delay * 2, MAX_SHIP_BACKOFF_SEC)
+                else:
+                    delay = SCANNER_LOG_SHIP_INTERVAL_SEC
+                # Gom record cho batch sau; flush() đánh thức sớm
+                self._cond.wait(delay)
+
+    def flush(self, timeout: float = 30.0) -> bool:
+        """Wait until queued records have been handed to Mongo (False on timeout)."""
+        deadline = time.time() + timeout
+        with self._cond:
+            self._cond.notify_all()
+            while self._pending or self._inflight:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+
+_SHIPPER = _LogShipper()
+
+
+class _ShipHandler(logging.Handler):
+    def __init__(self, scanner: str, collection: str) -> None:
+        super().__init__()
+        self._scanner = scanner
+        self._collection = collection
+
+    def emit(self, record: logging.LogRecord) -> None:
+        _SHIPPER.submit(self._collection, {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc),
+            "level": record.levelname,
+            "scanner": self._scanner,
+            "line": self.format(record),
+        })
+
+
+def get_scanner_logger(name: str, log_file: Optional[str] = None, collection: Optional[str] = None) -> logging.Logger:
+    """Logger of one scanner (created once per process)."""
+    name = name.lower()
+    with _LOCK:
+        logger = _LOGGERS.get(name)
+        if logger is not None:
+            return logger
+        logger = logging.getLogger(f"whale.{name}")
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        fmt = logging.Formatter(LOG_FORMAT)
+        handlers: List[logging.Handler] = []
+        try:
+            handlers.append(RotatingFileHandler(log_file or f"{name}_whale_scanner.log", maxBytes=SCANNER_LOG_MAX_BYTES,
+                                                backupCount=SCANNER_LOG_BACKUPS, encoding="utf-8", delay=True))
+        except OSError:
+            pass
+        ring: deque = deque(maxlen=SCANNER_LOG_RING_SIZE)
+        handlers.append(_RingHandler(ring))
+        handlers.append(_ShipHandler(name, collection or f"{name}_logs"))
+        for h in handlers:
+            h.setFormatter(fmt)
+            logger.addHandler(h)
+        _RINGS[name] = ring
+        _LOGGERS[name] = logger
+        return logger
+
+
+def recent_logs(name: str, n: int = 100) -> List[str]:
+    """Last n formatted lines of a scanner (newest last), from memory."""
+    ring = _RINGS.get(name.lower())
+    return list(ring)[-n:] if ring else []
+
+
+def flush_logs(timeout: float = 30.0) -> bool:
+    return _SHIPPER.flush(timeout)
+
+
+def shipper_stats() -> Dict[str, int]:
+    return {**_SHIPPER.stats, "pending": len(_SHIPPER._pending)}
+
+
+__all__ = ["get_scanner_logger", "recent_logs", "flush_logs", "shipper_stats"]
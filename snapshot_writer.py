@@ -0,0 +1,177 @@
+"""
+Process-wide single writer for portfolio snapshots.
+
+The Portfolio tab (every Streamlit rerun, every session) and the background
+recorder thread used to append to the history store and upsert to Mongo on
+their own, each with its own dedupe. Now they only `submit_snapshot(docs)`;
+one daemon thread owns both sinks:
+
+- timestamps are floored to the minute and a (minute, coin) key is written at
+  most once (first submission wins, like the store's own dedupe),
+- everything queued within `GROUP_COMMIT_SEC` is committed together: one
+  `append_snapshot` (one fsync) and one DB upsert of the deduped batch. Only
+  keys the local store accepted are remembered, so a failed disk write is
+  retried by the next submission of that minute and never blocks the DB write.
+"""
+from __future__ import annotations
+
+import queue
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from history_parquet import TOTAL_COIN
+from portfolio_history import append_snapshot, read_range
+
+GROUP_COMMIT_SEC = 2.0
+# Minutes whose keys are remembered for dedupe (older submissions are dropped by the store)
+_SEEN_MINUTES = 180
+
+
+def _minute_key(doc: Dict) -> Optional[Tuple[int, str]]:
+    ts = doc.get("timestamp")
+    if ts is None:
+        return None
+    return (int(ts) // 60) * 60, doc.get("coin") or TOTAL_COIN
+
+
+class SnapshotWriter:
+    """Queue + daemon thread; `submit` never blocks on disk or network."""
+
+    def __init__(self, group_commit_sec: float = GROUP_COMMIT_SEC, db_sink=None) -> None:
+        self._queue: "queue.Queue[List[Dict]]" = queue.Queue()
+        self._group_commit_sec = group_commit_sec
+        self._db_sink = db_sink
+        # minute -> set(coin) already committed (or dropped as duplicates)
+        self._seen: Dict[int, set] = {}
+        self._seeded = False
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+        self._idle = threading.Event()
+        self._idle.set()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self.stats = {"submitted": 0, "duplicates": 0, "written": 0, "commits": 0}
+
+    def start(self) -> None:
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="snapshot-writer", daemon=True)
+            self._thread.start()
+
+    def submit(self, docs: List[Dict]) -> None:
+        if not docs:
+            return
+        self.start()
+        with self._pending_lock:
+            self._pending += 1
+            self._idle.clear()
+        self._queue.put(list(docs))
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until everything submitted so far is committed."""
+        return self._idle.wait(timeout)
+
+    # ---------- writer thread ----------
+    def _seed_seen(self) -> None:
+        """Remember the keys of the recent history so restarts do not re-write a minute."""
+        self._seeded = True
+        try:
+            df = read_range(int(time.time()) - _SEEN_MINUTES * 60, columns=["timestamp", "coin"])
+        except Exception:
+            return
+        for ts, coin in zip(df["timestamp"].tolist(), df["coin"].tolist()):
+            minute = (int(ts) // 60) * 60
+            self._seen.setdefault(minute, set()).add(coin if isinstance(coin, str) else TOTAL_COIN)
+
+    def _dedupe(self, docs: List[Dict], batch: Dict[Tuple[int, str], Dict]) -> None:
+        for d in docs:
+            key = _minute_key(d)
+            if key is None:
+                continue
+            minute, series = key
+            if key in batch or series in self._seen.get(minute, ()):
+                self.stats["duplicates"] += 1
+                continue
+            doc = dict(d)
+            doc["timestamp"] = minute
+            batch[key] = doc
+
+    def _remember(self, keys) -> None:
+        for minute, series in keys:
+            self._seen.setdefault(minute, set()).add(series)
+        if len(self._seen) > _SEEN_MINUTES:
+            for minute in sorted(self._seen)[:-_SEEN_MINUTES]:
+                del self._seen[minute]
+
+    def _commit(self, batch: Dict[Tuple[int, str], Dict]) -> None:
+        docs = sorted(batch.values(), key=lambda d: (d["timestamp"], d.get("coin") or ""))
+        written = append_snapshot(docs) or []
+        # append_snapshot trả [] cả khi lỗi đĩa: chỉ nhớ key đã thực sự ghi, minute lỗi sẽ được ghi lại
+        self._remember(k for k in map(_minute_key, written) if k is not None)
+        self.stats["written"] += len(written)
+        self.stats["commits"] += 1
+        # Cloud DB nhận cả batch đã khử trùng, không phụ thuộc kết quả ghi local (upsert theo key)
+        try:
+            (self._db_sink or _default_db_sink)(docs)
+        except Exception as e:
+            print(f"[SnapshotWriter] DB upsert lỗi: {e}")
+
+    def _run(self) -> None:
+        while True:
+            docs = self._queue.get()
+            if not self._seeded:
+                self._seed_seen()
+            taken = 1
+            batch: Dict[Tuple[int, str], Dict] = {}
+            deadline = time.time() + self._group_commit_sec
+            while True:
+                self.stats["submitted"] += len(docs)
+                self._dedupe(docs, batch)
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    docs = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                taken += 1
+            try:
+                if batch:
+                    self._commit(batch)
+            except Exception as e:
+                print(f"[SnapshotWriter] Ghi lịch sử lỗi: {e}")
+            with self._pending_lock:
+                self._pending -= taken
+                if self._pending == 0:
+                    self._idle.set()
+
+
+def _default_db_sink(docs: List[Dict]) -> None:
+    # Import muộn: cloud_db đọc biến môi trường Mongo lúc import
+    from cloud_db import db
+    from db_utils import db_upsert_portfolio_docs_with_retry, db_retry_queue
+
+    db_upsert_portfolio_docs_with_retry(db, docs)
+    db_retry_queue(db)
+
+
+_WRITER: Optional[SnapshotWriter] = None
+_WRITER_LOCK = threading.Lock()
+
+
+def get_snapshot_writer() -> SnapshotWriter:
+    global _WRITER
+    with _WRITER_LOCK:
+        if _WRITER is None:
+            _WRITER = SnapshotWriter()
+        return _WRITER
+
+
+def submit_snapshot(docs: List[Dict]) -> None:
+    """Queue snapshot docs for the process-wide writer (local history + Cloud DB)."""
+    get_snapshot_writer().submit(docs)
+
+
+__all__ = ["SnapshotWriter", "get_snapshot_writer", "submit_snapshot", "GROUP_COMMIT_SEC"]
@@ -0,0 +1,52 @@
+"""
+CloudDB.upsert_many: the filter carries every unique key, so a totals doc (no `coin`) only matches totals.
+
+Chạy: python test_cloud_db.py (hoặc pytest test_cloud_db.py)
+"""
+import time
+
+from cloud_db import CloudDB
+
+
+class FakeCollection:
+    def __init__(self):
+        self.ops = []
+
+    def bulk_write(self, ops, ordered=True):
+        self.ops.extend(ops)
+
+        class Result:
+            upserted_count = len(ops)
+            modified_count = 0
+            matched_count = 0
+        return Result()
+
+
+class FakeMongo:
+    def __init__(self):
+        self.collections = {}
+
+    def __getitem__(self, name):
+        return self.collections.setdefault(name, FakeCollection())
+
+
+def test_upsert_filter_has_every_unique_key():
+    cloud = CloudDB()
+    cloud._db = FakeMongo()
+    cloud._last_ok = time.time() + 3600  # available() không ping
+    docs = [
+        {"timestamp": 60, "value": 10.0},
+        {"timestamp": 60, "coin": "bitcoin", "value": 4.0},
+        {"value": 1.0},  # không có key nào: bỏ qua
+    ]
+    assert cloud.upsert_many("portfolio_history", docs, unique_keys=["timestamp", "coin"]) == 2
+    ops = cloud._db["portfolio_history"].ops
+    assert [op._filter for op in ops] == [{"timestamp": 60, "coin": None}, {"timestamp": 60, "coin": "bitcoin"}]
+    assert ops[0]._doc == {"$set": {"timestamp": 60, "value": 10.0}}
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_") and callable(fn):
+            fn()
+            print(f"OK {name}")
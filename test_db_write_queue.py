@@ -0,0 +1,167 @@
+"""
+Durable write queue: key coalescing, restarts, and one bulk replay per collection.
+
+Chạy: python test_db_write_queue.py (hoặc pytest test_db_write_queue.py)
+"""
+import json
+import os
+import sqlite3
+import tempfile
+
+import db_utils
+from db_write_queue import DurableWriteQueue
+
+T0 = 1_700_000_040
+
+
+def test_enqueue_coalesces_by_key_and_survives_restart():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "queue.sqlite3")
+        q = DurableWriteQueue(path)
+        assert q.enqueue([{"timestamp": T0, "value": 1}, {"timestamp": T0, "coin": "bitcoin", "value": 2}],
+                         "portfolio_history") == 2
+        # UI và recorder gửi lại cùng phút: chỉ giữ bản mới nhất mỗi key
+        assert q.enqueue([{"timestamp": T0, "value": 3}, {"timestamp": T0 + 60, "value": 4}],
+                         "portfolio_history") == 1
+        assert len(q) == 3
+        assert q.stats()["coalesced"] == 1
+
+        q = DurableWriteQueue(path)
+        assert len(q) == 3
+        keys, docs = q.peek("portfolio_history", 10)
+        assert sorted((d["timestamp"], d.get("coin") or "", d["value"]) for d in docs) == \
+            [(T0, "", 3), (T0, "bitcoin", 2), (T0 + 60, "", 4)]
+        q.fail("portfolio_history", keys[:1], "timeout")
+        assert q.stats()["max_attempts"] == 1
+        q.ack("portfolio_history", keys)
+        assert len(q) == 0 and q.collections() == []
+
+
+def test_legacy_fifo_rows_are_folded_into_pending():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "queue.sqlite3")
+        conn = sqlite3.connect(path)
+        conn.execute("CREATE TABLE queue (id INTEGER PRIMARY KEY, enqueued REAL, payload TEXT)")
+        for value in (1, 2):
+            conn.execute("INSERT INTO queue (enqueued, payload) VALUES (?, ?)",
+                         (T0, json.dumps([{"timestamp": T0, "value": value}])))
+        conn.commit()
+        conn.close()
+        q = DurableWriteQueue(path)
+        assert len(q) == 1
+        assert q.peek("portfolio_history", 10)[1] == [{"timestamp": T0, "value": 2}]
+
+
+class FakeDB:
+    def __init__(self):
+        self.up = False
+        self.fail_writes = False
+        self.calls = []
+        self.last_upsert_stats = []
+
+    def available(self):
+        return self.up
+
+    def last_error(self):
+        return "boom"
+
+    def upsert_many(self, collection, docs, unique_keys):
+        docs = list(docs)
+        self.calls.append((collection, docs))
+        self.last_upsert_stats = [{"ops": len(docs), "failed": len(docs) if self.fail_writes else 0}]
+        return 0 if self.fail_writes else len(docs)
+
+
+def test_failed_writes_are_queued_then_replayed_in_one_bulk_upsert():
+    saved = (db_utils._db_write_queue, db_utils._db_retry_interval, db_utils._db_last_retry,
+             db_utils._db_consecutive_failures)
+    with tempfile.TemporaryDirectory() as tmp:
+        db_utils._db_write_queue = DurableWriteQueue(os.path.join(tmp, "queue.sqlite3"))
+        try:
+            db = FakeDB()
+            # DB down: ba lần ghi chồng lên nhau chỉ để lại một doc mỗi key
+            for value in (1, 2, 3):
+                db_utils.db_upsert_portfolio_docs_with_retry(db, [
+                    {"timestamp": T0, "value": value},
+                    {"timestamp": T0, "coin": "bitcoin", "value": value * 10},
+                ])
+            assert len(db_utils._db_write_queue) == 2 and db.calls == []
+
+            db.up, db.fail_writes = True, True
+            db_utils._db_last_retry = 0
+            db_utils.db_retry_queue(db)
+            assert len(db.calls) == 1 and len(db_utils._db_write_queue) == 2
+            assert db_utils._db_write_queue.stats()["max_attempts"] == 1
+
+            db.fail_writes = False
+            db.calls = []
+            db_utils._db_last_retry = 0
+            db_utils.db_retry_queue(db)
+            assert len(db_utils._db_write_queue) == 0
+            assert [c for c, _ in db.calls] == [db_utils.PORTFOLIO_COLLECTION]
+            assert [(d["timestamp"], d.get("coin"), d["value"]) for d in db.calls[0][1]] == \
+                [(T0, None, 3), (T0, "bitcoin", 30)]
+        finally:
+            (db_utils._db_write_queue, db_utils._db_retry_interval, db_utils._db_last_retry,
+             db_utils._db_consecutive_failures) = saved
+
+
+class PoisonDB(FakeDB):
+    """DB nhận ghi nhưng từ chối riêng doc có value âm (giống writeError của bulk unordered)."""
+
+    def __init__(self):
+        super().__init__()
+        self.up = True
+        self.stored = {}
+
+    def upsert_many(self, collection, docs, unique_keys):
+        docs = list(docs)
+        self.calls.append((collection, docs))
+        bad = [d for d in docs if d["value"] < 0]
+        for d in docs:
+            if d["value"] >= 0:
+                self.stored[(d["timestamp"], d.get("coin"))] = d["value"]
+        self.last_upsert_stats = [{"ops": len(docs), "failed": len(bad)}]
+        return len(docs) - len(bad)
+
+
+def test_poison_doc_is_isolated_then_dropped():
+    saved = (db_utils._db_write_queue, db_utils._db_retry_interval, db_utils._db_last_retry,
+             db_utils._db_consecutive_failures)
+    with tempfile.TemporaryDirectory() as tmp:
+        queue = db_utils._db_write_queue = DurableWriteQueue(os.path.join(tmp, "queue.sqlite3"))
+        try:
+            queue.enqueue([{"timestamp": T0 + 60 * i, "value": -1 if i == 5 else i} for i in range(16)],
+                          db_utils.PORTFOLIO_COLLECTION)
+            db = PoisonDB()
+            db_utils._db_last_retry = 0
+            db_utils.db_retry_queue(db)
+            # Chia đôi: 15 doc tốt được ghi và xóa khỏi queue, chỉ còn doc hỏng
+            assert len(db.stored) == 15 and len(queue) == 1
+            assert len(db.calls) <= 1 + 2 * 4
+            assert queue.peek(db_utils.PORTFOLIO_COLLECTION, 10)[1] == [{"timestamp": T0 + 300, "value": -1}]
+
+            for _ in range(db_utils._DB_POISON_ATTEMPTS - 1):
+                db_utils._db_last_retry = 0
+                db_utils.db_retry_queue(db)
+            assert len(queue) == 0 and queue.stats()["dropped"] == 1
+        finally:
+            (db_utils._db_write_queue, db_utils._db_retry_interval, db_utils._db_last_retry,
+             db_utils._db_consecutive_failures) = saved
+
+
+def test_peek_is_served_by_the_order_index():
+    with tempfile.TemporaryDirectory() as tmp:
+        q = DurableWriteQueue(os.path.join(tmp, "queue.sqlite3"))
+        q.enqueue([{"timestamp": T0, "value": 1}], "portfolio_history")
+        plan = " ".join(r[-1] for r in q._db().execute(
+            "EXPLAIN QUERY PLAN SELECT key, doc FROM pending WHERE collection = ? ORDER BY enqueued, key LIMIT 10",
+            ("portfolio_history",)))
+        assert "pending_order" in plan and "TEMP B-TREE" not in plan
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_") and callable(fn):
+            fn()
+            print(f"OK {name}")
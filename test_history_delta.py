@@ -0,0 +1,201 @@
+"""
+Delta codec: encode/decode round trip, and Cloud DB reads that start in the middle of a day.
+
+Chạy: python test_history_delta.py (hoặc pytest test_history_delta.py)
+"""
+import calendar
+import os
+import tempfile
+import time
+
+import db_utils
+from db_write_queue import DurableWriteQueue
+from history_delta import DeltaEncoder, DeltaHistoryStore, decode_frames, frame_to_mongo
+from history_store import SegmentedHistoryStore
+
+T0 = calendar.timegm(time.strptime("2024-03-05", "%Y-%m-%d"))
+
+
+def _snapshot(ts, amounts):
+    """1 doc tổng + 1 doc mỗi coin, giống snapshot của app."""
+    docs = []
+    for i, (coin, amount) in enumerate(sorted(amounts.items())):
+        value = amount * (100.0 + i + (ts - T0) / 60)
+        invested = amount * 90.0
+        docs.append({"timestamp": ts, "coin": coin, "value": value, "invested": invested,
+                     "PNL": value - invested, "amount": amount, "avg_price": 90.0})
+    docs.append({"timestamp": ts, "value": sum(d["value"] for d in docs),
+                 "PNL": sum(d["PNL"] for d in docs)})
+    return docs
+
+
+def _history():
+    """Hai ngày, 15 phút một snapshot; amount của bitcoin đổi giữa ngày."""
+    docs = []
+    for day in range(2):
+        for m in range(0, 24 * 60, 15):
+            ts = T0 + day * 86400 + m * 60
+            btc = 1.0 if m < 600 else 1.5
+            docs.extend(_snapshot(ts, {"bitcoin": btc, "ethereum": 10.0}))
+    return docs
+
+
+def _key(d):
+    return (d["timestamp"], d.get("coin") or "")
+
+
+def _same(got, expected):
+    got, expected = sorted(got, key=_key), sorted(expected, key=_key)
+    assert len(got) == len(expected)
+    for x, y in zip(got, expected):
+        assert x.keys() == y.keys(), (x, y)
+        for k in x:
+            assert abs(x[k] - y[k]) < 1e-6 if isinstance(y[k], float) else x[k] == y[k], (k, x, y)
+
+
+def test_round_trip():
+    docs = _history()
+    frames = DeltaEncoder(keyframe_interval=3600).encode(docs)
+    assert len(frames) == len({d["timestamp"] for d in docs})
+    assert sum(1 for f in frames if "s" in f) < len(frames)  # statics chỉ gửi khi đổi / keyframe
+    _same(list(decode_frames(frames)), docs)
+
+
+def test_store_round_trip_and_append():
+    docs = _history()
+    with tempfile.TemporaryDirectory() as tmp:
+        store = DeltaHistoryStore(os.path.join(tmp, "delta"))
+        half = len(docs) // 2
+        store.append(docs[:half])
+        store.append(docs[half:])
+        _same(store.load_all(), docs)
+
+
+class FakeDB:
+    """Chỉ đủ cho iter_find trên collection delta (lọc timestamp, sắp tăng dần)."""
+
+    def __init__(self, frames):
+        self.frames = frames
+        self.filters = []
+
+    def available(self):
+        return True
+
+    def iter_find(self, collection, filter=None, projection=None, sort_field=None, ascending=True,
+                  limit=None, batch_size=None):
+        cond = (filter or {}).get("timestamp", {})
+        self.filters.append(cond)
+        for f in sorted(self.frames, key=lambda f: f["timestamp"]):
+            if f["timestamp"] >= cond.get("$gte", f["timestamp"]) and f["timestamp"] <= cond.get("$lte", f["timestamp"]):
+                yield f
+
+
+def _nested(doc):
+    """frame_to_mongo dùng key chấm ($set); Mongo trả về dạng lồng nhau."""
+    out = {}
+    for k, v in doc.items():
+        if "." in k:
+            top, sub = k.split(".", 1)
+            out.setdefault(top, {})[sub] = v
+        else:
+            out[k] = v
+    return out
+
+
+def _as_mongo(frame):
+    return _nested(frame_to_mongo(frame))
+
+
+def test_db_read_from_mid_day_start():
+    docs = _history()
+    frames = [_as_mongo(f) for f in DeltaEncoder(keyframe_interval=3600).encode(docs)]
+    db = FakeDB(frames)
+    start = T0 + 86400 + 11 * 3600 + 7 * 60  # giữa ngày 2, không trùng keyframe
+    backend = db_utils.HISTORY_BACKEND
+    db_utils.HISTORY_BACKEND = "delta"
+    try:
+        got = list(db_utils.iter_portfolio_history_from_db(db, start=start))
+        totals = list(db_utils.iter_portfolio_history_from_db(db, start=start, coin="__total__"))
+    finally:
+        db_utils.HISTORY_BACKEND = backend
+    assert db.filters[0]["$gte"] == T0 + 86400  # đọc từ đầu ngày UTC
+    expected = [d for d in docs if d["timestamp"] >= start]
+    _same(got, expected)
+    assert all(d["invested"] is not None and d["amount"] is not None for d in got if d.get("coin"))
+    assert len(totals) == len({d["timestamp"] for d in expected})
+
+
+class FailingUpsertDB:
+    """upsert_many lỗi ở lần gọi đầu, các lần sau ghi nhận payload."""
+
+    def __init__(self):
+        self.calls = 0
+        self.written = []
+        self.last_upsert_stats = []
+
+    def available(self):
+        return True
+
+    def last_error(self):
+        return "boom"
+
+    def upsert_many(self, collection, docs, unique_keys):
+        self.calls += 1
+        docs = list(docs)
+        failed = len(docs) if self.calls == 1 else 0
+        self.last_upsert_stats = [{"ops": len(docs), "failed": failed}]
+        if not failed:
+            self.written.extend(_nested(d) for d in docs)
+        return len(docs) - failed
+
+
+def test_failed_db_write_does_not_advance_encoder():
+    first, second = _snapshot(T0, {"bitcoin": 1.0}), _snapshot(T0 + 60, {"bitcoin": 1.0})
+    saved = (db_utils.HISTORY_BACKEND, db_utils._db_write_queue, db_utils._db_retry_interval,
+             db_utils._db_consecutive_failures)
+    with tempfile.TemporaryDirectory() as tmp:
+        db_utils.HISTORY_BACKEND = "delta"
+        db_utils._db_write_queue = DurableWriteQueue(os.path.join(tmp, "queue.sqlite3"))
+        db_utils._db_delta_encoder.reset()
+        try:
+            db = FailingUpsertDB()
+            db_utils.db_upsert_portfolio_docs_with_retry(db, first)   # lỗi: statics chưa lên DB
+            db_utils.db_upsert_portfolio_docs_with_retry(db, second)
+        finally:
+            db_utils._db_delta_encoder.reset()
+            (db_utils.HISTORY_BACKEND, db_utils._db_write_queue, db_utils._db_retry_interval,
+             db_utils._db_consecutive_failures) = saved
+    # Frame ghi thành công phải tự giải mã được (statics gửi lại sau lần lỗi)
+    assert [f.get("s") for f in db.written] == [{"bitcoin": [1.0, 90.0, 90.0]}]
+    _same(list(decode_frames(db.written)), second)
+
+
+def test_store_write_failure_reprimes_encoder():
+    # amount đổi đúng ở snapshot ghi lỗi
+    before, failed, after = (_snapshot(T0, {"bitcoin": 1.0}), _snapshot(T0 + 60, {"bitcoin": 1.5}),
+                             _snapshot(T0 + 120, {"bitcoin": 1.5}))
+    with tempfile.TemporaryDirectory() as tmp:
+        store = DeltaHistoryStore(os.path.join(tmp, "delta"))
+        store.append(before)
+        write = SegmentedHistoryStore._write_segments
+
+        def broken(self, frames):
+            raise OSError("disk full")
+
+        SegmentedHistoryStore._write_segments = broken
+        try:
+            try:
+                store.append(failed)
+            except OSError:
+                pass
+        finally:
+            SegmentedHistoryStore._write_segments = write
+        store.append(failed + after)
+        _same(DeltaHistoryStore(os.path.join(tmp, "delta")).load_all(), before + failed + after)
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_") and callable(fn):
+            fn()
+            print(f"OK {name}")
@@ -0,0 +1,103 @@
+"""
+Key index / memmap coin codes stay stable when COIN_LIST changes between runs.
+
+Chạy: python test_history_keyindex.py (hoặc pytest test_history_keyindex.py)
+"""
+import json
+import os
+import tempfile
+
+import numpy as np
+
+import history_memmap
+from history_keyindex import KeyIndex
+from history_memmap import MemmapHistoryStore
+from history_store import SegmentedHistoryStore
+
+T0 = 1_700_000_000 - 1_700_000_000 % 86400 + 3600
+
+
+def _docs(ts, coins):
+    return [{"timestamp": ts, "value": 1.0}] + [{"timestamp": ts, "coin": c, "value": 2.0} for c in coins]
+
+
+def _with_coin_list(order, fn):
+    """Chạy fn với COIN_LIST giả (thứ tự khác) cho các bảng mã seed từ COIN_LIST."""
+    saved = history_memmap.COIN_INDEX
+    history_memmap.COIN_INDEX = {c: i for i, c in enumerate(order)}
+    try:
+        return fn()
+    finally:
+        history_memmap.COIN_INDEX = saved
+
+
+def test_segment_key_slots_survive_restart_with_new_coin():
+    with tempfile.TemporaryDirectory() as tmp:
+        store = SegmentedHistoryStore(tmp)
+        assert len(store.append(_docs(T0, ["bitcoin", "ethereum"]))) == 3
+        slots = dict(store.keys()._slots)
+
+        # Lần chạy sau: coin mới xuất hiện, snapshot cũ gửi lại phải bị coi là trùng
+        store = SegmentedHistoryStore(tmp)
+        assert store.append(_docs(T0, ["bitcoin", "ethereum"])) == []
+        written = store.append(_docs(T0, ["newcoin"]) + _docs(T0 + 60, ["newcoin", "bitcoin"]))
+        assert [(d["timestamp"], d.get("coin")) for d in written] == \
+            [(T0, "newcoin"), (T0 + 60, None), (T0 + 60, "newcoin"), (T0 + 60, "bitcoin")]
+        new_slots = store.keys()._slots
+        assert {c: new_slots[c] for c in slots} == slots
+        assert len(set(new_slots.values())) == len(new_slots)
+
+        store = SegmentedHistoryStore(tmp)
+        for d in store.iter_docs():
+            assert (d["timestamp"], d.get("coin")) in store.keys()
+        assert (T0 + 120, "newcoin") not in store.keys()
+
+
+def test_colliding_legacy_slot_map_is_rebuilt():
+    with tempfile.TemporaryDirectory() as tmp:
+        store = SegmentedHistoryStore(tmp)
+        store.append(_docs(T0, ["bitcoin"]))
+        meta_path = os.path.join(tmp, "_keys.meta.json")
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        # Map kiểu cũ: coin thêm sau nhận slot trùng với một coin của COIN_LIST
+        meta["slots"] = {"bitcoin": 1, "solana": 1}
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        index = KeyIndex(os.path.join(tmp, "_keys"))
+        index.open(store.signature(), lambda: [(T0, None), (T0, "bitcoin")])
+        assert (T0, "bitcoin") in index
+        assert (T0, "solana") not in index
+
+
+def test_memmap_coin_table_survives_coin_list_reorder():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "history.bin")
+
+        def first_run():
+            store = MemmapHistoryStore(path)
+            assert len(store.append(_docs(T0, ["bitcoin", "ethereum", "newcoin"]))) == 4
+            return np.array(store.view()["coin"]).tolist()
+
+        codes = _with_coin_list(["bitcoin", "ethereum"], first_run)
+        assert codes == [-1, 0, 1, 2]  # newcoin nhận max + 1
+
+        def second_run():
+            store = MemmapHistoryStore(path)
+            assert store.append(_docs(T0, ["bitcoin", "ethereum", "newcoin"])) == []
+            assert len(store.append(_docs(T0 + 60, ["solana", "ethereum"]))) == 3
+            return store
+
+        # COIN_LIST đổi thứ tự và thêm coin ở đầu: mã đã lưu không đổi
+        store = _with_coin_list(["solana", "newcoin", "ethereum", "bitcoin"], second_run)
+        got = sorted((d["timestamp"] - T0, d.get("coin") or "") for d in store.load_all())
+        assert got == [(0, ""), (0, "bitcoin"), (0, "ethereum"), (0, "newcoin"),
+                       (60, ""), (60, "ethereum"), (60, "solana")]
+        assert store.read_range(coin="newcoin")["timestamp"].tolist() == [T0]
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_") and callable(fn):
+            fn()
+            print(f"OK {name}")
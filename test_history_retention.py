@@ -0,0 +1,132 @@
+"""
+Retention: local downsampling and Cloud DB pruning only inside the buckets that were downsampled.
+
+Chạy: python test_history_retention.py (hoặc pytest test_history_retention.py)
+"""
+import calendar
+import os
+import tempfile
+import time
+
+import db_utils
+from history_retention import apply_to_segments, downsample, downsampled_buckets
+from history_store import SegmentedHistoryStore
+
+DAY = "2024-01-02"
+T0 = calendar.timegm(time.strptime(DAY, "%Y-%m-%d"))
+NOW = T0 + 30 * 86400  # ngày đã đóng, tuổi giữa 7 và 90 ngày -> "1h"
+
+
+def _match(doc, query):
+    for key, cond in query.items():
+        if key == "$or":
+            if not any(_match(doc, q) for q in cond):
+                return False
+            continue
+        val = doc.get(key)
+        if isinstance(cond, dict):
+            for op, arg in cond.items():
+                ok = {
+                    "$exists": lambda: (key in doc) == arg,
+                    "$gte": lambda: val is not None and val >= arg,
+                    "$gt": lambda: val is not None and val > arg,
+                    "$lt": lambda: val is not None and val < arg,
+                    "$lte": lambda: val is not None and val <= arg,
+                    "$ne": lambda: val != arg,
+                    "$nin": lambda: val not in arg,
+                }[op]()
+                if not ok:
+                    return False
+        elif val != cond:
+            return False
+    return True
+
+
+class FakeDB:
+    def __init__(self):
+        self.collections = {}
+
+    def available(self):
+        return True
+
+    def delete_many(self, collection, query):
+        docs = self.collections.get(collection, [])
+        keep = [d for d in docs if not _match(d, query)]
+        self.collections[collection] = keep
+        return len(docs) - len(keep)
+
+
+def _doc(ts, coin=None, value=1.0):
+    d = {"timestamp": ts, "value": value}
+    if coin:
+        d["coin"] = coin
+    return d
+
+
+def test_downsampled_buckets_only_lists_buckets_that_lost_docs():
+    docs = [_doc(T0), _doc(T0 + 60), _doc(T0 + 3600), _doc(T0 + 60, "bitcoin")]
+    kept = downsample(docs, 3600)
+    assert downsampled_buckets(docs, kept, 3600) == {"__total__": [[T0, T0]]}
+
+
+def test_prune_keeps_cloud_data_outside_downsampled_buckets():
+    with tempfile.TemporaryDirectory() as tmp:
+        store = SegmentedHistoryStore(os.path.join(tmp, "segments"))
+        # Local: giờ 0 có 3 snapshot tổng + 2 bitcoin; giờ 1 chỉ có 1 snapshot tổng; giờ 2 bị mất (downtime)
+        store.append([_doc(T0), _doc(T0 + 60), _doc(T0 + 120, value=0),
+                      _doc(T0, "bitcoin"), _doc(T0 + 60, "bitcoin"), _doc(T0 + 3600)])
+        result = apply_to_segments(store, os.path.join(tmp, "state.json"), now=NOW)
+        assert result[DAY]["resolution"] == "1h"
+        assert [(d["timestamp"], d.get("coin")) for d in store.iter_docs()] == \
+            [(T0, None), (T0, "bitcoin"), (T0 + 3600, None)]
+
+        cloud = [_doc(T0), _doc(T0 + 60), _doc(T0 + 120, value=0), _doc(T0 + 180),   # giờ 0, tổng
+                 _doc(T0, "bitcoin"), _doc(T0 + 60, "bitcoin"),                      # giờ 0, bitcoin
+                 _doc(T0 + 60, "ethereum"),                                          # series local không có
+                 _doc(T0 + 3600), _doc(T0 + 3660),                                   # giờ 1: local không gộp
+                 _doc(T0 + 7200), _doc(T0 + 7260)]                                   # giờ 2: local mất dữ liệu
+        db = FakeDB()
+        db.collections[db_utils.PORTFOLIO_COLLECTION] = [dict(d) for d in cloud]
+        removed = db_utils.prune_portfolio_history_db(db, result)
+        left = sorted((d["timestamp"] - T0, d.get("coin") or "") for d in db.collections[db_utils.PORTFOLIO_COLLECTION])
+        assert removed == 4
+        assert left == [(0, ""), (0, "bitcoin"), (60, "ethereum"), (3600, ""), (3660, ""), (7200, ""), (7260, "")]
+
+
+def test_prune_timeseries_collection_uses_same_buckets():
+    result = {DAY: {"resolution": "1h", "buckets": {"__total__": [[T0, T0]]}}}
+    to_date = db_utils.ts_store.to_date
+    db = FakeDB()
+    db.collections[db_utils.PORTFOLIO_TS_COLLECTION] = [
+        {"timestamp": to_date(T0), "coin": "__total__"},
+        {"timestamp": to_date(T0 + 60), "coin": "__total__"},
+        {"timestamp": to_date(T0 + 60), "coin": "bitcoin"},
+        {"timestamp": to_date(T0 + 3660), "coin": "__total__"},
+    ]
+    writes_enabled = db_utils.ts_store.writes_enabled
+    db_utils.ts_store.writes_enabled = lambda: True
+    try:
+        assert db_utils.prune_portfolio_history_db(db, result) == 1
+    finally:
+        db_utils.ts_store.writes_enabled = writes_enabled
+    assert len(db.collections[db_utils.PORTFOLIO_TS_COLLECTION]) == 3
+
+
+def test_prune_skips_delta_backend():
+    result = {DAY: {"resolution": "1h", "buckets": {"__total__": [[T0, T0]]}}}
+    db = FakeDB()
+    db.collections[db_utils.PORTFOLIO_DELTA_COLLECTION] = [{"timestamp": T0}, {"timestamp": T0 + 60}]
+    backend = db_utils.HISTORY_BACKEND
+    db_utils.HISTORY_BACKEND = "delta"
+    try:
+        assert db_utils.prune_portfolio_history_db(db, result) == 0
+    finally:
+        db_utils.HISTORY_BACKEND = backend
+    assert len(db.collections[db_utils.PORTFOLIO_DELTA_COLLECTION]) == 2
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_") and callable(fn):
+            fn()
+            print(f"OK {name}")
@@ -0,0 +1,85 @@
+"""
+Scanner log shipper: TTL index on the first insert into a `*_logs` collection, legacy string `ts` converted.
+
+Chạy: python test_scanner_log.py (hoặc pytest test_scanner_log.py)
+"""
+import time
+from datetime import datetime, timezone
+
+from cloud_db import CloudDB
+from scanner_log import _LogShipper
+
+
+class FakeCollection:
+    def __init__(self):
+        self.docs = []
+        self.indexes = {"_id_": {"key": [("_id", 1)]}}
+        self.create_calls = 0
+
+    def index_information(self):
+        return dict(self.indexes)
+
+    def create_index(self, keys, name, **options):
+        self.create_calls += 1
+        self.indexes[name] = {"key": list(keys), **options}
+
+    def insert_many(self, docs, ordered=True):
+        self.docs.extend(docs)
+
+        class Result:
+            inserted_ids = list(range(len(docs)))
+        return Result()
+
+    def update_many(self, filter, update):
+        # Chỉ đủ cho bước chuyển ISO string -> date của ensure_indexes
+        field = next(iter(filter))
+        assert filter[field] == {"$type": "string"} and update[0]["$set"][field]["$dateFromString"]
+        for d in self.docs:
+            if isinstance(d.get(field), str):
+                d[field] = datetime.fromisoformat(d[field]).replace(tzinfo=timezone.utc)
+
+
+class FakeMongo:
+    def __init__(self):
+        self.collections = {}
+
+    def __getitem__(self, name):
+        return self.collections.setdefault(name, FakeCollection())
+
+    def list_collection_names(self):
+        return list(self.collections)
+
+
+def _cloud_db():
+    cloud = CloudDB()
+    cloud._db = FakeMongo()
+    cloud._last_ok = time.time() + 3600  # available() không ping
+    return cloud
+
+
+def test_first_insert_creates_ttl_index_and_converts_legacy_ts():
+    cloud = _cloud_db()
+    legacy = cloud._db["btc_logs"]
+    legacy.docs.append({"ts": "2024-01-02T03:04:05.123456", "line": "old"})
+    cloud.ensure_indexes(["dominance_history"])
+
+    shipper = _LogShipper()
+    now = datetime.now(timezone.utc)
+    assert shipper._ship(cloud, {"btc_logs": [({"ts": now, "line": "a"}, 0)],
+                                 "bnb_logs": [({"ts": now, "line": "b"}, 0)]}) == 2
+    for name in ("btc_logs", "bnb_logs"):
+        assert cloud._db[name].indexes["ts_ttl"]["expireAfterSeconds"] > 0
+    assert all(isinstance(d["ts"], datetime) for d in legacy.docs)
+
+    shipper._ship(cloud, {"btc_logs": [({"ts": now, "line": "c"}, 0)]})
+    assert legacy.create_calls == 1
+    # Lần ensure theo collection không thay report đầy đủ, cũng không chặn lần chạy đầy đủ
+    assert set(cloud.index_report) == {"dominance_history", "btc_logs", "bnb_logs"}
+    assert "portfolio_history" in cloud.ensure_indexes()
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_") and callable(fn):
+            fn()
+            print(f"OK {name}")
@@ -0,0 +1,130 @@
+"""
+SOL block parser: `decode_blocks` must agree with `json.loads`, also on escaped strings.
+
+Chạy: python test_sol_block_parser.py (hoặc pytest test_sol_block_parser.py)
+"""
+import json
+
+from SOL.block_parser import (
+    SYSTEM_PROGRAM,
+    audit_block,
+    decode_blocks,
+    extract_transfers,
+    full_walk_transfers,
+    tx_count,
+)
+
+USDC = "EPjFWdd5AufqSSqeM2qN1xzybapC8G4wEGGkZwyTDt1v"
+TOKEN_PROGRAM = "TokenkegQfeZyiNwAJbNbGKPFXCWuBvf9Ss623VQ5DA"
+VOTE_PROGRAM = "Vote111111111111111111111111111111111111111"
+
+# Chuỗi khó cho bộ quét byte: dấu " và \ escape, chuỗi \ chẵn/lẻ trước ", ngoặc và key giả trong chuỗi
+TRICKY_LOGS = [
+    'say "hi" {[ not a bracket ]}',
+    "path C:\\dir\\",
+    "\\\\\\\"still inside\\\\",
+    '"transactions":[{"fake": 1}]',
+    "unicode đ ✓ \u0000 \t\n",
+    "ends with a backslash \\",
+    "",
+]
+
+
+def _vote_tx(i):
+    return {
+        "transaction": {"signatures": [f"vote{i}"],
+                        "message": {"accountKeys": [f"validator{i}", VOTE_PROGRAM],
+                                    "instructions": [{"programIdIndex": 1, "accounts": [0], "data": "x\"]}"}]}},
+        "meta": {"preBalances": [10, 1], "postBalances": [5, 1], "logMessages": TRICKY_LOGS},
+    }
+
+
+def _sol_tx(i, lamports):
+    return {
+        "transaction": {"signatures": [f"sol{i}"],
+                        "message": {"accountKeys": [f"from{i}", f"to{i}", SYSTEM_PROGRAM],
+                                    "instructions": [{"programIdIndex": 2, "accounts": [0, 1], "data": "3Bxs"}]}},
+        "meta": {"preBalances": [lamports + 10_000, 0, 1], "postBalances": [5_000, lamports, 1],
+                 "logMessages": ["Program 11111111111111111111111111111111 invoke [1]", *TRICKY_LOGS]},
+    }
+
+
+def _usdc_tx(i, amount):
+    def bal(idx, owner, amt):
+        return {"accountIndex": idx, "mint": USDC, "owner": owner, "programId": TOKEN_PROGRAM,
+                "uiTokenAmount": {"amount": str(amt), "decimals": 6}}
+
+    return {
+        "transaction": {"signatures": [f"usdc{i}"],
+                        "message": {"accountKeys": [f"alice{i}", f"bob{i}", TOKEN_PROGRAM],
+                                    "instructions": [{"programIdIndex": 2, "accounts": [0, 1], "data": "\\\""}]}},
+        "meta": {"preBalances": [1, 1, 1], "postBalances": [1, 1, 1],
+                 "preTokenBalances": [bal(0, f"alice{i}", amount), bal(1, f"bob{i}", 0)],
+                 "postTokenBalances": [bal(0, f"alice{i}", 0), bal(1, f"bob{i}", amount)],
+                 "logMessages": TRICKY_LOGS},
+    }
+
+
+def _response(slots=(1, 2)):
+    """Batch getBlock: mỗi slot một block, vote xen kẽ với giao dịch SOL/USDC."""
+    out = []
+    for slot in slots:
+        txs = []
+        for i in range(6):
+            txs.append(_vote_tx(f"{slot}-{i}"))
+            if i % 2 == 0:
+                txs.append(_sol_tx(f"{slot}-{i}", (i + 1) * 10 ** 9))
+            if i % 3 == 0:
+                txs.append(_usdc_tx(f"{slot}-{i}", (i + 1) * 10 ** 12))
+        out.append({"jsonrpc": "2.0", "id": slot,
+                    "result": {"blockhash": 'h"\\{', "parentSlot": slot - 1, "blockTime": 1_700_000_000,
+                               "transactions": txs, "note": "\"transactions\":["}})
+    return out
+
+
+def _strip(block):
+    return {k: v for k, v in block.items() if not k.startswith("_") and k != "transactions"}
+
+
+def test_decode_blocks_matches_json_loads():
+    ref = _response()
+    for raw in (json.dumps(ref).encode(), json.dumps(ref, ensure_ascii=False, indent=1).encode("utf-8")):
+        got = decode_blocks(raw, mints=[USDC])
+        expected = json.loads(raw)
+        assert len(got) == len(expected)
+        for g, e in zip(got, expected):
+            gb, eb = g["result"], e["result"]
+            assert _strip(gb) == _strip(eb)
+            assert tx_count(gb) == len(eb["transactions"])
+            assert json.loads(bytes(gb["_tx_array"])) == eb["transactions"]
+            kept = [json.loads(t) for t in gb["_raw_txs"]]
+            assert kept == [tx for tx in eb["transactions"]
+                            if tx["transaction"]["signatures"][0].startswith(("sol", "usdc"))]
+
+
+def test_fast_path_agrees_with_full_walk():
+    raw = json.dumps(_response()).encode()
+    for g, e in zip(decode_blocks(raw, mints=[USDC]), json.loads(raw)):
+        sol, tokens, skipped = extract_transfers(g["result"], [USDC])
+        assert (sol, tokens) == full_walk_transfers(e["result"], [USDC])
+        assert len(sol) == 3 and len(tokens) == 2 and skipped == 6
+        assert audit_block(g["result"], [USDC])[2]
+
+
+def test_single_block_and_fallback():
+    block = _response(slots=(7,))[0]["result"]
+    raw = json.dumps({"jsonrpc": "2.0", "id": 7, "result": block}).encode()
+    got = decode_blocks(raw)
+    assert got["result"]["_tx_count"] == len(block["transactions"])
+    # Không có System Program / mint theo dõi -> chỉ giữ giao dịch SOL
+    assert len(got["result"]["_raw_txs"]) == 3
+    # Mảng "transactions" không thuộc block nào (cấu trúc lạ): quay về json.loads
+    odd = json.dumps({"result": {"meta": {"transactions": [{"a": "\\\""}]}}}).encode()
+    assert decode_blocks(odd) == json.loads(odd)
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_") and callable(fn):
+            fn()
+            print(f"OK {name}")
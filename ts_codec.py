@@ -0,0 +1,384 @@
+"""
+Gorilla-style compressed time-series codec.
+
+Timestamps are stored as delta-of-delta with variable bit widths, float columns
+as the XOR of consecutive IEEE-754 bit patterns (leading/trailing zero windows),
+as in Facebook's Gorilla TSDB. Series are cut into blocks of `block_size`
+points; a small index (first/last timestamp, count, offset per block) at the
+front of the blob lets a range read decode only the overlapping blocks.
+
+Blob layout:
+  b"GRL1" | u16 ncols | (u8 len, utf-8 name) * ncols | u32 nblocks
+  | nblocks * (i64 first_ts, i64 last_ts, u32 count, u32 offset, u32 length)
+  | block payloads (timestamps bitstream, then each column)
+
+Meant for cold / archival series that are written once and read many times
+(`frame_to_blob`, `read_csv_series` with a compressed sidecar next to a CSV,
+`to_mongo_blocks` for Mongo payloads). CSVs that are still being appended to,
+like the dominance / market-cap history, should be read with `pd.read_csv`:
+the sidecar would be rebuilt on every read.
+Run `python bench_ts_codec.py` for size / decode-speed numbers.
+"""
+from __future__ import annotations
+
+import os
+import struct
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+MAGIC = b"GRL1"
+BLOCK_SIZE = 1024
+SIDECAR_SUFFIX = ".grl"
+
+_INDEX_ENTRY = struct.Struct("<qqIII")
+_MASK64 = (1 << 64) - 1
+
+# (prefix bits, prefix length, payload bits) for delta-of-delta buckets
+_DOD_BUCKETS = [(0b10, 2, 7), (0b110, 3, 9), (0b1110, 4, 12)]
+
+
+class BitWriter:
+    def __init__(self) -> None:
+        self._buf = bytearray()
+        self._acc = 0
+        self._n = 0
+
+    def write(self, value: int, nbits: int) -> None:
+        if nbits == 0:
+            return
+        self._acc = (self._acc << nbits) | (value & ((1 << nbits) - 1))
+        self._n += nbits
+        while self._n >= 8:
+            self._n -= 8
+            self._buf.append((self._acc >> self._n) & 0xFF)
+        self._acc &= (1 << self._n) - 1
+
+    def getvalue(self) -> bytes:
+        if self._n:
+            return bytes(self._buf) + bytes([(self._acc << (8 - self._n)) & 0xFF])
+        return bytes(self._buf)
+
+
+class BitReader:
+    def __init__(self, data: bytes) -> None:
+        self._data = bytes(data) + b"\x00" * 9
+        self._pos = 0
+
+    def read(self, nbits: int) -> int:
+        if nbits == 0:
+            return 0
+        pos = self._pos
+        first = pos >> 3
+        last = (pos + nbits + 7) >> 3
+        chunk = int.from_bytes(self._data[first:last], "big")
+        self._pos = pos + nbits
+        return (chunk >> ((last << 3) - pos - nbits)) & ((1 << nbits) - 1)
+
+    def bit(self) -> int:
+        return self.read(1)
+
+
+def _f2u(v: float) -> int:
+    return struct.unpack("<Q", struct.pack("<d", v))[0]
+
+
+def _u2f(u: int) -> float:
+    return struct.unpack("<d", struct.pack("<Q", u))[0]
+
+
+def _signed(u: int, nbits: int) -> int:
+    return u - (1 << nbits) if u >= 1 << (nbits - 1) else u
+
+
+# ---------- timestamps: delta-of-delta ----------
+def _write_timestamps(w: BitWriter, ts: Sequence[int]) -> None:
+    prev = int(ts[0])
+    prev_delta = 0
+    w.write(prev & _MASK64, 64)
+    for t in ts[1:]:
+        t = int(t)
+        delta = t - prev
+        dod = delta - prev_delta
+        if dod == 0:
+            w.write(0, 1)
+        else:
+            for prefix, plen, bits in _DOD_BUCKETS:
+                lim = 1 << (bits - 1)
+                if -lim < dod <= lim:
+                    w.write(prefix, plen)
+                    w.write(dod + lim - 1, bits)
+                    break
+            else:
+                w.write(0b1111, 4)
+                w.write(dod & _MASK64, 64)
+        prev, prev_delta = t, delta
+
+
+def _read_timestamps(r: BitReader, count: int) -> List[int]:
+    prev = _signed(r.read(64), 64)
+    out = [prev]
+    prev_delta = 0
+    for _ in range(count - 1):
+        if r.bit() == 0:
+            dod = 0
+        elif r.bit() == 0:
+            dod = r.read(7) - (1 << 6) + 1
+        elif r.bit() == 0:
+            dod = r.read(9) - (1 << 8) + 1
+        elif r.bit() == 0:
+            dod = r.read(12) - (1 << 11) + 1
+        else:
+            dod = _signed(r.read(64), 64)
+        prev_delta += dod
+        prev += prev_delta
+        out.append(prev)
+    return out
+
+
+# ---------- floats: XOR ----------
+def _write_values(w: BitWriter, values: Sequence[float]) -> None:
+    prev = _f2u(float(values[0]))
+    w.write(prev, 64)
+    lead, trail = -1, -1
+    for v in values[1:]:
+        cur = _f2u(float(v))
+        x = cur ^ prev
+        if x == 0:
+            w.write(0, 1)
+        else:
+            w.write(1, 1)
+            nlead = min(64 - x.bit_length(), 31)
+            ntrail = (x & -x).bit_length() - 1
+            if lead >= 0 and nlead >= lead and ntrail >= trail:
+                w.write(0, 1)
+                w.write(x >> trail, 64 - lead - trail)
+            else:
+                lead, trail = nlead, ntrail
+                sig = 64 - lead - trail
+                w.write(1, 1)
+                w.write(lead, 5)
+                w.write(sig & 63, 6)
+                w.write(x >> trail, sig)
+        prev = cur
+
+
+def _read_values(r: BitReader, count: int) -> List[float]:
+    prev = r.read(64)
+    out = [_u2f(prev)]
+    lead, trail = 0, 0
+    for _ in range(count - 1):
+        if r.bit() == 0:
+            out.append(_u2f(prev))
+            continue
+        if r.bit() == 1:
+            lead = r.read(5)
+            sig = r.read(6) or 64
+            trail = 64 - lead - sig
+        x = r.read(64 - lead - trail) << trail
+        prev ^= x
+        out.append(_u2f(prev))
+    return out
+
+
+# ---------- blocks / container ----------
+def encode_series(timestamps: Sequence[int], columns: Dict[str, Sequence[float]],
+                  block_size: int = BLOCK_SIZE) -> bytes:
+    """Encode ascending integer timestamps and aligned float columns into one blob."""
+    names = list(columns)
+    n = len(timestamps)
+    for name in names:
+        if len(columns[name]) != n:
+            raise ValueError(f"column {name!r} has {len(columns[name])} values, expected {n}")
+    index: List[Tuple[int, int, int, int, int]] = []
+    payload = bytearray()
+    for lo in range(0, n, block_size):
+        hi = min(n, lo + block_size)
+        w = BitWriter()
+        _write_timestamps(w, timestamps[lo:hi])
+        for name in names:
+            _write_values(w, columns[name][lo:hi])
+        data = w.getvalue()
+        index.append((int(timestamps[lo]), int(timestamps[hi - 1]), hi - lo, len(payload), len(data)))
+        payload += data
+    head = bytearray(MAGIC)
+    head += struct.pack("<H", len(names))
+    for name in names:
+        raw = name.encode("utf-8")
+        head += struct.pack("<B", len(raw)) + raw
+    head += struct.pack("<I", len(index))
+    for entry in index:
+        head += _INDEX_ENTRY.pack(*entry)
+    return bytes(head + payload)
+
+
+def _parse_header(blob: bytes) -> Tuple[List[str], List[Tuple[int, int, int, int, int]], int]:
+    if blob[:4] != MAGIC:
+        raise ValueError("not a GRL1 blob")
+    pos = 4
+    (ncols,) = struct.unpack_from("<H", blob, pos)
+    pos += 2
+    names = []
+    for _ in range(ncols):
+        (ln,) = struct.unpack_from("<B", blob, pos)
+        pos += 1
+        names.append(blob[pos:pos + ln].decode("utf-8"))
+        pos += ln
+    (nblocks,) = struct.unpack_from("<I", blob, pos)
+    pos += 4
+    index = []
+    for _ in range(nblocks):
+        index.append(_INDEX_ENTRY.unpack_from(blob, pos))
+        pos += _INDEX_ENTRY.size
+    return names, index, pos
+
+
+def series_index(blob: bytes) -> List[Dict[str, int]]:
+    """Block directory of a blob: first/last timestamp and point count per block."""
+    _, index, _ = _parse_header(blob)
+    return [{"first_ts": f, "last_ts": l, "count": c} for f, l, c, _, _ in index]
+
+
+def _decode_block(data: bytes, count: int, names: List[str], wanted: List[str]) -> Tuple[List[int], Dict[str, List[float]]]:
+    r = BitReader(data)
+    ts = _read_timestamps(r, count)
+    cols: Dict[str, List[float]] = {}
+    for name in names:
+        vals = _read_values(r, count)
+        if name in wanted:
+            cols[name] = vals
+        elif all(w in cols for w in wanted):
+            break
+    return ts, cols
+
+
+def decode_series(blob: bytes, start: Optional[int] = None, end: Optional[int] = None,
+                  columns: Optional[Iterable[str]] = None) -> Tuple[List[int], Dict[str, List[float]]]:
+    """Decode points with start <= ts <= end, touching only the overlapping blocks."""
+    names, index, base = _parse_header(blob)
+    wanted = list(columns) if columns is not None else names
+    out_ts: List[int] = []
+    out_cols: Dict[str, List[float]] = {name: [] for name in wanted}
+    for first, last, count, offset, length in index:
+        if (start is not None and last < start) or (end is not None and first > end):
+            continue
+        ts, cols = _decode_block(blob[base + offset: base + offset + length], count, names, wanted)
+        lo, hi = 0, count
+        if start is not None and first < start:
+            while lo < count and ts[lo] < start:
+                lo += 1
+        if end is not None and last > end:
+            while hi > lo and ts[hi - 1] > end:
+                hi -= 1
+        out_ts.extend(ts[lo:hi])
+        for name in wanted:
+            out_cols[name].extend(cols[name][lo:hi])
+    return out_ts, out_cols
+
+
+# ---------- pandas / files / Mongo helpers ----------
+def frame_to_blob(df, time_col: str = "timestamp", columns: Optional[Sequence[str]] = None,
+                  block_size: int = BLOCK_SIZE) -> bytes:
+    """Encode a DataFrame; datetime time columns are stored as epoch seconds."""
+    import pandas as pd
+
+    df = df.dropna(subset=[time_col])
+    ts = df[time_col]
+    if pd.api.types.is_datetime64_any_dtype(ts):
+        ts = ts.astype("datetime64[s]").astype("int64")
+    order = ts.argsort(kind="stable")
+    ts = ts.to_numpy()[order]
+    cols = [c for c in (columns or df.columns) if c != time_col]
+    data = {c: pd.to_numeric(df[c], errors="coerce").astype("float64").to_numpy()[order].tolist() for c in cols}
+    return encode_series(ts.tolist(), data, block_size=block_size)
+
+
+def blob_to_frame(blob: bytes, start: Optional[int] = None, end: Optional[int] = None,
+                  columns: Optional[Iterable[str]] = None, time_col: str = "timestamp",
+                  as_datetime: bool = False):
+    import pandas as pd
+
+    ts, cols = decode_series(blob, start, end, columns)
+    df = pd.DataFrame(cols)
+    df.insert(0, time_col, pd.to_datetime(ts, unit="s") if as_datetime else ts)
+    return df
+
+
+def save_blob(path: str, blob: bytes) -> None:
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(blob)
+    os.replace(tmp, path)
+
+
+def load_blob(path: str) -> Optional[bytes]:
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def read_csv_series(csv_path: str, time_col: str = "timestamp", start=None, parse_ts=None):
+    """Read a time-series CSV through a compressed sidecar (`<csv>.grl`).
+
+    The sidecar is rebuilt when the CSV is newer; otherwise only the blocks
+    from `start` (datetime-like or epoch seconds) onward are decoded. `parse_ts`
+    converts the raw time column to datetimes (default: pd.to_datetime, coerce).
+    Returns a DataFrame with a datetime `time_col`, or None if the CSV does not exist.
+    """
+    import pandas as pd
+
+    if not os.path.exists(csv_path):
+        return None
+    sidecar = csv_path + SIDECAR_SUFFIX
+    start_s = None
+    if start is not None:
+        start_s = int(pd.Timestamp(start).timestamp()) if not isinstance(start, (int, float)) else int(start)
+    fresh = os.path.exists(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(csv_path)
+    blob = load_blob(sidecar) if fresh else None
+    if blob is None:
+        df = pd.read_csv(csv_path)
+        df[time_col] = parse_ts(df[time_col]) if parse_ts else pd.to_datetime(df[time_col], errors="coerce")
+        blob = frame_to_blob(df, time_col=time_col)
+        try:
+            save_blob(sidecar, blob)
+        except OSError:
+            pass
+    return blob_to_frame(blob, start=start_s, time_col=time_col, as_datetime=True)
+
+
+def to_mongo_blocks(series: str, timestamps: Sequence[int], columns: Dict[str, Sequence[float]],
+                    block_size: int = BLOCK_SIZE) -> List[Dict]:
+    """One Mongo doc per block: {series, first_ts, last_ts, count, data(bytes)} – upsert on (series, first_ts)."""
+    docs = []
+    n = len(timestamps)
+    for lo in range(0, n, block_size):
+        hi = min(n, lo + block_size)
+        blob = encode_series(timestamps[lo:hi], {k: v[lo:hi] for k, v in columns.items()}, block_size=block_size)
+        docs.append({
+            "series": series,
+            "first_ts": int(timestamps[lo]),
+            "last_ts": int(timestamps[hi - 1]),
+            "count": hi - lo,
+            "data": blob,
+        })
+    return docs
+
+
+def from_mongo_blocks(docs: Iterable[Dict], start: Optional[int] = None, end: Optional[int] = None,
+                      columns: Optional[Iterable[str]] = None) -> Tuple[List[int], Dict[str, List[float]]]:
+    """Decode block docs (any order) back into one series."""
+    out_ts: List[int] = []
+    out_cols: Dict[str, List[float]] = {}
+    for d in sorted(docs, key=lambda d: d.get("first_ts", 0)):
+        ts, cols = decode_series(bytes(d["data"]), start, end, columns)
+        out_ts.extend(ts)
+        for k, v in cols.items():
+            out_cols.setdefault(k, []).extend(v)
+    return out_ts, out_cols
+
+
+__all__ = [
+    "encode_series", "decode_series", "series_index",
+    "frame_to_blob", "blob_to_frame", "read_csv_series",
+    "save_blob", "load_blob", "to_mongo_blocks", "from_mongo_blocks",
+]
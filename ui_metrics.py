@@ -8,11 +8,15 @@ from portfolio_history import filter_portfolio_totals, filter_coin_history
 
 
 def show_portfolio_over_time_chart(history, tz_display="Asia/Bangkok", key="main_line_chart"):
-    if not history:
+    """Plot totals from a list of history docs or a DataFrame returned by `read_range`."""
+    if history is None or len(history) == 0:
         st.info("Chưa có dữ liệu lịch sử portfolio.")
         return
     tz = pytz.timezone(tz_display)
-    df_totals = pd.DataFrame(filter_portfolio_totals(history))
+    if isinstance(history, pd.DataFrame):
+        df_totals = history[history["coin"].isna()] if "coin" in history.columns else history
+    else:
+        df_totals = pd.DataFrame(filter_portfolio_totals(history))
     if df_totals.empty:
         st.info("Không có bản ghi tổng Portfolio.")
         return
@@ -63,3 +67,16 @@ def show_health_panel(db, queue_length: int, last_price_ts: int, last_price_upda
             st.metric("Last Price Update", "N/A")
     with cols[3]:
         st.write(last_price_update_message or "")
+    # Mongo indexes: cảnh báo index thiếu và số lần sử dụng ($indexStats)
+    report = getattr(db, "index_report", None)
+    if report:
+        warnings = db.index_warnings()
+        with st.expander(f"Mongo indexes ({len(warnings)} cảnh báo)", expanded=bool(warnings)):
+            for w in warnings:
+                st.warning(w)
+            rows = []
+            for coll in report:
+                for name, ops in db.index_usage(coll).items():
+                    rows.append({"collection": coll, "index": name, "ops": ops})
+            if rows:
+                st.dataframe(pd.DataFrame(rows), use_container_width=True, hide_index=True)